@@ -672,6 +672,9 @@ class ModesLead(Lead):
         stabilized = self.modes(energy, args, params=params)[1]
         return stabilized.selfenergy()
 
+    def selfenergy_factors(self, energy, args=(), *, params=None):
+        return self.modes(energy, args, params=params)[1]
+
 
 
 ################ Builder class
@@ -26,6 +26,7 @@ __all__ = ['Graph', 'CGraph']
 # TODO (perhaps): transform Graph into something which behaves like a python
 # sequence.  Allow creation of compressed graphs from any sequence.
 
+cimport cython
 from libc.stdlib cimport malloc, realloc, free
 from libc.string cimport memset
 from cpython cimport array
@@ -33,6 +34,7 @@ import array
 import numpy as np
 cimport numpy as np
 from .defs cimport gint
+from .defs import gint_dtype
 
 cdef class Graph:
     """An uncompressed graph.  Used to make compressed graphs.  (See `CGraph`.)
@@ -660,6 +662,77 @@ cdef class CGraph:
         file.write("}\n")
 
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _graph_edges(graph):
+    """Return the tails and the heads of all the edges of `graph`, in the
+    order in which they are iterated over."""
+    if not isinstance(graph, CGraph):
+        edges = np.array(list(graph), dtype=gint_dtype).reshape(-1, 2)
+        return edges[:, 0], edges[:, 1]
+    cdef CGraph g = graph
+    cdef gint[:] tails = np.empty(g.num_edges, dtype=gint_dtype)
+    cdef gint[:] heads = np.empty(g.num_edges, dtype=gint_dtype)
+    cdef gint tail, edge
+    for tail in range(g.num_nodes):
+        for edge in range(g.heads_idxs[tail], g.heads_idxs[tail + 1]):
+            tails[edge] = tail
+            heads[edge] = g.heads[edge]
+    return np.asarray(tails), np.asarray(heads)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _distance_coloring(graph, gint distance):
+    """Color the nodes of a graph such that nodes with the same color are
+    more than 'distance' edges apart.
+
+    The nodes are colored greedily, in their order in the graph: each node
+    gets the smallest color that is not used by the nodes found with a
+    breadth-first search of depth 'distance' from it.
+    """
+    tails, heads_array = _graph_edges(graph)
+    order = np.argsort(tails, kind='stable')
+    cdef gint num_nodes = graph.num_nodes
+    cdef gint[:] heads = heads_array[order]
+    cdef gint[:] heads_idxs = np.searchsorted(
+        tails[order], np.arange(num_nodes + 1)).astype(gint_dtype)
+
+    cdef gint[:] colors = np.full(num_nodes, -1, dtype=gint_dtype)
+    # scratch space reused for all the nodes: 'visited[j] == i' if 'j' was
+    # reached from 'i', and 'used[c] == i' if the color 'c' was found.
+    cdef gint[:] visited = np.full(num_nodes, -1, dtype=gint_dtype)
+    cdef gint[:] used = np.full(num_nodes + 1, -1, dtype=gint_dtype)
+    cdef gint[:] queue = np.empty(num_nodes, dtype=gint_dtype)
+    cdef gint i, j, k, edge, depth, start, stop, end, color
+    with nogil:
+        for i in range(num_nodes):
+            visited[i] = i
+            queue[0] = i
+            start, end = 0, 1
+            # 'queue[start:end]' holds the nodes at the current depth
+            for depth in range(distance):
+                stop = end
+                for k in range(start, stop):
+                    for edge in range(heads_idxs[queue[k]],
+                                      heads_idxs[queue[k] + 1]):
+                        j = heads[edge]
+                        if visited[j] != i:
+                            visited[j] = i
+                            queue[end] = j
+                            end += 1
+                            if colors[j] >= 0:
+                                used[colors[j]] = i
+                start = stop
+                if start == end:
+                    break
+            color = 0
+            while used[color] == i:
+                color += 1
+            colors[i] = color
+    return np.asarray(colors)
+
+
 cdef class CGraph_malloc(CGraph):
     """A CGraph which allocates and frees its own memory."""
 
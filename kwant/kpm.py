@@ -8,16 +8,30 @@
 # http://kwant-project.org/authors.
 
 import math
+import hashlib
+import functools
+import collections
+import multiprocessing
+from contextlib import contextmanager
 import numpy as np
+import numpy.linalg as npl
 import scipy
-import scipy.sparse.linalg as sla
+import scipy.linalg
+import scipy.special
 import scipy.fftpack as fft
 
 from . import system
 from ._common import ensure_rng
-from .operator import _LocalOperator
+from .operator import _LocalOperator, Density, _get_all_orbs
+from .graph.core import _distance_coloring
 
-__all__ = ['SpectralDensity']
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # skip coverage; Python < 3.8
+    shared_memory = None
+
+__all__ = ['SpectralDensity', 'Conductivity', 'Propagator',
+           'ProbingVectors', 'fermi_distribution']
 
 
 class SpectralDensity:
@@ -63,19 +77,40 @@ class SpectralDensity:
         length ``n`` that will be used in the algorithm.
         If not provided, random phase vectors are used.
         The default random vectors are optimal for most cases, see the
-        discussions in [1]_ and [2]_.
+        discussions in [1]_ and [2]_. For local Hamiltonians, probing
+        vectors from `~kwant.kpm.ProbingVectors` may need fewer vectors.
     bounds : pair of floats, optional
         Lower and upper bounds for the eigenvalue spectrum of the system.
-        If not provided, they are computed.
+        If not provided, they are estimated with the Lanczos algorithm, to
+        a precision set by ``eps``. The estimated bounds are cached, so
+        they are only calculated once for the same Hamiltonian.
     eps : positive float, default: 0.05
         Parameter to ensure that the rescaled spectrum lies in the
-        interval ``(-1, 1)``; required for stability.
+        interval ``(-1, 1)``; required for stability. The spectrum is
+        rescaled to have a margin of about ``eps / 2`` at either end.
     rng : seed, or random number generator, optional
         Random number generator used for the calculation of the spectral
         bounds, and to generate random vectors (if ``vector_factory`` is
         not provided). If not provided, numpy's rng will be used; if it
         is an Integer, it will be used to seed numpy's rng, and if it is
         a random number generator, this is the one used.
+    block_size : positive int, optional
+        Number of random vectors that are propagated together, using
+        sparse matrix products with blocks of vectors.  If not provided,
+        all the random vectors are propagated together, unless ``n_jobs``
+        is larger than 1, in which case they are split evenly among the
+        processes.
+    n_jobs : positive int, default: 1
+        Number of processes among which the blocks of random vectors are
+        distributed.  The results do not depend on the number of
+        processes.
+    dtype : numpy dtype, default: complex128
+        Type of the Hamiltonian and of the vectors of the Chebyshev
+        recursion: ``complex128``, ``complex64``, ``float64`` or
+        ``float32``. The real types require a real Hamiltonian, and the
+        default random vectors then have random signs. Single and real
+        types reduce the memory traffic of the sparse matrix products.
+        See the notes below for their accuracy.
 
     Notes
     -----
@@ -86,6 +121,26 @@ class SpectralDensity:
     will be arrays of the length of the system, that is, local
     densities.
 
+    The Chebyshev moments, as well as the vectors needed to continue the
+    Chebyshev recursion, are stored with the instance. Instances can be
+    pickled (provided that the ``operator`` and ``vector_factory`` can be
+    pickled), for example to save a long calculation and extend it later
+    with `add_moments` or `add_vectors`.
+
+    With a real ``dtype``, the random vectors have random signs instead of
+    random phases. This doubles the variance of the stochastic trace, so
+    about twice as many vectors are needed for the same accuracy. The
+    sparse products are, however, about three times cheaper.
+
+    In single precision, the inner products are still accumulated in
+    double precision, but the rounding errors of the Chebyshev recursion
+    grow with the number of moments. Compared with double precision for
+    the same random vectors, the relative error of the densities of a
+    disordered square lattice of 300 by 300 sites is about 1e-5 for 400
+    moments and 1e-4 for 1000 moments. This is usually well below the
+    statistical error, but should be checked against a double precision
+    calculation with a few random vectors when many moments are used.
+
     .. [1] `Rev. Mod. Phys., Vol. 78, No. 1 (2006)
        <https://arxiv.org/abs/cond-mat/0504627>`_.
     .. [2] `Phys. Rev. E 69, 057701 (2004)
@@ -136,7 +191,8 @@ class SpectralDensity:
 
     def __init__(self, hamiltonian, params=None, operator=None,
                  num_vectors=10, num_moments=None, energy_resolution=None,
-                 vector_factory=None, bounds=None, eps=0.05, rng=None):
+                 vector_factory=None, bounds=None, eps=0.05, rng=None,
+                 block_size=None, n_jobs=1, dtype=None):
 
         if num_moments and energy_resolution:
             raise TypeError("either 'num_moments' or 'energy_resolution' "
@@ -146,6 +202,11 @@ class SpectralDensity:
         # self.eps ensures that the rescaled Hamiltonian has a
         # spectrum strictly in the interval (-1,1).
         self.eps = eps
+        self.dtype = np.dtype(complex if dtype is None else dtype)
+        if self.dtype not in _kpm_dtypes:
+            raise ValueError("'dtype' must be one of {}."
+                             .format(', '.join(map(str, _kpm_dtypes))))
+        real = self.dtype.kind == 'f'
 
         # Normalize the format of 'ham'
         if isinstance(hamiltonian, system.System):
@@ -156,6 +217,8 @@ class SpectralDensity:
         except Exception:
             raise ValueError("'hamiltonian' is neither a matrix "
                              "nor a Kwant system.")
+        if real and np.any(hamiltonian.data.imag):
+            raise ValueError("A real 'dtype' requires a real Hamiltonian.")
 
         # Normalize 'operator' to a common format.
         if operator is None:
@@ -166,21 +229,25 @@ class SpectralDensity:
             self.operator = operator
         elif hasattr(operator, 'dot'):
             operator = scipy.sparse.csr_matrix(operator)
-            self.operator = lambda bra, ket: np.vdot(bra, operator.dot(ket))
+            self.operator = functools.partial(_matrix_element, operator)
         else:
             raise ValueError('Parameter `operator` has no `.dot` '
                              'attribute and is not callable.')
 
-        self._vector_factory = vector_factory or \
-            (lambda n: np.exp(2j * np.pi * rng.random_sample(n)))
+        self._vector_factory = (
+            vector_factory or
+            functools.partial(_random_signs if real else _random_phases,
+                              rng))
         # store this vector for reproducibility
         self._v0 = np.exp(2j * np.pi * rng.random_sample(hamiltonian.shape[0]))
-        self._rand_vect_list = []
         # Hamiltonian rescaled as in Eq. (24)
         self.hamiltonian, (self._a, self._b) = _rescale(hamiltonian,
                                                         eps=self.eps,
                                                         v0=self._v0,
                                                         bounds=bounds)
+        if real:
+            self.hamiltonian = self.hamiltonian.real
+        self.hamiltonian = self.hamiltonian.astype(self.dtype)
         self.bounds = (self._b - self._a, self._b + self._a)
 
         if energy_resolution:
@@ -188,30 +255,33 @@ class SpectralDensity:
         elif num_moments is None:
             num_moments = 100
 
-        must_be_positive_int = ['num_vectors', 'num_moments']
+        if block_size is None:
+            block_size = max(num_vectors // n_jobs, 1)
+
+        must_be_positive_int = ['num_vectors', 'num_moments', 'block_size',
+                                'n_jobs']
         for var in must_be_positive_int:
             val = locals()[var]
             if val <= 0 or val != int(val):
                 raise ValueError('{} must be a positive integer'.format(var))
         if eps <= 0:
             raise ValueError('eps must be positive')
+        self.block_size = block_size
+        self.n_jobs = n_jobs
 
-        for r in range(num_vectors):
-            self._rand_vect_list.append(
-                self._vector_factory(self.hamiltonian.shape[0]))
-        self._last_two_alphas = [0.] * num_vectors
-        self._moments_list = [0.] * num_vectors
+        # The random vectors, the last two vectors of the Chebyshev
+        # recursion and the moments are stored with the random vectors along
+        # the last, last and first axis, respectively.
+        self._rand_vects = self._make_vectors(num_vectors)
+        self._last_two_alphas = None
+        self._moments_list = None
 
         self.num_moments = num_moments
         self.num_vectors = 0  # new random vectors will be used
         self._update_moments_list(self.num_moments, num_vectors)
         self.num_vectors = num_vectors
 
-        moments = self._moments()
-        xk_rescaled, rho, self._gammas = _calc_fft_moments(
-            moments, 2 * self.num_moments)
-        self.energies = xk_rescaled * self._a + self._b
-        self.densities = rho
+        self._update_densities()
 
     def __call__(self, energy=None):
         """Return the spectral density evaluated at ``energy``.
@@ -239,22 +309,8 @@ class SpectralDensity:
             g_e = (np.pi * np.sqrt(1 - rescaled_energy)
                    * np.sqrt(1 + rescaled_energy))
 
-            moments = self._moments()
-
-            m = np.arange(self.num_moments)
-
-            kernel = ((self.num_moments - m + 1) *
-                      np.cos(np.pi * m/(self.num_moments + 1)) +
-                      np.sin(np.pi * m/(self.num_moments + 1)) /
-                      np.tan(np.pi/(self.num_moments + 1)))
-            kernel = kernel / (self.num_moments + 1)
-
-            # transposes handle the case where operators have vector outputs
-            coef_cheb = np.transpose(moments.transpose() * kernel)
-            coef_cheb[1:] = 2 * coef_cheb[1:]
-
             return np.transpose(np.polynomial.chebyshev.chebval(
-                    rescaled_energy, coef_cheb) / g_e).real
+                    rescaled_energy, self._coef_cheb) / g_e).real
 
     def integrate(self, distribution_function=None):
         """Returns the total spectral density.
@@ -263,19 +319,35 @@ class SpectralDensity:
         distribution function. ``distribution_function`` should be able
         to take arrays as input. Defined using Gauss-Chebyshev
         integration.
+
+        Several distribution functions are integrated at once if
+        ``distribution_function`` returns an array with additional
+        leading axes, the energies being along the last axis. The
+        result then has these leading axes. For example, the integrals
+        for arrays of chemical potentials ``mu`` and temperatures ``T``
+        are obtained with
+
+        >>> def fermi(energy):
+        ...     return fermi_distribution(energy, mu[:, np.newaxis, np.newaxis],
+        ...                               T[:, np.newaxis])
+        >>> integrals = spectrum.integrate(fermi)
         """
         # This factor divides the sum to normalize the Gauss integral
         # and rescales the integral back with ``self._a`` to normal
         # scale.
         factor = self._a / (2 * self.num_moments)
         if distribution_function is None:
-            rho = self._gammas
-        else:
-            # The evaluation of the distribution function should be at
-            # the energies without rescaling.
-            distribution_array = distribution_function(self.energies)
-            rho = np.transpose(self._gammas.transpose() * distribution_array)
-        return factor * np.sum(rho, axis=0)
+            return factor * np.sum(self._gammas, axis=0)
+        # The evaluation of the distribution function should be at
+        # the energies without rescaling.
+        distribution_array = np.asarray(distribution_function(self.energies))
+        # Distribution functions that do not depend on the energy may
+        # return a scalar.
+        distribution_array = np.broadcast_to(
+            distribution_array,
+            distribution_array.shape[:-1] + self.energies.shape)
+        return factor * np.tensordot(distribution_array, self._gammas,
+                                     axes=1)[()]
 
     def add_moments(self, num_moments=None, *, energy_resolution=None):
         """Increase the number of Chebyshev moments.
@@ -316,12 +388,7 @@ class SpectralDensity:
                                   self.num_vectors)
         self.num_moments += num_moments
 
-        # recalculate quantities derived from the moments
-        moments = self._moments()
-        xk_rescaled, rho, self._gammas = _calc_fft_moments(
-            moments, 2 * self.num_moments)
-        self.energies = xk_rescaled * self._a + self._b
-        self.densities = rho
+        self._update_densities()
 
     def add_vectors(self, num_vectors):
         """Increase the number of random vectors.
@@ -333,25 +400,43 @@ class SpectralDensity:
         """
         if num_vectors <= 0 or num_vectors != int(num_vectors):
             raise ValueError("'num_vectors' must be a positive integer")
-        for r in range(num_vectors):
-            self._rand_vect_list.append(
-                self._vector_factory(self.hamiltonian.shape[0]))
-        self._moments_list.extend([0.] * num_vectors)
-        self._last_two_alphas.extend([0.] * num_vectors)
+        self._rand_vects = np.concatenate(
+            [self._rand_vects, self._make_vectors(num_vectors)], axis=1)
         self._update_moments_list(self.num_moments,
                                   self.num_vectors + num_vectors)
         self.num_vectors += num_vectors
 
-        # recalculate quantities derived from the moments
+        self._update_densities()
+
+    def _update_densities(self):
+        """Recalculate the quantities derived from the moments."""
         moments = self._moments()
         xk_rescaled, rho, self._gammas = _calc_fft_moments(
             moments, 2 * self.num_moments)
         self.energies = xk_rescaled * self._a + self._b
         self.densities = rho
 
+        # Chebyshev coefficients of the kernel improved density, for the
+        # evaluation at arbitrary energies.
+        kernel = _jackson_kernel(self.num_moments)
+        # transposes handle the case where operators have vector outputs
+        self._coef_cheb = np.transpose(moments.transpose() * kernel)
+        self._coef_cheb[1:] *= 2
+
+    def _make_vectors(self, num_vectors):
+        """Return new random vectors, stacked as columns."""
+        vectors = [self._vector_factory(self.hamiltonian.shape[0])
+                   for r in range(num_vectors)]
+        vectors = np.array(vectors).transpose()
+        if self.dtype.kind == 'f' and np.iscomplexobj(vectors):
+            if np.any(vectors.imag):
+                raise ValueError("A real 'dtype' requires real vectors.")
+            vectors = vectors.real
+        return np.array(vectors, dtype=self.dtype, order='C')
+
     def _moments(self):
         # sum moments of all random vectors
-        moments = np.sum(np.asarray(self._moments_list).real, axis=0)
+        moments = np.sum(self._moments_list.real, axis=0)
         # divide by the number of random vectors
         moments /= self.num_vectors
         # divide by scale factor to reflect the integral rescaling
@@ -383,14 +468,12 @@ class SpectralDensity:
             raise ValueError('Cannot decrease number of random vectors')
 
         if n_moments == self.num_moments:
-            m_start = 2
             new_moments = 0
             if new_rand_vect == 0:
                 # nothing new to calculate
                 return
         else:
             new_moments = n_moments - self.num_moments
-            m_start = self.num_moments
             if new_moments < 0:
                 raise ValueError('Cannot decrease number of moments')
 
@@ -398,65 +481,969 @@ class SpectralDensity:
                 raise ValueError("Only 'num_moments' *or* 'num_vectors' "
                                  "may be updated at a time.")
 
-        for r in range(r_start, n_rand):
-            alpha_zero = self._rand_vect_list[r]
+        # The random vectors are propagated in blocks, stacked as the
+        # columns of 2D arrays.
+        blocks = [range(block_start, min(block_start + self.block_size,
+                                         n_rand))
+                  for block_start in range(r_start, n_rand, self.block_size)]
+        tasks = []
+        for block in blocks:
+            block = slice(block.start, block.stop)
+            alpha_zero = np.ascontiguousarray(self._rand_vects[:, block])
+            if new_moments > 0:
+                last_two_alphas = tuple(np.ascontiguousarray(alpha[:, block])
+                                        for alpha in self._last_two_alphas)
+                moments = np.swapaxes(self._moments_list[block], 0, 1)
+            else:
+                last_two_alphas = moments = None
+            tasks.append((alpha_zero, n_moments, last_two_alphas, moments))
 
-            one_moment = [0.] * n_moments
-            if new_rand_vect > 0:
-                alpha = alpha_zero
-                alpha_next = self.hamiltonian.matvec(alpha)
-                if self.operator is None:
-                    one_moment[0] = np.vdot(alpha_zero, alpha_zero)
-                    one_moment[1] = np.vdot(alpha_zero, alpha_next)
-                else:
-                    one_moment[0] = self.operator(alpha_zero, alpha_zero)
-                    one_moment[1] = self.operator(alpha_zero, alpha_next)
+        if self.n_jobs == 1 or len(tasks) == 1:
+            results = [_block_moments(self.hamiltonian, self.operator, *task)
+                       for task in tasks]
+        else:
+            with _process_pool(self.n_jobs, self.hamiltonian,
+                               self.operator) as pool:
+                results = pool.starmap(_block_moments_in_worker, tasks)
+
+        moments, last_two_alphas = zip(*results)
+        if new_moments > 0:
+            self._moments_list = np.concatenate(moments)
+            self._last_two_alphas = np.concatenate(last_two_alphas, axis=2)
+        else:
+            old = [] if self._moments_list is None else [self._moments_list]
+            self._moments_list = np.concatenate(old + list(moments))
+            old = ([] if self._last_two_alphas is None
+                   else [self._last_two_alphas])
+            self._last_two_alphas = np.concatenate(
+                old + [np.array(alphas) for alphas in last_two_alphas],
+                axis=2)
 
-            if new_moments > 0:
-                (alpha, alpha_next) = self._last_two_alphas[r]
-                one_moment[0:self.num_moments] = self._moments_list[r]
-            # Iteration over the moments
-            # Two cases can occur, depicted in Eq. (28) and in Eq. (29),
-            # respectively.
-            # ----
-            # In the first case, self.operator is None and we can use
-            # Eqs. (34) and (35) to obtain the density of states, with
-            # two moments ``one_moment`` for every new alpha.
-            # ----
-            # In the second case, the operator is not None and a matrix
-            # multiplication should be used.
-            if self.operator is None:
-                for n in range(m_start//2, n_moments//2):
-                    alpha_save = alpha_next
-                    alpha_next = (2 * self.hamiltonian.matvec(alpha_next)
-                                  - alpha)
-                    alpha = alpha_save
-                    # Following Eqs. (34) and (35)
-                    one_moment[2*n] = (2 * np.vdot(alpha, alpha)
-                                       - one_moment[0])
-                    one_moment[2*n+1] = (2 * np.vdot(alpha_next, alpha)
-                                         - one_moment[1])
-                if n_moments % 2:
-                    # odd moment
-                    one_moment[n_moments - 1] = (
-                        2 * np.vdot(alpha_next, alpha_next) - one_moment[0])
+
+class Conductivity:
+    r"""Calculate the conductivity tensor with the Kubo-Bastin formula.
+
+    This class makes use of the kernel polynomial method (KPM) to expand
+    the Kubo-Bastin formula for an element :math:`σ_{αβ}` of the
+    conductivity tensor in two-dimensional Chebyshev moments, as presented
+    in [1]_. In units of :math:`e^2/h`,
+
+    .. math::
+       σ_{αβ}(μ, T) = \frac{8}{a^2 Ω} \int_{-1}^{1} dε
+           \frac{f(ε)}{(1 - ε^2)^2} \sum_{m,n} Γ_{mn}(ε) μ_{mn},
+
+    where :math:`f` is the Fermi-Dirac distribution, :math:`Ω` the volume
+    of the system, :math:`a` the scale factor of the rescaled Hamiltonian
+    :math:`\tilde H` and
+
+    .. math::
+       Γ_{mn}(ε) = (ε + i n \sqrt{1 - ε^2}) e^{-i n \arccos ε} T_m(ε)
+           + (ε - i m \sqrt{1 - ε^2}) e^{i m \arccos ε} T_n(ε),
+
+    .. math::
+       μ_{mn} = \frac{g_m g_n}{(1 + δ_{m0})(1 + δ_{n0})}
+           \mathrm{Tr}\left[v_α T_m(\tilde H) v_β T_n(\tilde H)\right],
+
+    with :math:`T_m` the Chebyshev polynomials, :math:`g_m` the Jackson
+    kernel and :math:`v_α = i[H, x_α]` the velocity operators. The trace
+    is estimated with random vectors, so the cost of the calculation is
+    linear in the size of the system.
+
+    Parameters
+    ----------
+    hamiltonian : `~kwant.system.FiniteSystem` or matrix Hamiltonian
+        If a system is passed, it should contain no leads.
+    alpha, beta : {'x', 'y', 'z'}, or matrix, default: 'x'
+        The directions of the conductivity tensor element. The velocity
+        operators are obtained from the hoppings of the Hamiltonian and
+        the ``positions``. Alternatively, Hermitian velocity operators can
+        be provided as dense or sparse matrices, for example for systems
+        with periodic boundary conditions.
+    positions : array of shape ``(N, d)``, optional
+        Positions of the ``N`` orbitals of the Hamiltonian. Required if a
+        matrix Hamiltonian is passed and ``alpha`` or ``beta`` are
+        directions. If a system is passed, the positions of its sites are
+        used.
+    params : dict, optional
+        Additional parameters to pass to the Hamiltonian.
+    num_vectors : positive int, default: 10
+        Number of random vectors for the KPM method.
+    num_moments : positive int, default: 100
+        Number of moments, order of the KPM expansion. Mutually exclusive
+        with 'energy_resolution'.
+    energy_resolution : positive float, optional
+        The resolution in energy of the KPM approximation. Mutually
+        exclusive with 'num_moments'.
+    vector_factory : function, optional
+        The user defined function ``f(n)`` generates random vectors of
+        length ``n`` that will be used in the algorithm.
+        If not provided, random phase vectors are used.
+    bounds : pair of floats, optional
+        Lower and upper bounds for the eigenvalue spectrum of the system.
+        If not provided, they are estimated with the Lanczos algorithm, to
+        a precision set by ``eps``. The estimated bounds are cached, so
+        they are only calculated once for the same Hamiltonian.
+    eps : positive float, default: 0.05
+        Parameter to ensure that the rescaled spectrum lies in the
+        interval ``(-1, 1)``; required for stability. The spectrum is
+        rescaled to have a margin of about ``eps / 2`` at either end.
+    rng : seed, or random number generator, optional
+        Random number generator used for the calculation of the spectral
+        bounds, and to generate random vectors (if ``vector_factory`` is
+        not provided). Same as for `~kwant.kpm.SpectralDensity`.
+    block_size : positive int, default: 1
+        Number of random vectors that are propagated together. The
+        memory needed is proportional to ``block_size * num_moments``
+        times the size of the Hamiltonian.
+    n_jobs : positive int, default: 1
+        Number of processes among which the blocks of random vectors are
+        distributed.
+
+    Notes
+    -----
+    Like the spectral density, the conductivity is extensive: the
+    returned values are :math:`Ω σ_{αβ}`, in units of :math:`e^2/h`
+    times the unit of volume of the ``positions``. The temperature is
+    given in units of energy.
+
+    Only the number of random vectors can be increased after creation,
+    with `add_vectors`.
+
+    .. [1] `Phys. Rev. Lett. 114, 116602 (2015)
+       <https://arxiv.org/abs/1410.8140>`_.
+
+    Examples
+    --------
+    The Hall conductivity of a system ``fsyst`` in the plane is obtained,
+    as a function of the chemical potential, with
+
+    >>> sigma_xy = kwant.kpm.Conductivity(fsyst, alpha='x', beta='y')
+    >>> conductivities = sigma_xy(mu=np.linspace(-1, 1), temperature=0.01)
+
+    Attributes
+    ----------
+    energies : array of floats
+        Array of sampling points with length ``2 * num_moments`` in
+        the range of the spectrum, used to integrate over the energy.
+    """
+
+    def __init__(self, hamiltonian, alpha='x', beta='x', positions=None,
+                 params=None, num_vectors=10, num_moments=None,
+                 energy_resolution=None, vector_factory=None, bounds=None,
+                 eps=0.05, rng=None, block_size=1, n_jobs=1):
+
+        if num_moments and energy_resolution:
+            raise TypeError("either 'num_moments' or 'energy_resolution' "
+                            "must be provided.")
+
+        rng = ensure_rng(rng)
+        self.eps = eps
+
+        directions = [v for v in (alpha, beta) if isinstance(v, str)]
+        if isinstance(hamiltonian, system.System):
+            if directions and positions is None:
+                positions = _orbital_positions(hamiltonian)
+            hamiltonian = hamiltonian.hamiltonian_submatrix(params=params,
+                                                            sparse=True)
+        try:
+            hamiltonian = scipy.sparse.csr_matrix(hamiltonian)
+        except Exception:
+            raise ValueError("'hamiltonian' is neither a matrix "
+                             "nor a Kwant system.")
+        if directions and positions is None:
+            raise ValueError("'positions' must be provided to obtain the "
+                             "velocity operators of a matrix Hamiltonian.")
+        self._velocities = tuple(_velocity(hamiltonian, v, positions)
+                                 for v in (alpha, beta))
+
+        self._vector_factory = (vector_factory or
+                                functools.partial(_random_phases, rng))
+        self._v0 = np.exp(2j * np.pi * rng.random_sample(hamiltonian.shape[0]))
+        self.hamiltonian, (self._a, self._b) = _rescale(hamiltonian,
+                                                        eps=self.eps,
+                                                        v0=self._v0,
+                                                        bounds=bounds)
+        self.bounds = (self._b - self._a, self._b + self._a)
+
+        if energy_resolution:
+            num_moments = math.ceil((1.6 * self._a) / energy_resolution)
+        elif num_moments is None:
+            num_moments = 100
+
+        must_be_positive_int = ['num_vectors', 'num_moments', 'block_size',
+                                'n_jobs']
+        for var in must_be_positive_int:
+            val = locals()[var]
+            if val <= 0 or val != int(val):
+                raise ValueError('{} must be a positive integer'.format(var))
+        if eps <= 0:
+            raise ValueError('eps must be positive')
+        self.num_moments = num_moments
+        self.block_size = block_size
+        self.n_jobs = n_jobs
+
+        # Sum over the random vectors of the traces in the moments.
+        self._moments_sum = np.zeros((num_moments, num_moments), complex)
+        self.num_vectors = 0
+        self.add_vectors(num_vectors)
+
+    def __call__(self, mu=0, temperature=0):
+        """Return the conductivity tensor element.
+
+        Parameters
+        ----------
+        mu : float or array of floats, default: 0
+            Chemical potential.
+        temperature : float or array of floats, default: 0
+            Temperature, in units of energy.
+
+        Returns
+        -------
+        float, if ``mu`` and ``temperature`` are floats, or array of floats
+        with the shape of ``mu`` and ``temperature`` broadcast together.
+        """
+        mu, temperature = np.broadcast_arrays(mu, temperature)
+        occupations = fermi_distribution(self.energies,
+                                         mu[..., np.newaxis],
+                                         temperature[..., np.newaxis])
+        return occupations.dot(self._weights)
+
+    def add_vectors(self, num_vectors):
+        """Increase the number of random vectors.
+
+        Parameters
+        ----------
+        num_vectors: positive int
+            The number of random vectors to add.
+        """
+        if num_vectors <= 0 or num_vectors != int(num_vectors):
+            raise ValueError("'num_vectors' must be a positive integer")
+
+        tasks = []
+        for block_start in range(0, num_vectors, self.block_size):
+            block_size = min(self.block_size, num_vectors - block_start)
+            vectors = [self._vector_factory(self.hamiltonian.shape[0])
+                       for r in range(block_size)]
+            tasks.append((np.array(vectors).transpose().copy(),
+                          self.num_moments))
+
+        if self.n_jobs == 1 or len(tasks) == 1:
+            results = [_correlation_moments(self.hamiltonian,
+                                            self._velocities, *task)
+                       for task in tasks]
+        else:
+            with _process_pool(self.n_jobs, self.hamiltonian,
+                               self._velocities) as pool:
+                results = pool.starmap(_correlation_moments_in_worker, tasks)
+        for moments in results:
+            self._moments_sum += moments
+        self.num_vectors += num_vectors
+
+        # recalculate quantities derived from the moments
+        self.energies, self._weights = _kubo_bastin_weights(
+            self._moments_sum / self.num_vectors, self._a, self._b,
+            2 * self.num_moments)
+
+
+class Propagator:
+    r"""Propagate states in time with the kernel polynomial method.
+
+    The time evolution operator is expanded in Chebyshev polynomials of
+    the rescaled Hamiltonian :math:`\tilde H = (H - b) / a`, with
+    coefficients given by Bessel functions of the first kind [1]_,
+
+    .. math::
+       e^{-iHt} = e^{-ibt} \left[J_0(at) + 2 \sum_{n=1}^{N-1} (-i)^n
+           J_n(at) T_n(\tilde H)\right].
+
+    The order :math:`N` of the expansion is chosen for each time step,
+    such that the neglected terms are smaller than ``tol``. It grows
+    linearly with the time step, so that the cost of the propagation is
+    linear in the total time and in the size of the system.
+
+    Parameters
+    ----------
+    hamiltonian : `~kwant.system.FiniteSystem` or matrix Hamiltonian
+        If a system is passed, it should contain no leads.
+    params : dict, optional
+        Additional parameters to pass to the Hamiltonian and operators.
+    tol : positive float, default: 1e-12
+        Accuracy of the Chebyshev expansion, relative to the norm of the
+        propagated states.
+    bounds : pair of floats, optional
+        Lower and upper bounds for the eigenvalue spectrum of the system.
+        If not provided, they are estimated as for
+        `~kwant.kpm.SpectralDensity`.
+    eps : positive float, default: 0.05
+        Parameter to ensure that the rescaled spectrum lies in the
+        interval ``(-1, 1)``; required for stability.
+    rng : seed, or random number generator, optional
+        Random number generator used for the calculation of the spectral
+        bounds.
+
+    Notes
+    -----
+    Times are in units of :math:`ħ` divided by the unit of energy of the
+    Hamiltonian.
+
+    .. [1] `J. Chem. Phys. 81, 3967 (1984)
+       <https://doi.org/10.1063/1.448136>`_.
+
+    Examples
+    --------
+    The spreading of a wave packet ``psi`` in a system ``fsyst`` is
+    obtained from the expectation value of an operator along the
+    trajectory, without storing the intermediate states
+
+    >>> propagator = kwant.kpm.Propagator(fsyst)
+    >>> density = kwant.operator.Density(fsyst, sum=False)
+    >>> times = np.linspace(0, 10, 101)
+    >>> densities = propagator.expectation_values(density, psi, times)
+    """
+
+    def __init__(self, hamiltonian, params=None, tol=1e-12, bounds=None,
+                 eps=0.05, rng=None):
+        if tol <= 0:
+            raise ValueError('tol must be positive')
+        if eps <= 0:
+            raise ValueError('eps must be positive')
+        rng = ensure_rng(rng)
+        self.params = params
+        self.tol = tol
+
+        if isinstance(hamiltonian, system.System):
+            hamiltonian = hamiltonian.hamiltonian_submatrix(params=params,
+                                                            sparse=True)
+        try:
+            hamiltonian = scipy.sparse.csr_matrix(hamiltonian)
+        except Exception:
+            raise ValueError("'hamiltonian' is neither a matrix "
+                             "nor a Kwant system.")
+
+        v0 = np.exp(2j * np.pi * rng.random_sample(hamiltonian.shape[0]))
+        self.hamiltonian, (self._a, self._b) = _rescale(hamiltonian, eps=eps,
+                                                        v0=v0, bounds=bounds)
+        self.bounds = (self._b - self._a, self._b + self._a)
+        # Expansion coefficients, indexed by the time step.
+        self._coefficients = {}
+
+    def __call__(self, vectors, time):
+        """Return the states evolved during ``time``.
+
+        Parameters
+        ----------
+        vectors : 1D or 2D array
+            The state, or the states stacked as columns.
+        time : float
+
+        Returns
+        -------
+        array of the same shape as ``vectors``.
+        """
+        vectors = np.asarray(vectors, dtype=complex)
+        if time == 0:
+            return vectors.copy()
+        coefs = self._expansion_coefficients(time)
+        result = np.zeros_like(vectors)
+        for coef, alpha in zip(coefs, _chebyshev_vectors(self.hamiltonian,
+                                                         vectors, len(coefs))):
+            result += coef * alpha
+        return result
+
+    def trajectory(self, vectors, times):
+        """Yield the evolved states at a sequence of times.
+
+        Only the last state is kept in memory, and it is propagated from
+        one time to the next.
+
+        Parameters
+        ----------
+        vectors : 1D or 2D array
+            The state at time 0, or the states stacked as columns.
+        times : sequence of floats
+
+        Yields
+        ------
+        array of the same shape as ``vectors``
+            The states at each of the ``times``.
+        """
+        previous_time = 0
+        for time in times:
+            vectors = self(vectors, time - previous_time)
+            previous_time = time
+            yield vectors
+
+    def expectation_values(self, operator, vectors, times):
+        """Return the expectation values of an operator along the
+        trajectory.
+
+        Parameters
+        ----------
+        operator : operator, dense matrix, or sparse matrix
+            If it is callable, the result of ``operator(bra, ket)`` is
+            returned, otherwise it must have a ``dot`` method. Operators
+            from `kwant.operator` are bound to ``params``.
+        vectors : 1D or 2D array
+            The state at time 0, or the states stacked as columns.
+        times : sequence of floats
+
+        Returns
+        -------
+        array
+            The expectation values, with the times along the first axis
+            and, if ``vectors`` is 2D, the states along the second.
+        """
+        if isinstance(operator, _LocalOperator):
+            operator = operator.bind(params=self.params)
+        elif not callable(operator):
+            if not hasattr(operator, 'dot'):
+                raise ValueError('Parameter `operator` has no `.dot` '
+                                 'attribute and is not callable.')
+            operator = functools.partial(_matrix_element, operator)
+
+        vectors = np.asarray(vectors, dtype=complex)
+        values = []
+        for state in self.trajectory(vectors, times):
+            if state.ndim == 1:
+                values.append(operator(state, state))
             else:
-                for n in range(m_start, n_moments):
-                    alpha_save = alpha_next
-                    alpha_next = (2 * self.hamiltonian.matvec(alpha_next)
-                                  - alpha)
-                    alpha = alpha_save
-                    one_moment[n] = self.operator(alpha_zero, alpha_next)
+                values.append(_operator_columns(operator, state, state))
+        return np.array(values)
 
-            self._last_two_alphas[r] = (alpha, alpha_next)
-            self._moments_list[r] = one_moment[:]
+    def _expansion_coefficients(self, time):
+        """Return the Chebyshev coefficients of the evolution operator
+        for a time step."""
+        try:
+            return self._coefficients[time]
+        except KeyError:
+            pass
+        z = self._a * time
+        # The Bessel functions decay faster than exponentially for orders
+        # larger than |z|.
+        orders = np.arange(int(abs(z)) + 20)
+        bessel = scipy.special.jv(orders, z)
+        while abs(bessel[-1]) > self.tol / 2:
+            orders = np.arange(len(orders) + 20)
+            bessel = scipy.special.jv(orders, z)
+        n_moments = np.nonzero(np.abs(bessel) > self.tol / 2)[0][-1] + 1
+        coefs = 2 * (-1j)**orders[:n_moments] * bessel[:n_moments]
+        coefs[0] /= 2
+        coefs *= np.exp(-1j * self._b * time)
+        self._coefficients[time] = coefs
+        return coefs
+
+
+class ProbingVectors:
+    """Factory of probing vectors for the stochastic evaluation of traces.
+
+    The sites of the system are colored such that sites closer than
+    ``distance`` hoppings have different colors. For every color and
+    orbital, there is a vector that is nonzero only on this orbital of the
+    sites of this color. The error of the trace of an operator estimated
+    with these vectors only comes from its matrix elements between sites
+    of the same color, which are farther apart than ``distance`` hoppings.
+    In particular, the traces of the powers of the Hamiltonian up to
+    ``distance`` are exact. For local Hamiltonians, this typically
+    needs much fewer vectors than random vectors for the same accuracy,
+    provided that ``distance`` is not much smaller than the number of
+    Chebyshev moments.
+
+    An instance can be passed as the ``vector_factory`` of
+    `~kwant.kpm.SpectralDensity` or `~kwant.kpm.Conductivity`. The vectors
+    are generated cyclically, and ``num_vectors`` should be a multiple of
+    the attribute ``num_vectors`` of this factory.
+
+    Parameters
+    ----------
+    syst : `~kwant.system.FiniteSystem`
+        The system, with the number of orbitals of its sites defined.
+    distance : positive int, default: 1
+        Minimal distance, in hoppings, between sites of the same color.
+    random_phases : bool, default: False
+        If True, the nonzero elements of the vectors have random phases,
+        which are generated anew in every cycle, otherwise they are 1.
+    rng : seed, or random number generator, optional
+        Random number generator used for the random phases.
+
+    Attributes
+    ----------
+    num_vectors : int
+        The number of probing vectors in a cycle.
+    colors : array of int
+        The color of every site of the system.
+    """
+
+    def __init__(self, syst, distance=1, *, random_phases=False, rng=None):
+        if distance <= 0 or distance != int(distance):
+            raise ValueError('distance must be a positive integer')
+        norbs = _site_norbs(syst)
+        self.colors = _distance_coloring(syst.graph, distance)
+        self.random_phases = random_phases
+        self._rng = ensure_rng(rng)
+
+        # Orbitals of every color and orbital index.
+        orbital_colors = np.repeat(self.colors, norbs)
+        orbital_indices = (np.arange(np.sum(norbs))
+                           - np.repeat(np.cumsum(norbs) - norbs, norbs))
+        groups = orbital_colors * np.max(norbs, initial=0) + orbital_indices
+        order = np.argsort(groups, kind='stable')
+        boundaries = np.nonzero(np.diff(groups[order]))[0] + 1
+        self._groups = np.split(order, boundaries)
+        self.num_vectors = len(self._groups)
+        self._tot_norbs = len(groups)
+        self._count = 0
+
+    def __call__(self, n):
+        """Return the next probing vector of length ``n``."""
+        if n != self._tot_norbs:
+            raise ValueError('The probing vectors have length {}, not {}.'
+                             .format(self._tot_norbs, n))
+        group = self._groups[self._count % self.num_vectors]
+        self._count += 1
+        vector = np.zeros(n, complex)
+        if self.random_phases:
+            vector[group] = _random_phases(self._rng, len(group))
+        else:
+            vector[group] = 1
+        # The traces are averages over the vectors, so the vectors are
+        # normalized such that the average over a cycle is the trace.
+        vector *= np.sqrt(self.num_vectors)
+        return vector
+
+
+def fermi_distribution(energy, mu, temperature):
+    """Return the Fermi-Dirac distribution.
+
+    Parameters
+    ----------
+    energy : float or array of floats
+    mu : float or array of floats
+        Chemical potential.
+    temperature : float or array of floats
+        Temperature, in units of energy.
+
+    Returns
+    -------
+    float, or array of floats with the shape of the parameters broadcast
+    together. At zero temperature, it is a step function, with value
+    1/2 at ``energy == mu``.
+    """
+    energy, mu, temperature = np.broadcast_arrays(energy, mu, temperature)
+    if np.any(temperature < 0):
+        raise ValueError('temperature must be non-negative')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # At zero temperature this is infinite, or nan if energy == mu.
+        x = (energy - mu) / temperature
+    return np.where(np.isnan(x), 0.5, scipy.special.expit(-x))[()]
 
 
 # ### Auxiliary functions
 
+# Types of the vectors and the Hamiltonian supported by SpectralDensity.
+_kpm_dtypes = tuple(map(np.dtype, (np.complex128, np.complex64,
+                                   np.float64, np.float32)))
+
+
+def _block_moments(hamiltonian, operator, alpha_zero, n_moments,
+                   last_two_alphas=None, moments=None):
+    """Calculate the Chebyshev moments of a block of random vectors.
+
+    Parameters
+    ----------
+    hamiltonian : sparse matrix
+        The rescaled Hamiltonian.
+    operator : callable or None
+        The operator ``operator(bra, ket)``. If None, the moments of the
+        density of states are calculated.
+    alpha_zero : 2D array
+        The random vectors, stacked as columns.
+    n_moments : integer
+        Number of Chebyshev moments.
+    last_two_alphas : pair of 2D arrays, optional
+        The last two vectors of the Chebyshev recursion of a previous
+        calculation with fewer moments, which is continued.
+    moments : sequence, optional
+        The moments of the previous calculation, with the moments along the
+        first axis and the random vectors along the second.
+
+    Returns
+    -------
+    moments : array
+        The moments, with the random vectors along the first axis and the
+        moments along the second.
+    last_two_alphas : pair of 2D arrays
+        The last two vectors of the Chebyshev recursion.
+    """
+    one_moment = [0.] * n_moments
+    if operator is not None:
+        # The bra of all the moments is the same random vector, so the
+        # operator is applied to it only once.
+        expectation = _bra_expectation(operator, alpha_zero)
+    if moments is None:
+        m_start = 2
+        alpha = alpha_zero
+        alpha_next = hamiltonian.dot(alpha)
+        if operator is None:
+            one_moment[0] = _vdot_columns(alpha_zero, alpha_zero)
+            one_moment[1] = _vdot_columns(alpha_zero, alpha_next)
+        else:
+            one_moment[0] = expectation(alpha_zero)
+            one_moment[1] = expectation(alpha_next)
+    else:
+        m_start = len(moments)
+        alpha, alpha_next = last_two_alphas
+        one_moment[0:m_start] = moments
+
+    # Iteration over the moments
+    # Two cases can occur, depicted in Eq. (28) and in Eq. (29),
+    # respectively.
+    # ----
+    # In the first case, operator is None and we can use
+    # Eqs. (34) and (35) to obtain the density of states, with
+    # two moments ``one_moment`` for every new alpha.
+    # ----
+    # In the second case, the operator is not None and a matrix
+    # multiplication should be used.
+    # ----
+    # The rescaled Hamiltonian is a sparse matrix, such that the
+    # recursion alpha_next = 2 * H @ alpha_next - alpha is done with
+    # a single sparse product and in-place updates.
+    if operator is None:
+        for n in range(m_start//2, n_moments//2):
+            alpha_save = alpha_next
+            alpha_next = hamiltonian.dot(alpha_next)
+            alpha_next *= 2
+            alpha_next -= alpha
+            alpha = alpha_save
+            # Following Eqs. (34) and (35)
+            one_moment[2*n] = (2 * _vdot_columns(alpha, alpha)
+                               - one_moment[0])
+            one_moment[2*n+1] = (2 * _vdot_columns(alpha_next, alpha)
+                                 - one_moment[1])
+        if n_moments % 2:
+            # odd moment
+            one_moment[n_moments - 1] = (
+                2 * _vdot_columns(alpha_next, alpha_next) - one_moment[0])
+    else:
+        for n in range(m_start, n_moments):
+            alpha_save = alpha_next
+            alpha_next = hamiltonian.dot(alpha_next)
+            alpha_next *= 2
+            alpha_next -= alpha
+            alpha = alpha_save
+            one_moment[n] = expectation(alpha_next)
+
+    return np.swapaxes(one_moment, 0, 1), (alpha, alpha_next)
+
+
+def _operator_columns(operator, bra, ket):
+    """Apply the operator to the pairs of columns of 'bra' and 'ket'."""
+    if isinstance(operator, _LocalOperator):
+        return operator(bra.T, ket.T)
+    return np.array([operator(bra[:, i], ket[:, i])
+                     for i in range(bra.shape[1])])
+
+
+def _bra_expectation(operator, bra):
+    """Return a function that evaluates the operator between the columns
+    of 'bra' and the columns of a block of kets.
+
+    When possible, the operator is applied to the bras once, so that
+    evaluating the function only requires inner products of the columns,
+    or sums over the orbitals of each site for densities with
+    ``sum=False``.  Otherwise, the operator is called for every column.
+    """
+    if isinstance(operator, functools.partial) and (
+            operator.func is _matrix_element):
+        matrix, = operator.args
+        # <bra| M |ket> = <M^† bra|ket>
+        acted_bra = matrix.conj().T.dot(bra).conj()
+        return functools.partial(_inner_columns, acted_bra)
+
+    if not (isinstance(operator, _LocalOperator)
+            and operator.check_hermiticity):
+        return functools.partial(_operator_columns, operator, bra)
+
+    # The operator is Hermitian, so acting on the bras is the same as
+    # acting with its Hermitian conjugate.
+    if operator.sum:
+        acted_bra = _act_columns(operator, bra).conj()
+        return functools.partial(_inner_columns, acted_bra)
+
+    where = np.asarray(operator.where)[:, 0]
+    if (not isinstance(operator, Density)
+            or len(np.unique(where)) != len(where)):
+        return functools.partial(_operator_columns, operator, bra)
+
+    # Matrix that sums the orbitals of each site in 'where'.
+    offsets, norbs = _get_all_orbs(operator.where, operator._site_ranges)
+    offsets, norbs = offsets[:, 0], norbs[:, 0]
+    rows = np.repeat(np.arange(len(where)), norbs)
+    # position of every orbital among the orbitals of its site
+    orbs = np.arange(len(rows)) - np.repeat(np.cumsum(norbs) - norbs, norbs)
+    cols = np.repeat(offsets, norbs) + orbs
+    site_sum = scipy.sparse.csr_matrix((np.ones(len(rows)), (rows, cols)),
+                                       shape=(len(where), bra.shape[0]))
+
+    acted_bra = _act_columns(operator, bra).conj()
+    return functools.partial(_sum_sites, site_sum, acted_bra)
+
+
+def _act_columns(operator, vectors):
+    """Act with the operator on the columns of 'vectors'."""
+    return operator.act(vectors.T).T
+
+
+def _sum_sites(site_sum, a, b):
+    """Return the sums over the orbitals of each site of the product of
+    'a' and 'b', with the columns along the first axis."""
+    return site_sum.dot(a * b).T
+
+
+def _inner_columns(a, b):
+    """Return the sums over the rows of the product of 'a' and 'b'.
+
+    The inner products of the columns of two matrices are obtained by
+    passing the complex conjugate of the first one as 'a'.
+    """
+    if a.shape[1] == 1:
+        # See '_vdot_columns'.
+        a = np.broadcast_to(a, (a.shape[0], 2))
+        b = np.broadcast_to(b, (b.shape[0], 2))
+        return _inner_columns(a, b)[:1]
+    return np.einsum('ij,ij->j', a, b)
+
+
+def _random_phases(rng, n):
+    return np.exp(2j * np.pi * rng.random_sample(n))
+
+
+def _random_signs(rng, n):
+    return 2. * rng.randint(2, size=n) - 1
+
+
+def _matrix_element(matrix, bra, ket):
+    return np.vdot(bra, matrix.dot(ket))
+
+
+# State of the worker processes of '_process_pool'.
+_worker = {}
+
+
+@contextmanager
+def _process_pool(n_jobs, hamiltonian, operator):
+    """Start a pool of processes that calculate Chebyshev moments.
+
+    The Hamiltonian is shared with the workers through shared memory if
+    available, otherwise it is sent to each worker once.
+    """
+    shared = []
+    try:
+        if shared_memory is None:  # skip coverage
+            matrix = hamiltonian
+        else:
+            matrix = [hamiltonian.shape]
+            for array in (hamiltonian.data, hamiltonian.indices,
+                          hamiltonian.indptr):
+                shm = shared_memory.SharedMemory(create=True,
+                                                 size=max(array.nbytes, 1))
+                shared.append(shm)
+                np.ndarray(array.shape, array.dtype, shm.buf)[...] = array
+                matrix.append((shm.name, array.shape, array.dtype.str))
+        with multiprocessing.Pool(n_jobs, _init_worker,
+                                  (matrix, operator)) as pool:
+            yield pool
+    finally:
+        for shm in shared:
+            shm.close()
+            shm.unlink()
+
+
+def _init_worker(matrix, operator):
+    if isinstance(matrix, list):
+        shape, *arrays = matrix
+        shared = [shared_memory.SharedMemory(name=name)
+                  for name, _, _ in arrays]
+        data, indices, indptr = (
+            np.ndarray(array_shape, dtype, shm.buf)
+            for shm, (_, array_shape, dtype) in zip(shared, arrays))
+        matrix = scipy.sparse.csr_matrix((data, indices, indptr),
+                                         shape=shape, copy=False)
+        # Keep the shared memory open while the worker is alive.
+        _worker['shared'] = shared
+    _worker['hamiltonian'] = matrix
+    _worker['operator'] = operator
+
+
+def _block_moments_in_worker(*args):
+    return _block_moments(_worker['hamiltonian'], _worker['operator'], *args)
+
+
+def _site_norbs(syst):
+    """Return the number of orbitals of every site of a finite system."""
+    if syst.site_ranges is None:
+        raise ValueError('Number of orbitals not defined.\n'
+                         'Declare the number of orbitals using the '
+                         '`norbs` keyword argument when constructing '
+                         'the site families (lattices).')
+    site_ranges = np.asarray(syst.site_ranges)
+    return np.repeat(site_ranges[:-1, 1], np.diff(site_ranges[:, 0]))
+
+
+def _orbital_positions(syst):
+    """Return the positions of the orbitals of a finite system."""
+    norbs = _site_norbs(syst)
+    positions = np.array([syst.pos(i) for i in range(len(norbs))])
+    return np.repeat(positions.reshape(len(norbs), -1), norbs, axis=0)
+
+
+def _velocity(hamiltonian, direction, positions):
+    """Return the velocity operator ``i[H, x]`` along a direction.
+
+    If 'direction' is not a string, it is taken to be the velocity
+    operator itself.
+    """
+    if not isinstance(direction, str):
+        return scipy.sparse.csr_matrix(direction, dtype=complex)
+    try:
+        index = 'xyz'.index(direction)
+    except ValueError:
+        raise ValueError("The direction must be 'x', 'y' or 'z', or a "
+                         "velocity operator.")
+    positions = np.asarray(positions, dtype=float)
+    if positions.ndim == 1:
+        positions = positions[:, np.newaxis]
+    if positions.shape[0] != hamiltonian.shape[0]:
+        raise ValueError("'positions' must have one row per orbital.")
+    if index >= positions.shape[1]:
+        raise ValueError("The direction '{}' does not exist in a system of "
+                         "dimension {}.".format(direction, positions.shape[1]))
+    coords = positions[:, index]
+    hamiltonian = hamiltonian.tocoo()
+    displacements = coords[hamiltonian.col] - coords[hamiltonian.row]
+    return scipy.sparse.csr_matrix(
+        (1j * displacements * hamiltonian.data,
+         (hamiltonian.row, hamiltonian.col)), shape=hamiltonian.shape)
+
+
+def _chebyshev_vectors(hamiltonian, alpha_zero, n_moments):
+    """Yield the vectors ``T_n(H) alpha_zero`` for ``n < n_moments``."""
+    alpha = alpha_zero
+    yield alpha
+    if n_moments == 1:
+        return
+    alpha_next = hamiltonian.dot(alpha)
+    yield alpha_next
+    for n in range(2, n_moments):
+        alpha_save = alpha_next
+        alpha_next = hamiltonian.dot(alpha_next)
+        alpha_next *= 2
+        alpha_next -= alpha
+        alpha = alpha_save
+        yield alpha_next
+
+
+def _correlation_moments(hamiltonian, velocities, alpha_zero, n_moments):
+    """Calculate the two-dimensional Chebyshev moments of the velocity
+    correlations of a block of random vectors.
+
+    Returns the sum over the random vectors ``r`` (the columns of
+    'alpha_zero') of ``<r|v_α T_m(H) v_β T_n(H)|r>``, as an array with
+    ``m`` along the first axis and ``n`` along the second.
+    """
+    v_alpha, v_beta = velocities
+    n_vectors = alpha_zero.shape[1]
+    # The bras <r|v_α T_m(H), stored as the rows of a matrix for every
+    # random vector.
+    bras = np.empty((n_vectors, n_moments, alpha_zero.shape[0]), complex)
+    vectors = _chebyshev_vectors(hamiltonian, v_alpha.dot(alpha_zero),
+                                 n_moments)
+    for m, alpha in enumerate(vectors):
+        bras[:, m] = alpha.T.conj()
+
+    moments = np.empty((n_moments, n_moments), complex)
+    vectors = _chebyshev_vectors(hamiltonian, alpha_zero, n_moments)
+    for n, alpha in enumerate(vectors):
+        kets = v_beta.dot(alpha).T[:, :, np.newaxis]
+        moments[:, n] = np.sum(np.matmul(bras, kets), axis=0)[:, 0]
+    return moments
+
+
+def _correlation_moments_in_worker(*args):
+    return _correlation_moments(_worker['hamiltonian'], _worker['operator'],
+                                *args)
+
+
+def _kubo_bastin_weights(moments, a, b, n_sampling):
+    """Return the energies and weights of the integral over the energy of
+    the Kubo-Bastin formula.
+
+    The conductivity is the sum of the weights times the occupations of
+    the energies, which are sampled at the abscissas of Chebyshev
+    integration.
+    """
+    n_moments = len(moments)
+    factors = _jackson_kernel(n_moments)
+    factors[0] /= 2
+    moments = factors[:, np.newaxis] * moments * factors
+
+    k = np.arange(n_sampling)
+    theta = np.pi * (k + 0.5) / n_sampling
+    e, sin = np.cos(theta), np.sin(theta)
+    m = np.arange(n_moments)
+    chebyshev = np.cos(np.outer(theta, m))
+    gamma = ((e[:, np.newaxis] + 1j * m * sin[:, np.newaxis])
+             * np.exp(-1j * np.outer(theta, m)))
+    integrand = (np.sum(chebyshev.dot(moments) * gamma, axis=1) +
+                 np.sum(gamma.conj().dot(moments) * chebyshev, axis=1))
+    # Gauss-Chebyshev integration, with the factor sin(θ) of dε, and
+    # 1 / (1 - ε^2)^2 from the Kubo-Bastin formula.
+    weights = 8 * np.pi / (a**2 * n_sampling) * integrand.real / sin**3
+
+    # Reverse energies and weights to set ascending order.
+    return (e * a + b)[::-1], weights[::-1]
+
+
+def _vdot_columns(a, b):
+    """Return the real part of the inner products of the columns of 'a'
+    and 'b'.
+
+    Only the real part is needed for the moments of the density of states,
+    since the Hamiltonian is Hermitian.  Computing it from the real and
+    imaginary parts avoids allocating temporary arrays.
+    """
+    if a.shape[1] == 1:
+        # NumPy sums single columns in a different order, which would make
+        # the results depend on the size of the blocks of vectors.
+        a = np.broadcast_to(a, (a.shape[0], 2))
+        b = np.broadcast_to(b, (b.shape[0], 2))
+        return _vdot_columns(a, b)[:1]
+    if np.iscomplexobj(a) and np.iscomplexobj(b):
+        return (_sum_products(a.real, b.real) +
+                _sum_products(a.imag, b.imag))
+    return _sum_products(a.real, b.real)
+
+
+def _sum_products(a, b, chunk=64):
+    """Return the sums over the rows of the product of real 'a' and 'b'.
+
+    Single precision products are summed in chunks of rows, and the sums
+    of the chunks are accumulated in double precision. This is as fast as
+    summing in single precision, and almost as accurate as summing in
+    double precision.
+    """
+    if a.dtype != np.float32 and b.dtype != np.float32:
+        return np.einsum('ij,ij->j', a, b)
+    n = a.shape[0] - a.shape[0] % chunk
+    chunk_sums = np.einsum('kij,kij->kj',
+                           a[:n].reshape(-1, chunk, a.shape[1]),
+                           b[:n].reshape(-1, chunk, b.shape[1]))
+    return (np.sum(chunk_sums, axis=0, dtype=float) +
+            np.einsum('ij,ij->j', a[n:], b[n:], dtype=float))
+
 
 def _rescale(hamiltonian, eps, v0, bounds):
-    """Rescale a Hamiltonian and return a LinearOperator
+    """Rescale a Hamiltonian and return it as a sparse matrix
 
     Parameters
     ----------
@@ -465,24 +1452,22 @@ def _rescale(hamiltonian, eps, v0, bounds):
     eps : scalar
         Ensures that the bounds 'a' and 'b' are strict.
     v0 : random vector, or None
-        Used as the initial residual vector for the algorithm that
+        Used as the initial vector for the algorithm that
         finds the lowest and highest eigenvalues.
     bounds : tuple, or None
         Boundaries of the spectrum. If not provided the maximum and
-        minimum eigenvalues are calculated.
+        minimum eigenvalues are estimated.
     """
     # Relative tolerance to which to calculate eigenvalues.  Because after
     # rescaling we will add eps / 2 to the spectral bounds, we don't need
     # to know the bounds more accurately than eps / 2.
     tol = eps / 2
+    hamiltonian = scipy.sparse.csr_matrix(hamiltonian)
 
     if bounds:
         lmin, lmax = bounds
     else:
-        lmax = float(sla.eigsh(hamiltonian, k=1, which='LA',
-                               return_eigenvectors=False, tol=tol, v0=v0))
-        lmin = float(sla.eigsh(hamiltonian, k=1, which='SA',
-                               return_eigenvectors=False, tol=tol, v0=v0))
+        lmin, lmax = _spectral_bounds(hamiltonian, tol, v0)
 
     a = np.abs(lmax-lmin) / (2. - eps)
     b = (lmax+lmin) / 2.
@@ -492,14 +1477,132 @@ def _rescale(hamiltonian, eps, v0, bounds):
             'The Hamiltonian has a single eigenvalue, it is not possible to '
             'obtain a spectral density.')
 
-    def rescaled(v):
-        return (hamiltonian.dot(v) - b * v) / a
-
-    rescaled_ham = sla.LinearOperator(shape=hamiltonian.shape, matvec=rescaled)
+    # Rescaling the matrix once is cheaper than rescaling the vectors
+    # at every step of the Chebyshev recursion.
+    identity = scipy.sparse.identity(hamiltonian.shape[0], format='csr')
+    rescaled_ham = (hamiltonian - b * identity) / a
 
     return rescaled_ham, (a, b)
 
 
+# Spectral bounds of the most recently used Hamiltonians, indexed by
+# '_fingerprint' and the tolerance.
+_bounds_cache = collections.OrderedDict()
+_bounds_cache_size = 16
+
+
+def _spectral_bounds(hamiltonian, tol, v0=None):
+    """Return estimates of the lowest and highest eigenvalues of a sparse
+    Hermitian matrix.
+
+    The bounds are obtained from a single Lanczos run, and are accurate
+    up to 'tol' times half the width of the spectrum. If the Lanczos run
+    does not converge, the bounds are obtained from the Gershgorin disks.
+    The bounds are cached, so that they are only calculated once for
+    the same Hamiltonian.
+    """
+    key = (_fingerprint(hamiltonian), tol)
+    try:
+        _bounds_cache.move_to_end(key)
+        return _bounds_cache[key]
+    except KeyError:
+        pass
+
+    # The Gershgorin bounds are strict, so they can only improve the
+    # Lanczos estimates.
+    gershgorin = _gershgorin_bounds(hamiltonian)
+    lanczos = _lanczos_bounds(hamiltonian, tol, v0)
+    if lanczos is None:
+        bounds = gershgorin
+    else:
+        bounds = (max(lanczos[0], gershgorin[0]),
+                  min(lanczos[1], gershgorin[1]))
+
+    _bounds_cache[key] = bounds
+    if len(_bounds_cache) > _bounds_cache_size:
+        _bounds_cache.popitem(last=False)
+    return bounds
+
+
+def _fingerprint(matrix):
+    """Return a hash of the content of a sparse matrix."""
+    if not matrix.has_canonical_format:
+        matrix = matrix.copy()
+        matrix.sum_duplicates()
+    digest = hashlib.sha1(repr((matrix.shape, matrix.dtype.str)).encode())
+    for array in (matrix.data, matrix.indices, matrix.indptr):
+        digest.update(np.ascontiguousarray(array).view(np.uint8))
+    return digest.hexdigest()
+
+
+def _gershgorin_bounds(hamiltonian):
+    """Return the bounds of the spectrum from the Gershgorin disks."""
+    diagonal = hamiltonian.diagonal().real
+    radii = np.asarray(abs(hamiltonian).sum(axis=1)).ravel()
+    radii -= np.abs(diagonal)
+    return float(np.min(diagonal - radii)), float(np.max(diagonal + radii))
+
+
+def _lanczos_bounds(hamiltonian, tol, v0=None, max_steps=1000):
+    """Estimate the bounds of the spectrum with the Lanczos algorithm.
+
+    Both ends of the spectrum are obtained from the same run. The extreme
+    Ritz values are extended by their residuals, and the run stops when
+    these are smaller than 'tol' times half the width of the spectrum.
+    Returns None if this does not happen within 'max_steps' steps.
+    """
+    dim = hamiltonian.shape[0]
+    if v0 is None:
+        v0 = np.exp(2j * np.pi * np.random.random_sample(dim))
+    v = np.asarray(v0, dtype=complex) / npl.norm(v0)
+    v_prev = np.zeros_like(v)
+    alphas, betas = [], []
+    # 'scale' is a lower bound for the norm of the Hamiltonian.
+    beta = scale = 0
+    for step in range(1, min(max_steps, dim) + 1):
+        w = hamiltonian.dot(v)
+        alpha = np.vdot(v, w).real
+        w -= alpha * v
+        w -= beta * v_prev
+        scale = max(scale, abs(alpha), beta)
+        beta = npl.norm(w)
+        alphas.append(alpha)
+        # The Krylov space is invariant, or is the full space.
+        exhausted = beta <= 1e-12 * scale or step == dim
+        if exhausted or step % 10 == 0:
+            (lmin, lmax), last_components = _extreme_ritz(alphas, betas)
+            if exhausted:
+                return lmin, lmax
+            residuals = beta * np.abs(last_components)
+            if max(residuals) <= tol * (lmax - lmin) / 2:
+                return lmin - residuals[0], lmax + residuals[1]
+        betas.append(beta)
+        v_prev, v = v, w / beta
+    return None
+
+
+def _extreme_ritz(alphas, betas):
+    """Return the extreme eigenvalues of a tridiagonal matrix, and the
+    last components of the corresponding eigenvectors."""
+    if len(alphas) == 1:
+        return (alphas[0], alphas[0]), (1, 1)
+    values, components = [], []
+    for index in (0, len(alphas) - 1):
+        value, vector = scipy.linalg.eigh_tridiagonal(
+            alphas, betas, select='i', select_range=(index, index))
+        values.append(value[0])
+        components.append(vector[-1, 0])
+    return values, components
+
+
+def _jackson_kernel(n_moments):
+    """Return the Jackson kernel, as in Eq. (71)."""
+    m = np.arange(n_moments)
+    return ((n_moments - m + 1) * np.cos(np.pi * m / (n_moments + 1)) +
+            np.sin(np.pi * m / (n_moments + 1)) /
+            np.tan(np.pi / (n_moments + 1))) / (n_moments + 1)
+
+
 def _calc_fft_moments(moments, n_sampling):
     """This function takes the normalised moments and returns an array
     of points and an array of the evaluated function at those points.
@@ -509,12 +1612,8 @@ def _calc_fft_moments(moments, n_sampling):
     n_moments, *extra_shape = moments.shape
     moments_ext = np.zeros([n_sampling] + extra_shape)
 
-    # Jackson kernel, as in Eq. (71), and kernel improved moments,
-    # as in Eq. (81).
-    m = np.arange(n_moments)
-    kernel = ((n_moments - m + 1) * np.cos(np.pi * m / (n_moments + 1)) +
-              np.sin(np.pi * m / (n_moments + 1)) /
-              np.tan(np.pi / (n_moments + 1))) / (n_moments + 1)
+    # Kernel improved moments, as in Eq. (81).
+    kernel = _jackson_kernel(n_moments)
 
     # special points at the abscissas of Chebyshev integration
     k = np.arange(0, n_sampling)
@@ -15,7 +15,7 @@ import numpy as np
 from . import lapack
 
 
-def schur(a, calc_q=True, calc_ev=True, overwrite_a=False):
+def schur(a, calc_q=True, calc_ev=True, overwrite_a=False, workspace=None):
     """Compute the Schur form of a square matrix a.
 
     The Schur form is a decomposition of the form a = q * t * q^dagger, where q
@@ -39,6 +39,8 @@ def schur(a, calc_q=True, calc_ev=True, overwrite_a=False):
         Whether to return the eigenvalues as a separate array.
     overwrite_a : boolean
         Whether to overwrite data in `a` (may increase performance).
+    workspace : `~kwant.linalg.lapack.Workspace`, optional
+        Work arrays to be reused between calls.  Default: None
 
     Returns
     -------
@@ -63,7 +65,7 @@ def schur(a, calc_q=True, calc_ev=True, overwrite_a=False):
         If the underlying QR iteration fails to converge.
     """
     a = lapack.prepare_for_lapack(overwrite_a, a)
-    return lapack.gees(a, calc_q, calc_ev)
+    return lapack.gees(a, calc_q, calc_ev, workspace)
 
 
 def convert_r2c_schur(t, q):
@@ -135,7 +137,8 @@ def convert_r2c_schur(t, q):
     return t2, q2
 
 
-def order_schur(select, t, q, calc_ev=True, overwrite_tq=False):
+def order_schur(select, t, q, calc_ev=True, overwrite_tq=False,
+                workspace=None):
     """Reorder the Schur form, selecting a cluster of eigenvalues.
 
     This function reorders the generalized Schur form such that the cluster of
@@ -162,6 +165,8 @@ def order_schur(select, t, q, calc_ev=True, overwrite_tq=False):
     overwrite_tq : boolean, optional
         Whether to overwrite data in `t` and `q` (may increase performance)
         Default: False
+    workspace : `~kwant.linalg.lapack.Workspace`, optional
+        Work arrays to be reused between calls.  Default: None
 
     Returns
     -------
@@ -209,13 +214,13 @@ def order_schur(select, t, q, calc_ev=True, overwrite_tq=False):
     for i in np.diagonal(t, -1).nonzero()[0]:
         if bool(select[i]) != bool(select[i+1]):
             t, q = convert_r2c_schur(t, q)
-            return order_schur(select, t, q, calc_ev, True)
+            return order_schur(select, t, q, calc_ev, True, workspace)
 
-    return lapack.trsen(select, t, q, calc_ev)
+    return lapack.trsen(select, t, q, calc_ev, workspace)
 
 
 def evecs_from_schur(t, q, select=None, left=False, right=True,
-                     overwrite_tq=False):
+                     overwrite_tq=False, workspace=None):
     """Compute eigenvectors from Schur form.
 
     This function computes either all or selected eigenvectors for the matrix
@@ -240,6 +245,8 @@ def evecs_from_schur(t, q, select=None, left=False, right=True,
     overwrite_tq : boolean, optional
         Whether to overwrite data in `t` and `q` (may increase performance)
         Default: False
+    workspace : `~kwant.linalg.lapack.Workspace`, optional
+        Work arrays to be reused between calls.  Default: None
 
     Returns
     -------
@@ -255,7 +262,9 @@ def evecs_from_schur(t, q, select=None, left=False, right=True,
         ``right == True``.
     """
 
-    t, q = lapack.prepare_for_lapack(overwrite_tq, t, q)
+    # Neither `t` nor `q` are modified by trevc, hence they are only copied
+    # if a conversion is necessary.
+    t, q = lapack.prepare_for_lapack(True, t, q)
 
     # check if select is a function or an array
     if select is not None:
@@ -282,11 +291,11 @@ def evecs_from_schur(t, q, select=None, left=False, right=True,
     else:
         selectarr = None
 
-    return lapack.trevc(t, q, selectarr, left, right)
+    return lapack.trevc(t, q, selectarr, left, right, workspace)
 
 
 def gen_schur(a, b, calc_q=True, calc_z=True, calc_ev=True,
-              overwrite_ab=False):
+              overwrite_ab=False, workspace=None):
     """Compute the generalized Schur form of a matrix pencil (a, b).
 
     The generalized Schur form is a decomposition of the form a = q * s *
@@ -320,6 +329,8 @@ def gen_schur(a, b, calc_q=True, calc_z=True, calc_ev=True,
     overwrite_ab : boolean, optional
         Whether to overwrite data in `a` and `b` (may increase performance)
         Default: False
+    workspace : `~kwant.linalg.lapack.Workspace`, optional
+        Work arrays to be reused between calls.  Default: None
 
     Returns
     -------
@@ -347,11 +358,11 @@ def gen_schur(a, b, calc_q=True, calc_z=True, calc_ev=True,
         If the underlying QZ iteration fails to converge.
     """
     a, b = lapack.prepare_for_lapack(overwrite_ab, a, b)
-    return lapack.gges(a, b, calc_q, calc_z, calc_ev)
+    return lapack.gges(a, b, calc_q, calc_z, calc_ev, workspace)
 
 
 def order_gen_schur(select, s, t, q=None, z=None, calc_ev=True,
-                    overwrite_stqz=False):
+                    overwrite_stqz=False, workspace=None):
     """Reorder the generalized Schur form.
 
     This function reorders the generalized Schur form such that the cluster of
@@ -381,6 +392,8 @@ def order_gen_schur(select, s, t, q=None, z=None, calc_ev=True,
     overwrite_stqz : boolean, optional
         Whether to overwrite data in `s`, `t`, `q`, and `z` (may
         increase performance) Default: False.
+    workspace : `~kwant.linalg.lapack.Workspace`, optional
+        Work arrays to be reused between calls.  Default: None
 
     Returns
     -------
@@ -445,9 +458,10 @@ def order_gen_schur(select, s, t, q=None, z=None, calc_ev=True,
             else:
                 s, t = convert_r2c_gen_schur(s, t)
 
-            return order_gen_schur(select, s, t, q, z, calc_ev, True)
+            return order_gen_schur(select, s, t, q, z, calc_ev, True,
+                                   workspace)
 
-    return lapack.tgsen(select, s, t, q, z, calc_ev)
+    return lapack.tgsen(select, s, t, q, z, calc_ev, workspace)
 
 
 def convert_r2c_gen_schur(s, t, q=None, z=None):
@@ -562,7 +576,8 @@ def convert_r2c_gen_schur(s, t, q=None, z=None):
 
 
 def evecs_from_gen_schur(s, t, q=None, z=None, select=None,
-                         left=False, right=True, overwrite_qz=False):
+                         left=False, right=True, overwrite_qz=False,
+                         workspace=None):
     """Compute eigenvectors from Schur form.
 
     This function computes either all or selected eigenvectors for the matrix
@@ -592,6 +607,8 @@ def evecs_from_gen_schur(s, t, q=None, z=None, select=None,
     overwrite_qz : boolean, optional
         Whether to overwrite data in `q` and `z` (may increase performance).
         Note that s and t remain always unchanged Default: False.
+    workspace : `~kwant.linalg.lapack.Workspace`, optional
+        Work arrays to be reused between calls.  Default: None
 
     Returns
     -------
@@ -611,7 +628,11 @@ def evecs_from_gen_schur(s, t, q=None, z=None, select=None,
 
     """
 
-    s, t, q, z = lapack.prepare_for_lapack(overwrite_qz, s, t, q, z)
+    # `s` and `t` are never modified by tgevc, and `q` and `z` only if all
+    # eigenvectors are computed.  Hence arrays are only copied if
+    # necessary.
+    s, t, q, z = lapack.prepare_for_lapack(overwrite_qz or select is not None,
+                                           s, t, q, z)
 
     if left and q is None:
         raise ValueError("Matrix q must be provided for left eigenvectors")
@@ -644,4 +665,4 @@ def evecs_from_gen_schur(s, t, q=None, z=None, select=None,
     else:
         selectarr = None
 
-    return lapack.tgevc(s, t, q, z, selectarr, left, right)
+    return lapack.tgevc(s, t, q, z, selectarr, left, right, workspace)
@@ -18,7 +18,8 @@ __all__ = ['getrf',
            'gges',
            'tgsen',
            'tgevc',
-           'prepare_for_lapack']
+           'prepare_for_lapack',
+           'Workspace']
 
 import numpy as np
 cimport numpy as np
@@ -75,6 +76,36 @@ def assert_fortran_mat(*mats):
             raise ValueError("Input matrix must be Fortran contiguous")
 
 
+class Workspace:
+    """Work arrays that are reused between calls to LAPACK routines.
+
+    The wrappers in this module allocate fresh work arrays for every call
+    unless an instance of this class is passed as their `workspace`
+    argument.  The same instance may then be passed to repeated calls, for
+    example when computing the Schur form of many matrices of the same size,
+    and the work arrays are only allocated once.
+
+    A workspace must not be used by several threads at the same time.
+    """
+    def __init__(self):
+        self._arrays = {}
+
+    def get(self, name, size, dtype):
+        """Return an uninitialized array with at least `size` elements."""
+        dtype = np.dtype(dtype)
+        arr = self._arrays.get((name, dtype))
+        if arr is None or arr.shape[0] < size:
+            arr = np.empty(size, dtype=dtype)
+            self._arrays[name, dtype] = arr
+        return arr
+
+
+def empty_work(workspace, name, size, dtype):
+    if workspace is None:
+        return np.empty(size, dtype=dtype)
+    return workspace.get(name, size, dtype)
+
+
 cdef np.ndarray maybe_complex(scalar selector,
                               np.ndarray real, np.ndarray imag):
     cdef np.ndarray r
@@ -413,7 +444,8 @@ def ggev(np.ndarray[scalar, ndim=2] A, np.ndarray[scalar, ndim=2] B,
     return filter_args((True, True, left, right), (alpha, beta, vl, vr))
 
 
-def gees(np.ndarray[scalar, ndim=2] A, calc_q=True, calc_ev=True):
+def gees(np.ndarray[scalar, ndim=2] A, calc_q=True, calc_ev=True,
+         workspace=None):
     cdef l_int N, lwork, sdim, info
 
     assert_fortran_mat(A)
@@ -438,9 +470,9 @@ def gees(np.ndarray[scalar, ndim=2] A, calc_q=True, calc_ev=True):
 
     cdef np.ndarray rwork
     if scalar is float_complex:
-        rwork = np.empty(N, dtype=np.float32)
+        rwork = empty_work(workspace, 'rwork', N, np.float32)
     elif scalar is double_complex:
-        rwork = np.empty(N, dtype=np.float64)
+        rwork = empty_work(workspace, 'rwork', N, np.float64)
 
     cdef char *jobvs
     cdef scalar *vs_ptr
@@ -479,7 +511,8 @@ def gees(np.ndarray[scalar, ndim=2] A, calc_q=True, calc_ev=True):
     assert info == 0, "Argument error in sgees"
 
     lwork = lwork_from_qwork(qwork)
-    cdef np.ndarray[scalar] work = np.empty(lwork, dtype=A.dtype)
+    cdef np.ndarray[scalar] work = empty_work(workspace, 'work', lwork,
+                                              A.dtype)
 
     # The actual calculation
 
@@ -516,7 +549,7 @@ def gees(np.ndarray[scalar, ndim=2] A, calc_q=True, calc_ev=True):
 def trsen(np.ndarray[l_logical] select,
           np.ndarray[scalar, ndim=2] T,
           np.ndarray[scalar, ndim=2] Q,
-          calc_ev=True):
+          calc_ev=True, workspace=None):
     cdef l_int N, M, lwork, liwork, qiwork, info
 
     assert_fortran_mat(T, Q)
@@ -571,12 +604,13 @@ def trsen(np.ndarray[l_logical] select,
     assert info == 0, "Argument error in trsen"
 
     lwork = lwork_from_qwork(qwork)
-    cdef np.ndarray[scalar] work = np.empty(lwork, dtype=T.dtype)
+    cdef np.ndarray[scalar] work = empty_work(workspace, 'work', lwork,
+                                              T.dtype)
 
     cdef np.ndarray[l_int] iwork = None
     if scalar in floating:
         liwork = qiwork
-        iwork = np.empty(liwork, dtype=int_dtype)
+        iwork = empty_work(workspace, 'iwork', liwork, int_dtype)
 
     # Tha actual calculation
 
@@ -656,7 +690,7 @@ def txevc_postprocess(dtype, T, vreal, np.ndarray[l_logical] select):
 def trevc(np.ndarray[scalar, ndim=2] T,
           np.ndarray[scalar, ndim=2] Q,
           np.ndarray[l_logical] select,
-          left=False, right=True):
+          left=False, right=True, workspace=None):
     cdef l_int N, info, M, MM
     cdef char *side
     cdef char *howmny
@@ -675,15 +709,15 @@ def trevc(np.ndarray[scalar, ndim=2] T,
 
     cdef np.ndarray[scalar] work
     if scalar in floating:
-        work = np.empty(4 * N, dtype=T.dtype)
+        work = empty_work(workspace, 'work', 4 * N, T.dtype)
     else:
-        work = np.empty(2 * N, dtype=T.dtype)
+        work = empty_work(workspace, 'work', 2 * N, T.dtype)
 
     cdef np.ndarray rwork = None
     if scalar is float_complex:
-        rwork = np.empty(N, dtype=np.float32)
+        rwork = empty_work(workspace, 'rwork', N, np.float32)
     elif scalar is double_complex:
-        rwork = np.empty(N, dtype=np.float64)
+        rwork = empty_work(workspace, 'rwork', N, np.float64)
 
     if left and right:
         side = "B"
@@ -801,7 +835,7 @@ def trevc(np.ndarray[scalar, ndim=2] T,
 
 def gges(np.ndarray[scalar, ndim=2] A,
           np.ndarray[scalar, ndim=2] B,
-          calc_q=True, calc_z=True, calc_ev=True):
+          calc_q=True, calc_z=True, calc_ev=True, workspace=None):
     cdef l_int N, sdim, info
 
     # Check parameters
@@ -830,9 +864,9 @@ def gges(np.ndarray[scalar, ndim=2] A,
 
     cdef np.ndarray rwork = None
     if scalar is float_complex:
-        rwork = np.empty(8 * N, dtype=np.float32)
+        rwork = empty_work(workspace, 'rwork', 8 * N, np.float32)
     elif scalar is double_complex:
-        rwork = np.empty(8 * N, dtype=np.float64)
+        rwork = empty_work(workspace, 'rwork', 8 * N, np.float64)
 
     cdef char *jobvsl
     cdef scalar *vsl_ptr
@@ -897,7 +931,8 @@ def gges(np.ndarray[scalar, ndim=2] A,
     assert info == 0, "Argument error in gges"
 
     lwork = lwork_from_qwork(qwork)
-    cdef np.ndarray[scalar] work = np.empty(lwork, dtype=A.dtype)
+    cdef np.ndarray[scalar] work = empty_work(workspace, 'work', lwork,
+                                              A.dtype)
 
     # The actual calculation
 
@@ -951,7 +986,7 @@ def tgsen(np.ndarray[l_logical] select,
            np.ndarray[scalar, ndim=2] T,
            np.ndarray[scalar, ndim=2] Q,
            np.ndarray[scalar, ndim=2] Z,
-           calc_ev=True):
+           calc_ev=True, workspace=None):
     cdef l_int ijob = 0
     cdef l_int N, M, lwork, liwork, info
 
@@ -1041,10 +1076,12 @@ def tgsen(np.ndarray[l_logical] select,
     assert info == 0, "Argument error in tgsen"
 
     lwork = lwork_from_qwork(qwork)
-    cdef np.ndarray[scalar] work = np.empty(lwork, dtype=S.dtype)
+    cdef np.ndarray[scalar] work = empty_work(workspace, 'work', lwork,
+                                              S.dtype)
 
     liwork = qiwork
-    cdef np.ndarray[l_int] iwork = np.empty(liwork, dtype=int_dtype)
+    cdef np.ndarray[l_int] iwork = empty_work(workspace, 'iwork', liwork,
+                                              int_dtype)
 
     # The actual calculation
 
@@ -1101,7 +1138,7 @@ def tgevc(np.ndarray[scalar, ndim=2] S,
           np.ndarray[scalar, ndim=2] Q,
           np.ndarray[scalar, ndim=2] Z,
           np.ndarray[l_logical] select,
-          left=False, right=True):
+          left=False, right=True, workspace=None):
     cdef l_int N, info, M, MM
 
     # Check parameters
@@ -1122,15 +1159,15 @@ def tgevc(np.ndarray[scalar, ndim=2] S,
 
     cdef np.ndarray[scalar] work
     if scalar in floating:
-        work = np.empty(6 * N, dtype=S.dtype)
+        work = empty_work(workspace, 'work', 6 * N, S.dtype)
     else:
-        work = np.empty(2 * N, dtype=S.dtype)
+        work = empty_work(workspace, 'work', 2 * N, S.dtype)
 
     cdef np.ndarray rwork = None
     if scalar is float_complex:
-        rwork = np.empty(2 * N, dtype=np.float32)
+        rwork = empty_work(workspace, 'rwork', 2 * N, np.float32)
     elif scalar is double_complex:
-        rwork = np.empty(2 * N, dtype=np.float64)
+        rwork = empty_work(workspace, 'rwork', 2 * N, np.float64)
 
     cdef char *side
     if left and right:
@@ -7,7 +7,7 @@
 # http://kwant-project.org/authors.
 
 from kwant.linalg import (
-    lu_factor, lu_solve, rcond_from_lu, gen_eig, schur,
+    lapack, lu_factor, lu_solve, rcond_from_lu, gen_eig, schur,
     convert_r2c_schur, order_schur, evecs_from_schur, gen_schur,
     convert_r2c_gen_schur, order_gen_schur, evecs_from_gen_schur)
 import numpy as np
@@ -356,3 +356,45 @@ def test_evecs_from_gen_schur():
     _test_evecs_from_gen_schur(np.complex128)
     #int should be propagated to float64
     _test_evecs_from_gen_schur(np.int32)
+
+
+def test_workspace():
+    def _test_workspace(dtype):
+        rand = _Random()
+        workspace = lapack.Workspace()
+        for i in range(2):
+            a = rand.randmat(5, 5, dtype)
+            b = rand.randmat(5, 5, dtype)
+            select = np.array([True, False, True, False, False])
+
+            s, t, q, z = gen_schur(a, b, workspace=workspace)[:4]
+            should_be = gen_schur(a, b)[:4]
+            for x, y in zip((s, t, q, z), should_be):
+                assert_array_almost_equal(dtype, x, y)
+            assert_array_almost_equal(
+                dtype, evecs_from_gen_schur(s, t, q, z, select,
+                                            workspace=workspace),
+                evecs_from_gen_schur(s, t, q, z, select))
+            assert_array_almost_equal(
+                dtype, order_gen_schur(select, s, t, q, z,
+                                       workspace=workspace)[0],
+                order_gen_schur(select, s, t, q, z)[0])
+
+            t, q = schur(a, calc_ev=False, workspace=workspace)
+            assert_array_almost_equal(dtype, t, schur(a, calc_ev=False)[0])
+            assert_array_almost_equal(
+                dtype, evecs_from_schur(t, q, select, workspace=workspace),
+                evecs_from_schur(t, q, select))
+            assert_array_almost_equal(
+                dtype, order_schur(select, t, q, workspace=workspace)[0],
+                order_schur(select, t, q)[0])
+
+        # The work arrays are allocated once and then reused.
+        work = workspace.get('work', 1, np.dtype(dtype))
+        schur(rand.randmat(5, 5, dtype), workspace=workspace)
+        assert workspace.get('work', 1, np.dtype(dtype)) is work
+
+    _test_workspace(np.float32)
+    _test_workspace(np.float64)
+    _test_workspace(np.complex64)
+    _test_workspace(np.complex128)
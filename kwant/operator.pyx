@@ -7,20 +7,24 @@
 # http://kwant-project.org/authors.
 """Tools for working with operators for acting on wavefunctions."""
 
-__all__ = ['Density', 'Current', 'Source']
+__all__ = ['Density', 'Current', 'Source', 'Composite']
 
 import cython
 from operator import itemgetter
 import functools as ft
+import itertools
 import collections
 
 import numpy as np
 import tinyarray as ta
-from scipy.sparse import coo_matrix
+from scipy.sparse import coo_matrix, csr_matrix
 
 from libc cimport math
+from libc.stdlib cimport malloc, free
+from cython.parallel cimport prange, parallel, threadid
 
-from .graph.core cimport EdgeIterator
+from .graph.core cimport EdgeIterator, CGraph
+from .graph.core import _graph_edges
 from .graph.defs cimport gint
 from .graph.defs import gint_dtype
 from .system import InfiniteSystem
@@ -123,27 +127,20 @@ cdef void _get_orbs(gint[:, :] site_ranges, gint site,
     norbs[0] = norb
 
 
-@cython.boundscheck(False)
-@cython.wraparound(False)
-def _get_all_orbs(gint[:, :] where, gint[:, :] site_ranges):
-    cdef gint[:, :] offsets = np.empty((where.shape[0], 2), dtype=gint_dtype)
-    cdef gint[:, :] norbs = np.empty((where.shape[0], 2), dtype=gint_dtype)
-
-    cdef gint w, a, a_offset, a_norbs, b, b_offset, b_norbs
-    for w in range(where.shape[0]):
-        a = where[w, 0]
-        _get_orbs(site_ranges, a, &a_offset, &a_norbs)
-        if where.shape[1] == 1:
-            b, b_offset, b_norbs = a, a_offset, a_norbs
-        else:
-            b = where[w, 1]
-            _get_orbs(site_ranges, b, &b_offset, &b_norbs)
-        offsets[w, 0] = a_offset
-        offsets[w, 1] = b_offset
-        norbs[w, 0] = a_norbs
-        norbs[w, 1] = b_norbs
-
-    return offsets, norbs
+def _get_all_orbs(where, site_ranges):
+    """Return the first orbitals and the numbers of orbitals of all the
+    sites in `where`, as two arrays of shape ``(len(where), 2)``."""
+    where = np.asarray(where)
+    site_ranges = np.asarray(site_ranges)
+    # the range that contains each site
+    ranges = site_ranges[np.searchsorted(site_ranges[:, 0], where,
+                                         side='right') - 1]
+    offsets = ranges[..., 2] + (where - ranges[..., 0]) * ranges[..., 1]
+    norbs = ranges[..., 1]
+    if where.shape[1] == 1:
+        offsets = np.repeat(offsets, 2, axis=1)
+        norbs = np.repeat(norbs, 2, axis=1)
+    return offsets.astype(gint_dtype), norbs.astype(gint_dtype)
 
 
 def _get_tot_norbs(syst):
@@ -155,18 +152,252 @@ def _get_tot_norbs(syst):
     return tot_norbs
 
 
-def _normalize_site_where(syst, where):
+def _as_columns(vectors):
+    "Return 1D or 2D (one per row) `vectors` as contiguous columns."
+    return np.ascontiguousarray(np.atleast_2d(vectors).T)
+
+
+cdef extern from *:
+    """
+    #ifdef _OPENMP
+    #include <omp.h>
+    #define _max_threads() omp_get_max_threads()
+    #else
+    #define _max_threads() 1
+    #endif
+    """
+    int _max_threads() nogil
+
+
+# Number of wavefunctions handled by one thread when acting with an operator.
+DEF MODE_CHUNK = 8
+
+
+# The kernels below operate on C-contiguous arrays of wavefunctions stored as
+# columns: orbital ``r`` of wavefunction ``m`` is at ``vectors[r * n_modes + m]``.
+
+cdef void _block_mat_els(complex *out, gint n_out,
+                         complex *bra, gint r_s, gint r_norbs,
+                         complex *Q,
+                         complex *ket, gint c_s, gint c_norbs,
+                         gint n_modes) nogil:
+    """Add the matrix elements of the block `Q` to `out`.
+
+    `Q` is the ``r_norbs x c_norbs`` block of the operator that starts at
+    orbitals ``(r_s, c_s)``. `out` holds a value for each wavefunction, or,
+    if ``n_out == 1``, the sum over the wavefunctions.
+    """
+    cdef gint i, j, m
+    cdef complex Q_ij
+    cdef complex *bra_i
+    cdef complex *ket_j
+    for i in range(r_norbs):
+        bra_i = bra + (r_s + i) * n_modes
+        for j in range(c_norbs):
+            Q_ij = Q[i * c_norbs + j]
+            ket_j = ket + (c_s + j) * n_modes
+            if n_out == 1:
+                for m in range(n_modes):
+                    out[0] = out[0] + bra_i[m].conjugate() * Q_ij * ket_j[m]
+            else:
+                for m in range(n_modes):
+                    out[m] = out[m] + bra_i[m].conjugate() * Q_ij * ket_j[m]
+
+
+cdef void _block_act(complex *out, gint r_s, gint r_norbs,
+                     complex *Q,
+                     complex *ket, gint c_s, gint c_norbs,
+                     gint n_modes, gint m_start, gint m_stop) nogil:
+    """Act with the block `Q` on the wavefunctions ``m_start:m_stop`` of
+    `ket`, adding the result to `out`.
+
+    `Q` is the ``r_norbs x c_norbs`` block of the operator that starts at
+    orbitals ``(r_s, c_s)``.
+    """
+    cdef gint i, j, m
+    cdef complex Q_ij
+    cdef complex *out_i
+    cdef complex *ket_j
+    for i in range(r_norbs):
+        out_i = out + (r_s + i) * n_modes
+        for j in range(c_norbs):
+            Q_ij = Q[i * c_norbs + j]
+            ket_j = ket + (c_s + j) * n_modes
+            for m in range(m_start, m_stop):
+                out_i[m] = out_i[m] + Q_ij * ket_j[m]
+
+
+cdef void _stacked_block_mat_els(complex *out, gint out_stride, gint n_ops,
+                                 gint n_out,
+                                 complex *bra, gint r_s, gint r_norbs,
+                                 complex **Q,
+                                 complex *ket, gint c_s, gint c_norbs,
+                                 gint n_modes, complex *bra_ket) nogil:
+    """Add the matrix elements of the blocks ``Q[o]`` of several operators
+    to ``out + o * out_stride``.
+
+    All the blocks start at orbitals ``(r_s, c_s)`` and have the same shape.
+    The products of the wavefunctions are computed only once for all the
+    operators, in the scratch space `bra_ket` of length ``n_modes``.
+    """
+    cdef gint i, j, m, o
+    cdef complex total, Q_ij
+    cdef complex *out_o
+    cdef complex *bra_i
+    cdef complex *ket_j
+    for i in range(r_norbs):
+        bra_i = bra + (r_s + i) * n_modes
+        for j in range(c_norbs):
+            ket_j = ket + (c_s + j) * n_modes
+            if n_out == 1:
+                total = 0
+                for m in range(n_modes):
+                    total = total + bra_i[m].conjugate() * ket_j[m]
+                for o in range(n_ops):
+                    Q_ij = Q[o][i * c_norbs + j]
+                    out[o * out_stride] = out[o * out_stride] + Q_ij * total
+            else:
+                for m in range(n_modes):
+                    bra_ket[m] = bra_i[m].conjugate() * ket_j[m]
+                for o in range(n_ops):
+                    Q_ij = Q[o][i * c_norbs + j]
+                    out_o = out + o * out_stride
+                    for m in range(n_modes):
+                        out_o[m] = out_o[m] + Q_ij * bra_ket[m]
+
+
+cdef void _current_blocks(complex *H_ab, complex *M_a,
+                          gint a_norbs, gint b_norbs, complex *P) nogil:
+    """Compute the two blocks of the current operator on a hopping.
+
+    On exit ``P`` holds ``i H_ab^† M_a`` (``b_norbs x a_norbs``), followed by
+    ``-i M_a H_ab`` (``a_norbs x b_norbs``).
+    """
+    cdef gint i, j, k
+    cdef complex tmp
+    cdef complex *R = P + a_norbs * b_norbs
+    for i in range(b_norbs):
+        for k in range(a_norbs):
+            tmp = 0
+            for j in range(a_norbs):
+                tmp = tmp + (H_ab[j * b_norbs + i].conjugate() *
+                             M_a[j * a_norbs + k])
+            P[i * a_norbs + k] = 1j * tmp
+    for j in range(a_norbs):
+        for i in range(b_norbs):
+            tmp = 0
+            for k in range(a_norbs):
+                tmp = tmp + M_a[j * a_norbs + k] * H_ab[k * b_norbs + i]
+            R[j * b_norbs + i] = -1j * tmp
+
+
+cdef void _source_block(complex *H_aa, complex *M_a, gint a_norbs,
+                        complex *Q) nogil:
+    """Compute the source operator ``i (H_aa^† M_a - M_a H_aa)`` on a site."""
+    cdef gint i, j, k
+    cdef complex tmp
+    for i in range(a_norbs):
+        for k in range(a_norbs):
+            tmp = 0
+            for j in range(a_norbs):
+                tmp = tmp + (H_aa[j * a_norbs + i].conjugate() *
+                             M_a[j * a_norbs + k]
+                             - M_a[i * a_norbs + j] * H_aa[j * a_norbs + k])
+            Q[i * a_norbs + k] = 1j * tmp
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _accumulate_current(double *out, gint[:] targets,
+                              double[:] current, gint[:, :] hoppings,
+                              double[:, :] positions) nogil:
+    """Add ``current[w] * (r_b - r_a) / |r_b - r_a|`` to row
+    ``targets[a]`` of `out` for each hopping ``(a, b)``.
+
+    The rows of `out` have one element per dimension of `positions`.
+    Hoppings between sites at the same position are ignored.
+    """
+    cdef gint w, a, b, d, dim = positions.shape[1]
+    cdef double norm, J_w
+    cdef double *out_a
+    for w in range(hoppings.shape[0]):
+        a = hoppings[w, 0]
+        b = hoppings[w, 1]
+        norm = 0
+        for d in range(dim):
+            norm += (positions[b, d] - positions[a, d])**2
+        if norm == 0:
+            continue
+        J_w = current[w] / math.sqrt(norm)
+        out_a = out + targets[a] * dim
+        for d in range(dim):
+            out_a[d] += J_w * (positions[b, d] - positions[a, d])
+
+
+def _has_edges(graph, hoppings):
+    """Return which of the `hoppings` are edges of `graph`."""
+    hoppings = np.asarray(hoppings, dtype=np.int64)
+    num_nodes = graph.num_nodes
+    tails, heads = _graph_edges(graph)
+    if not len(tails):
+        return np.zeros(len(hoppings), dtype=bool)
+    edges = np.sort(tails.astype(np.int64) * num_nodes + heads)
+    keys = hoppings[:, 0] * num_nodes + hoppings[:, 1]
+    index = np.minimum(np.searchsorted(edges, keys), len(edges) - 1)
+    in_graph = np.all((hoppings >= 0) & (hoppings < num_nodes), axis=1)
+    return in_graph & (edges[index] == keys)
+
+
+def _site_positions(sites):
+    """Return the positions of a sequence of sites as a 2D array."""
+    if not len(sites):
+        return np.empty((0, 0))
+    dim = len(sites[0].pos)
+    positions = itertools.chain.from_iterable(site.pos for site in sites)
+    return np.fromiter(positions, float, dim * len(sites)).reshape(-1, dim)
+
+
+def _family_positions(family, sites):
+    """Return the positions of `sites`, which all belong to `family`."""
+    try:
+        prim_vecs, offset = np.asarray(family.prim_vecs), family.offset
+    except AttributeError:
+        return _site_positions(sites)
+    # lattice sites: compute all the positions at once from the tags
+    lat_dim = len(prim_vecs)
+    tags = itertools.chain.from_iterable(site.tag for site in sites)
+    tags = np.fromiter(tags, float, lat_dim * len(sites)).reshape(-1, lat_dim)
+    return np.dot(tags, prim_vecs) + offset
+
+
+def _where_mask(mask, size):
+    mask = np.asarray(mask)
+    if mask.shape != (size,):
+        raise ValueError('A vectorized `where` function must return an array '
+                         'with one value for each of its inputs.')
+    return mask.astype(bool)
+
+
+def _normalize_site_where(syst, where, vectorize=False):
     """Normalize the format of `where` when `where` contains sites.
 
     If `where` is None, then all sites in the system are returned.
     If it is a general iterator then it is expanded into an array. If `syst`
     is a finalized Builder then `where` should contain `Site` objects,
-    otherwise it should contain integers.
+    otherwise it should contain integers. If `where` is a function and
+    `vectorize` is True, then it is called once with the positions of all
+    the sites (or their indices, if `syst` is not a finalized Builder).
     """
     if where is None:
         size = (syst.cell_size
                 if isinstance(syst, InfiniteSystem) else syst.graph.num_nodes)
-        _where = list(range(size))
+        _where = np.arange(size)
+    elif callable(where) and vectorize:
+        if hasattr(syst, 'sites'):
+            mask = where(_site_positions(syst.sites))
+        else:
+            mask = where(np.arange(syst.graph.num_nodes))
+        _where = np.flatnonzero(_where_mask(mask, syst.graph.num_nodes))
     elif callable(where):
         try:
             _where = [syst.id_by_site[a] for a in filter(where, syst.sites)]
@@ -176,26 +407,30 @@ def _normalize_site_where(syst, where):
         try:
             _where = list(syst.id_by_site[s] for s in where)
         except AttributeError:
-            _where = list(where)
-            if any(w < 0 or w >= syst.graph.num_nodes for w in _where):
+            _where = np.asarray(list(where)).reshape(-1)
+            if np.any((_where < 0) | (_where >= syst.graph.num_nodes)):
                 raise ValueError('`where` contains sites that are not in the '
                                  'system.')
 
+    _where = np.asarray(_where, dtype=gint_dtype).reshape(-1, 1)
     if isinstance(syst, InfiniteSystem):
-        if any(w >= syst.cell_size for w in _where):
+        if np.any(_where >= syst.cell_size):
             raise ValueError('Only sites in the fundamental domain may be '
                              'specified using `where`.')
 
-    return np.asarray(_where, dtype=gint_dtype).reshape(len(_where), 1)
+    return _where
 
 
-def _normalize_hopping_where(syst, where):
+def _normalize_hopping_where(syst, where, vectorize=False):
     """Normalize the format of `where` when `where` contains hoppings.
 
     If `where` is None, then all hoppings in the system are returned.
     If it is a general iterator then it is expanded into an array. If `syst` is
     a finalized Builder then `where` should contain pairs of `Site` objects,
-    otherwise it should contain pairs of integers.
+    otherwise it should contain pairs of integers. If `where` is a function
+    and `vectorize` is True, then it is called once with the positions of the
+    first and of the second sites of all the hoppings (or their indices, if
+    `syst` is not a finalized Builder).
     """
     if where is None:
         # we cannot extract the hoppings in the same order as they are in the
@@ -203,33 +438,45 @@ def _normalize_hopping_where(syst, where):
         if isinstance(syst, InfiniteSystem):
             raise ValueError('`where` must be provided when calculating '
                              'current in an InfiniteSystem.')
-        _where = list(syst.graph)
+        _where = np.column_stack(_graph_edges(syst.graph))
+    elif callable(where) and vectorize:
+        tails, heads = _graph_edges(syst.graph)
+        if hasattr(syst, 'sites'):
+            positions = _site_positions(syst.sites)
+            mask = where(positions[tails], positions[heads])
+        else:
+            mask = where(tails, heads)
+        mask = _where_mask(mask, len(tails))
+        _where = np.column_stack((tails[mask], heads[mask]))
     elif callable(where):
+        tails, heads = _graph_edges(syst.graph)
+        hoppings = zip(tails.tolist(), heads.tolist())
         if hasattr(syst, "sites"):
             def idx_where(hop):
                 a, b = hop
                 return where(syst.sites[a], syst.sites[b])
-            _where = list(filter(idx_where, syst.graph))
+            _where = list(filter(idx_where, hoppings))
         else:
-            _where = list(filter(lambda h: where(*h), syst.graph))
+            _where = list(filter(lambda h: where(*h), hoppings))
     else:
         try:
             _where = list((syst.id_by_site[a], syst.id_by_site[b])
                            for a, b in where)
         except AttributeError:
-            _where = list(where)
+            _where = np.asarray(list(where)).reshape(-1, 2)
             # NOTE: if we ever have operators that contain elements that are
             #       not in the system graph, then we should modify this check
-            if any(not syst.graph.has_edge(*w) for w in where):
+            if not np.all(_has_edges(syst.graph, _where)):
                 raise ValueError('`where` contains hoppings that are not in the '
                                  'system.')
 
+    _where = np.asarray(_where, dtype=gint_dtype).reshape(-1, 2)
     if isinstance(syst, InfiniteSystem):
-        if any(a > syst.cell_size or b > syst.cell_size for a, b in _where):
+        if np.any(_where > syst.cell_size):
             raise ValueError('Only intra-cell hoppings may be specified '
                              'using `where`.')
 
-    return np.asarray(_where, dtype=gint_dtype)
+    return _where
 
 
 ## These two classes are here to avoid using closures, as these will
@@ -250,16 +497,85 @@ class _DictOnsite(_FunctionalOnsite):
     def __call__(self, site_id, *args):
         return self.onsite[self.sites[site_id].family]
 
+    def family_values(self, family, site_ids, *args):
+        return self.onsite[family]
+
+
+class _VectorizedOnsite(_FunctionalOnsite):
 
-def _normalize_onsite(syst, onsite, check_hermiticity):
+    def __call__(self, site_id, *args):
+        value = np.asarray(self.family_values(self.sites[site_id].family,
+                                              [site_id], *args))
+        return value[0] if value.ndim == 3 else value
+
+    def family_values(self, family, site_ids, *args):
+        positions = _family_positions(family,
+                                      [self.sites[i] for i in site_ids])
+        return self.onsite(family, positions, *args)
+
+
+def _eval_family_onsites(onsite, where, site_ranges, args,
+                         check_hermiticity):
+    """Evaluate an onsite that is given per site family on `where`.
+
+    `onsite` is evaluated once for each site family in `where`, and each
+    distinct onsite matrix is stored only once in the returned
+    BlockSparseMatrix.
+    """
+    sites = onsite.sites
+    site_ids = np.asarray(where)[:, 0]
+    family_index = {}
+    index = np.fromiter(
+        (family_index.setdefault(sites[i].family, len(family_index))
+         for i in site_ids.tolist()),
+        gint_dtype, len(site_ids))
+
+    data = []
+    data_offsets = np.empty(len(site_ids), dtype=gint_dtype)
+    size = 0
+    for family, k in family_index.items():
+        members = np.flatnonzero(index == k)
+        value = np.array(onsite.family_values(family, site_ids[members], *args),
+                         dtype=complex)
+        if value.ndim < 3:
+            # a single matrix for all the sites of this family
+            matrices = value.reshape((1,) + np.atleast_2d(value).shape)
+            inverse = np.zeros(len(members), dtype=gint_dtype)
+        elif value.shape[0] == len(members):
+            matrices, inverse = np.unique(value.reshape(len(members), -1),
+                                          axis=0, return_inverse=True)
+            matrices = matrices.reshape((-1,) + value.shape[1:])
+        else:
+            raise UserCodeError('A vectorized `onsite` function must return '
+                                'a single matrix or one matrix for each of '
+                                'its inputs.')
+        for mat in matrices:
+            _check_onsite(mat, family.norbs, check_hermiticity)
+        data_offsets[members] = size + inverse * matrices[0].size
+        data.append(matrices.reshape(-1))
+        size += matrices.size
+
+    offsets, norbs = _get_all_orbs(where, site_ranges)
+    data = np.concatenate(data) if data else np.empty(0, dtype=complex)
+    return _block_sparse_matrix(offsets, norbs, data_offsets, data)
+
+
+def _normalize_onsite(syst, onsite, check_hermiticity, vectorize=False):
     """Normalize the format of `onsite`.
 
     If `onsite` is a function or a mapping (dictionary) then a function
-    is returned.
+    is returned. If `vectorize` is True, then a function `onsite` is
+    evaluated once per site family, with the positions of the sites.
     """
     param_names = ()
 
-    if callable(onsite):
+    if callable(onsite) and vectorize:
+        if not hasattr(syst, 'sites'):
+            raise TypeError('`onsite` may only be vectorized for finalized '
+                            'Builders.')
+        param_names = get_parameters(onsite)[2:]
+        _onsite = _VectorizedOnsite(onsite, syst.sites)
+    elif callable(onsite):
         # make 'onsite' compatible with hamiltonian value functions
         param_names = get_parameters(onsite)[1:]
         try:
@@ -392,6 +708,122 @@ cdef class BlockSparseMatrix:
         ) = state
 
 
+def _block_sparse_matrix(block_offsets, block_shapes, data_offsets, data):
+    """Return a BlockSparseMatrix made from already evaluated blocks."""
+    matrix = BlockSparseMatrix.__new__(BlockSparseMatrix)
+    matrix.__setstate__((block_offsets, block_shapes, data_offsets, data))
+    return matrix
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _block_elements(BlockSparseMatrix blocks, gint[:] where_ptr):
+    """Return the rows, columns, values and indices into `where` of all
+    the elements of `blocks`.
+
+    The blocks ``where_ptr[w]`` to ``where_ptr[w + 1]`` belong to the
+    element ``w`` of `where`.
+    """
+    cdef gint[:, :] offsets = blocks.block_offsets
+    cdef gint[:, :] shapes = blocks.block_shapes
+    cdef gint[:] data_offsets = blocks.data_offsets
+    cdef complex[:] data = blocks.data
+    size = np.sum(np.prod(np.asarray(shapes), axis=1))
+    cdef gint[:] rows = np.empty(size, dtype=gint_dtype)
+    cdef gint[:] cols = np.empty(size, dtype=gint_dtype)
+    cdef gint[:] where_idx = np.empty(size, dtype=gint_dtype)
+    cdef complex[:] values = np.empty(size, dtype=complex)
+
+    cdef gint w, k, i, j, n = 0
+    for w in range(where_ptr.shape[0] - 1):
+        for k in range(where_ptr[w], where_ptr[w + 1]):
+            for i in range(shapes[k, 0]):
+                for j in range(shapes[k, 1]):
+                    rows[n] = offsets[k, 0] + i
+                    cols[n] = offsets[k, 1] + j
+                    values[n] = data[data_offsets[k] + i * shapes[k, 1] + j]
+                    where_idx[n] = w
+                    n += 1
+    return tuple(map(np.asarray, (rows, cols, values, where_idx)))
+
+
+################ Caching of evaluated operators
+
+# Maximum number of sets of evaluated onsite and Hamiltonian matrices
+# that an operator keeps for reuse in later calls.
+_cache_size = 4
+
+
+# Types whose instances are immutable and compared by value.
+_immutable_types = (bool, int, float, complex, str, bytes, type(None))
+
+
+def _value_key(value):
+    """Return a hashable key that identifies 'value', or None.
+
+    Keys are only made for values that are known to be immutable: numbers,
+    strings, None, tuples of these, and arrays, which are identified by their
+    contents.  Numbers are keyed by their type and representation, such that
+    ``0.0`` and ``-0.0``, or ``1`` and ``True``, have different keys.
+    """
+    if isinstance(value, np.ndarray):
+        if value.dtype.hasobject:
+            return None
+        return (np.ndarray, value.dtype.str, value.shape, value.tobytes())
+    if isinstance(value, np.generic):
+        if value.dtype.hasobject:
+            return None
+        return (type(value), value.tobytes())
+    if type(value) is tuple:
+        keys = tuple(map(_value_key, value))
+        if any(key is None for key in keys):
+            return None
+        return (tuple, keys)
+    if type(value) in _immutable_types:
+        return (type(value), repr(value))
+    return None
+
+
+def _cache_key(args, params, param_names):
+    """Return a hashable key for the values of 'args', or of the
+    parameters 'param_names' in 'params', or None if there is none.
+
+    If 'param_names' is None, all the parameters are used.
+    """
+    if params:
+        if param_names is None:
+            items = sorted(params.items(), key=itemgetter(0))
+        else:
+            items = [(name, params[name]) for name in param_names
+                     if name in params]
+    else:
+        items = enumerate(args)
+    key = []
+    for name, value in items:
+        value = _value_key(value)
+        if value is None:
+            return None
+        key.append((name, value))
+    return bool(params), tuple(key)
+
+
+def _hamiltonian_param_names(syst, hoppings):
+    """Return the names of the parameters of the Hamiltonian of 'syst',
+    or None if they are not known.
+
+    Only the parameters of the hoppings are returned if 'hoppings' is True,
+    otherwise only those of the onsites.
+    """
+    try:
+        values = syst.hoppings if hoppings else syst.onsites
+    except AttributeError:
+        return None
+    param_names = set()
+    for names in {names for _, names in values}:
+        param_names.update(names or ())
+    return sorted(param_names)
+
+
 ################ Local Observables
 
 # supported operations within the `_operate` method
@@ -435,10 +867,16 @@ cdef class _LocalOperator:
     cdef public object syst, onsite, _onsite_param_names
     cdef public gint[:, :]  where, _site_ranges
     cdef public BlockSparseMatrix _bound_onsite, _bound_hamiltonian
+    cdef public object _cache, _hamiltonian_param_names
+
+    def __cinit__(self):
+        # evaluated onsite and Hamiltonian matrices, in least recently
+        # used order
+        self._cache = collections.OrderedDict()
 
     @cython.embedsignature
     def __init__(self, syst, onsite, where, *,
-                 check_hermiticity=True, sum=False):
+                 check_hermiticity=True, sum=False, vectorize=False):
         if syst.site_ranges is None:
             raise ValueError('Number of orbitals not defined.\n'
                              'Declare the number of orbitals using the '
@@ -447,7 +885,7 @@ cdef class _LocalOperator:
 
         self.syst = syst
         self.onsite, self._onsite_param_names = _normalize_onsite(
-            syst, onsite, check_hermiticity)
+            syst, onsite, check_hermiticity, vectorize)
         self.check_hermiticity = check_hermiticity
         self.sum = sum
         self._site_ranges = np.asarray(syst.site_ranges, dtype=gint_dtype)
@@ -456,7 +894,8 @@ cdef class _LocalOperator:
         self._bound_hamiltonian = None
 
     @cython.embedsignature
-    def __call__(self, bra, ket=None, args=(), *, params=None):
+    def __call__(self, bra, ket=None, args=(), *, params=None,
+                 sum_states=False):
         r"""Return the matrix elements of the operator.
 
         An operator ``A`` can be called like
@@ -490,12 +929,29 @@ cdef class _LocalOperator:
         :math:`i` runs over all sites or hoppings, and
         :math:`α` and :math:`β` run over all the degrees of freedom.
 
+        Several wavefunctions may be passed at once as the rows of a 2D
+        ``bra`` and ``ket``, for example the scattering states of one lead
+        as returned by `~kwant.solvers.default.wave_function`. The matrix
+        elements are then computed for each pair of rows, and the operator
+        data is only evaluated once for all of them.
+
+        The onsite matrices of the operator, and the parts of the system
+        Hamiltonian that it uses, are kept for the few most recently used
+        values of the parameters that they depend on. Calling the operator
+        again with these values does not evaluate them again, so the
+        functions that define them should only depend on their arguments.
+        Only parameter values that are immutable, namely numbers, strings,
+        None, tuples of these, and arrays (compared by their contents), are
+        used for caching; if any parameter has another value, the operator
+        is evaluated anew.
+
         Parameters
         ----------
-        bra, ket : sequence of complex
+        bra, ket : sequence of complex, or 2D array of complex
             Must have the same length as the number of orbitals
-            in the system. If only one is provided, both ``bra``
-            and ``ket`` are taken as equal.
+            in the system, or be 2D arrays with one wavefunction per row.
+            If only one is provided, both ``bra`` and ``ket`` are taken as
+            equal. ``bra`` and ``ket`` must have the same shape.
         args : tuple, optional
             The arguments to pass to the system. Used to evaluate
             the ``onsite`` elements and, possibly, the system Hamiltonian.
@@ -503,12 +959,18 @@ cdef class _LocalOperator:
         params : dict, optional
             Dictionary of parameter names and their values. Mutually exclusive
             with 'args'.
+        sum_states : bool, default: False
+            If True and ``bra`` and ``ket`` are 2D, then return the sum of the
+            matrix elements over all the wavefunctions, rather than the
+            matrix elements of each wavefunction separately.
 
         Returns
         -------
         `float` if ``check_hermiticity`` is True, and ``ket`` is ``None``,
         otherwise `complex`. If this operator was created with ``sum=True``,
         then a single value is returned, otherwise an array is returned.
+        If ``bra`` is 2D and ``sum_states`` is False, then the result has an
+        extra leading axis that runs over the wavefunctions.
         """
         if (self._bound_onsite or self._bound_hamiltonian) and (args or params):
             raise ValueError("Extra arguments are already bound to this "
@@ -521,26 +983,24 @@ cdef class _LocalOperator:
         bra = np.asarray(bra, dtype=complex)
         ket = bra if ket is None else np.asarray(ket, dtype=complex)
         tot_norbs = _get_tot_norbs(self.syst)
-        if bra.shape != (tot_norbs,):
-            msg = 'vector is incorrect shape'
-            msg = 'bra ' + msg if ket is None else msg
-            raise ValueError(msg)
-        elif ket.shape != (tot_norbs,):
+        if bra.ndim not in (1, 2) or bra.shape[-1] != tot_norbs:
+            raise ValueError('bra vector is incorrect shape')
+        elif ket.shape != bra.shape:
             raise ValueError('ket vector is incorrect shape')
 
-        where = np.asarray(self.where)
-        where.setflags(write=False)
-        if self.where.shape[1] == 1:
-            # if `where` just contains sites, then we want a strictly 1D array
-            where = where.reshape(-1)
-
-        result = np.zeros((self.where.shape[0],), dtype=complex)
-        self._operate(out_data=result, bra=bra, ket=ket, args=args,
+        # The kernels loop over the wavefunctions innermost, so they
+        # must be stored as contiguous columns.
+        bra_cols = _as_columns(bra)
+        ket_cols = bra_cols if ket is bra else _as_columns(ket)
+        n_out = 1 if sum_states else bra_cols.shape[1]
+        result = np.zeros((self.where.shape[0], n_out), dtype=complex)
+        self._operate(out_data=result, bra=bra_cols, ket=ket_cols, args=args,
                       params=params, op=MAT_ELS)
         # if everything is Hermitian then result is real if bra == ket
         if self.check_hermiticity and bra is ket:
             result = result.real
-        return np.sum(result) if self.sum else result
+        result = result[:, 0] if (bra.ndim == 1 or sum_states) else result.T
+        return np.sum(result, axis=-1) if self.sum else result
 
     @cython.embedsignature
     def act(self, ket, args=(), *, params=None):
@@ -551,8 +1011,9 @@ cdef class _LocalOperator:
 
         Parameters
         ----------
-        ket : sequence of complex
-            Wavefunctions defined over all the orbitals of the system.
+        ket : sequence of complex, or 2D array of complex
+            Wavefunction defined over all the orbitals of the system, or
+            a 2D array with one such wavefunction per row.
         args : tuple
             The extra arguments to the Hamiltonian value functions and
             the operator ``onsite`` function. Mutually exclusive with 'params'.
@@ -562,7 +1023,7 @@ cdef class _LocalOperator:
 
         Returns
         -------
-        Array of `complex`.
+        Array of `complex`, with the same shape as ``ket``.
         """
         if (self._bound_onsite or self._bound_hamiltonian) and (args or params):
             raise ValueError("Extra arguments are already bound to this "
@@ -575,12 +1036,13 @@ cdef class _LocalOperator:
             raise TypeError('ket must be an array')
         ket = np.asarray(ket, dtype=complex)
         tot_norbs = _get_tot_norbs(self.syst)
-        if ket.shape != (tot_norbs,):
+        if ket.ndim not in (1, 2) or ket.shape[-1] != tot_norbs:
             raise ValueError('ket vector is incorrect shape')
-        result = np.zeros((tot_norbs,), dtype=np.complex)
-        self._operate(out_data=result, bra=None, ket=ket, args=args,
+        ket_cols = _as_columns(ket)
+        result = np.zeros(ket_cols.shape, dtype=complex)
+        self._operate(out_data=result, bra=None, ket=ket_cols, args=args,
                       params=params, op=ACT)
-        return result
+        return result[:, 0] if ket.ndim == 1 else result.T
 
     @cython.embedsignature
     def bind(self, args=(), *, params=None):
@@ -588,6 +1050,8 @@ cdef class _LocalOperator:
 
         Returns a copy of this operator that does not need to be passed extra
         arguments when subsequently called or when using the ``act`` method.
+        The values that are bound are evaluated using the same cache as
+        ``__call__``, under the same assumptions on the parameters.
         """
         if args and params:
             raise TypeError("'args' and 'params' are mutually exclusive.")
@@ -606,8 +1070,10 @@ cdef class _LocalOperator:
         # NOTE: subclasses should populate `bound_hamiltonian` if needed
         return q
 
-    def _operate(self, complex[:] out_data, complex[:] bra, complex[:] ket,
-                 args, operation op, *, params=None):
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def _operate(self, complex[:, ::1] out_data, complex[:, ::1] bra,
+                 complex[:, ::1] ket, args, operation op, *, params=None):
         """Do an operation with the operator.
 
         Parameters
@@ -615,9 +1081,13 @@ cdef class _LocalOperator:
         out_data : ndarray
             Output array, zero on entry. On exit should contain the required
             data.  What this means depends on the value of `op`, as does the
-            length of the array.
+            shape of the array. For `MAT_ELS` there is one row per element
+            of `where`, and either one column per wavefunction or a single
+            column holding the sum over the wavefunctions. For `ACT` it has
+            the same shape as `ket`.
         bra, ket : ndarray
-            Wavefunctions defined over all the orbitals of the system.
+            Wavefunctions defined over all the orbitals of the system,
+            stored as the columns of a 2D array.
             If `op` is `ACT` then `bra` is None.
         args : tuple
             The extra arguments to the Hamiltonian value functions and
@@ -630,12 +1100,165 @@ cdef class _LocalOperator:
             Dictionary of parameter names and their values. Mutually exclusive
             with 'args'.
         """
+        cdef BlockSparseMatrix blocks
+        cdef gint[:] where_ptr
+        blocks, where_ptr = self._operator_blocks(args, params)
+
+        cdef gint[:, :] offsets = blocks.block_offsets
+        cdef gint[:, :] shapes = blocks.block_shapes
+        cdef gint[:] data_offsets = blocks.data_offsets
+        cdef complex *data = <complex*> &blocks.data[0]
+
+        cdef complex *out = &out_data[0, 0]
+        cdef complex *bra_data = NULL if bra is None else &bra[0, 0]
+        cdef complex *ket_data = &ket[0, 0]
+        cdef gint n_where = where_ptr.shape[0] - 1
+        cdef gint n_blocks = offsets.shape[0]
+        cdef gint n_out = out_data.shape[1], n_modes = ket.shape[1]
+        cdef gint n_chunks = (n_modes + MODE_CHUNK - 1) // MODE_CHUNK
+        cdef gint w, k, c, m_start
+        with nogil:
+            ### loop over the elements of 'where': each thread fills
+            ### separate rows of the result
+            if op == MAT_ELS:
+                for w in prange(n_where):
+                    for k in range(where_ptr[w], where_ptr[w + 1]):
+                        _block_mat_els(out + w * n_out, n_out,
+                                       bra_data, offsets[k, 0], shapes[k, 0],
+                                       data + data_offsets[k],
+                                       ket_data, offsets[k, 1], shapes[k, 1],
+                                       n_modes)
+            ### loop over groups of wavefunctions, then over the blocks, such
+            ### that each thread fills separate columns of the result
+            elif op == ACT:
+                for c in prange(n_chunks):
+                    m_start = c * MODE_CHUNK
+                    for k in range(n_blocks):
+                        _block_act(out, offsets[k, 0], shapes[k, 0],
+                                   data + data_offsets[k],
+                                   ket_data, offsets[k, 1], shapes[k, 1],
+                                   n_modes, m_start,
+                                   min(m_start + MODE_CHUNK, n_modes))
+
+    def _operator_blocks(self, args, params):
+        """Return the non-zero blocks of the operator.
+
+        Parameters
+        ----------
+        args : tuple
+            The extra arguments to the Hamiltonian value functions and
+            the operator ``onsite`` function. Mutually exclusive with 'params'.
+        params : dict, optional
+            Dictionary of parameter names and their values. Mutually exclusive
+            with 'args'.
+
+        Returns
+        -------
+        blocks : BlockSparseMatrix
+            The blocks of :math:`Q_{iαβ}` for all :math:`i`, ordered like
+            `where`.
+        where_ptr : gint[:]
+            The blocks ``where_ptr[i]`` to ``where_ptr[i + 1]`` belong to
+            the element ``i`` of `where`.
+        """
         raise NotImplementedError()
 
+    @cython.embedsignature
+    def tocsr(self, args=(), *, params=None, where_map=False):
+        r"""Convert the operator to a compressed sparse row matrix.
+
+        Parameters
+        ----------
+        args : tuple, optional
+            The arguments to pass to the system. Used to evaluate
+            the ``onsite`` elements and, possibly, the system Hamiltonian.
+            Mutually exclusive with 'params'.
+        params : dict, optional
+            Dictionary of parameter names and their values. Mutually exclusive
+            with 'args'.
+        where_map : bool, default: False
+            If True, also return the map from the stored elements of the
+            matrix to the sites or hoppings in ``where``.
+
+        Returns
+        -------
+        matrix : `scipy.sparse.csr_matrix`
+            The matrix :math:`∑_i Q_{iαβ}`, where :math:`i` runs over all
+            the sites or hoppings in ``where``.
+        where_map : `scipy.sparse.csr_matrix`
+            Only returned if ``where_map`` is True. Its element ``(i, k)`` is
+            :math:`Q_{iαβ}`, where ``α`` and ``β`` are the row and column of
+            the ``k``-th stored element of ``matrix``.
+
+        Notes
+        -----
+        The matrix elements of the operator may then be evaluated with
+        sparse matrix products. For wavefunctions ``bra`` and ``ket``,
+        stored as vectors or as the columns of 2D arrays, the result for
+        ``sum=True`` is ``(bra.conj() * (matrix @ ket)).sum(axis=0)``,
+        and the result on each site or hopping is ::
+
+            rows = np.repeat(np.arange(matrix.shape[0]),
+                             np.diff(matrix.indptr))
+            where_map @ (bra[rows].conj() * ket[matrix.indices])
+
+        ``matrix`` can also be passed directly wherever an operator may be
+        given as a sparse matrix, for instance to
+        `~kwant.kpm.SpectralDensity`.
+        """
+        if (self._bound_onsite or self._bound_hamiltonian) and (args or params):
+            raise ValueError("Extra arguments are already bound to this "
+                             "operator. You should call this operator "
+                             "providing neither 'args' nor 'params'.")
+        if args and params:
+            raise TypeError("'args' and 'params' are mutually exclusive.")
+
+        blocks, where_ptr = self._operator_blocks(args, params)
+        rows, cols, values, where_idx = _block_elements(blocks, where_ptr)
+        norbs = _get_tot_norbs(self.syst)
+        # Elements of different blocks may fall on the same orbitals.
+        keys, index = np.unique(rows.astype(np.int64) * norbs + cols,
+                                return_inverse=True)
+        data = (np.bincount(index, values.real, len(keys))
+                + 1j * np.bincount(index, values.imag, len(keys)))
+        indptr = np.searchsorted(keys // norbs, np.arange(norbs + 1))
+        matrix = csr_matrix((data, keys % norbs, indptr),
+                            shape=(norbs, norbs))
+        if not where_map:
+            return matrix
+        where_map = csr_matrix((values, (where_idx, index)),
+                               shape=(self.where.shape[0], len(keys)))
+        return matrix, where_map
+
+    cdef object _cached(self, key):
+        """Return the cached value for 'key', or None."""
+        if key is None or key not in self._cache:
+            return None
+        self._cache.move_to_end(key)
+        return self._cache[key]
+
+    cdef int _store(self, key, value) except -1:
+        """Cache 'value' for 'key', dropping the least recently used value
+        if the cache is full."""
+        if key is not None:
+            self._cache[key] = value
+            while len(self._cache) > _cache_size:
+                self._cache.popitem(last=False)
+        return 0
+
     cdef BlockSparseMatrix _eval_onsites(self, args, params):
-        """Evaluate the onsite matrices on all elements of `where`"""
+        """Evaluate the onsite matrices on all elements of `where`
+
+        The result is cached for the values of the parameters of ``onsite``.
+        """
         assert callable(self.onsite)
         assert not (args and params)
+        key = _cache_key(args, params, self._onsite_param_names)
+        key = None if key is None else ('onsite', key)
+        cached = self._cached(key)
+        if cached is not None:
+            return cached
+
         matrix = ta.matrix
         onsite = self.onsite
         check_hermiticity = self.check_hermiticity
@@ -650,16 +1273,38 @@ cdef class _LocalOperator:
                        ', '.join(map('"{}"'.format, missing)))
                 raise TypeError(''.join(msg))
 
+        if isinstance(onsite, (_DictOnsite, _VectorizedOnsite)):
+            blocks = _eval_family_onsites(onsite, self.where,
+                                          self._site_ranges, args,
+                                          check_hermiticity)
+            self._store(key, blocks)
+            return blocks
+
         def get_onsite(a, a_norbs, b, b_norbs):
             mat = matrix(onsite(a, *args), complex)
             _check_onsite(mat, a_norbs, check_hermiticity)
             return mat
 
         offsets, norbs = _get_all_orbs(self.where, self._site_ranges)
-        return  BlockSparseMatrix(self.where, offsets, norbs, get_onsite)
+        blocks = BlockSparseMatrix(self.where, offsets, norbs, get_onsite)
+        self._store(key, blocks)
+        return blocks
 
     cdef BlockSparseMatrix _eval_hamiltonian(self, args, params):
-        """Evaluate the Hamiltonian on all elements of `where`."""
+        """Evaluate the Hamiltonian on all elements of `where`.
+
+        The result is cached for the values of the parameters of the
+        Hamiltonian.
+        """
+        if params and self._hamiltonian_param_names is None:
+            self._hamiltonian_param_names = _hamiltonian_param_names(
+                self.syst, self.where.shape[1] == 2)
+        key = _cache_key(args, params, self._hamiltonian_param_names)
+        key = None if key is None else ('hamiltonian', key)
+        cached = self._cached(key)
+        if cached is not None:
+            return cached
+
         matrix = ta.matrix
         hamiltonian = self.syst.hamiltonian
         check_hermiticity = self.check_hermiticity
@@ -671,7 +1316,9 @@ cdef class _LocalOperator:
             return mat
 
         offsets, norbs = _get_all_orbs(self.where, self._site_ranges)
-        return  BlockSparseMatrix(self.where, offsets, norbs, get_ham)
+        blocks = BlockSparseMatrix(self.where, offsets, norbs, get_ham)
+        self._store(key, blocks)
+        return blocks
 
     def __getstate__(self):
         return (
@@ -718,6 +1365,17 @@ cdef class Density(_LocalOperator):
         If True, then calling this operator will return a single scalar,
         otherwise a vector will be returned (see
         `~kwant.operator.Density.__call__` for details).
+    vectorize : bool, default: False
+        If True, a function given as ``where`` is called only once, with the
+        positions of all the sites as an array of shape ``(n_sites, dim)``,
+        and must return a boolean array of length ``n_sites``. If ``syst``
+        is not a finalized Builder, it receives the array of all site
+        indices instead.
+        A function given as ``onsite`` is called once for each site family
+        in ``where``, as ``onsite(family, positions, *args)``, and must
+        return either a single matrix for all these sites or an array of
+        shape ``(n_sites, norbs, norbs)``; this is only supported if
+        ``syst`` is a finalized Builder.
 
     Notes
     -----
@@ -730,66 +1388,29 @@ cdef class Density(_LocalOperator):
 
     @cython.embedsignature
     def __init__(self, syst, onsite=1, where=None, *,
-                 check_hermiticity=True, sum=False):
-        where = _normalize_site_where(syst, where)
+                 check_hermiticity=True, sum=False, vectorize=False):
+        where = _normalize_site_where(syst, where, vectorize)
         super().__init__(syst, onsite, where,
-                         check_hermiticity=check_hermiticity, sum=sum)
-
-    @cython.boundscheck(False)
-    @cython.wraparound(False)
-    def _operate(self, complex[:] out_data, complex[:] bra, complex[:] ket,
-                 args, operation op, *, params=None):
-        matrix = ta.matrix
-        cdef int unique_onsite = not callable(self.onsite)
-        # prepare onsite matrices
-        cdef complex[:, :] _tmp_mat
-        cdef complex *M_a = NULL
-        cdef BlockSparseMatrix M_a_blocks
+                         check_hermiticity=check_hermiticity, sum=sum,
+                         vectorize=vectorize)
 
-        if unique_onsite:
-            _tmp_mat = self.onsite
-            M_a = <complex*> &_tmp_mat[0, 0]
+    def _operator_blocks(self, args, params):
+        offsets, norbs = _get_all_orbs(self.where, self._site_ranges)
+        n_where = self.where.shape[0]
+        if not callable(self.onsite):
+            # All the blocks share the same data.
+            blocks = _block_sparse_matrix(
+                offsets, norbs, np.zeros(n_where, dtype=gint_dtype),
+                np.array(self.onsite, dtype=complex).ravel())
         elif self._bound_onsite:
-            M_a_blocks = self._bound_onsite
+            blocks = self._bound_onsite
         else:
-            M_a_blocks = self._eval_onsites(args, params)
-
-        # loop-local variables
-        cdef gint a, a_s, a_norbs
-        cdef gint i, j, w
-        cdef complex tmp, bra_conj
-        ### loop over sites
-        for w in range(self.where.shape[0]):
-            ### get the next site, start orbital and number of orbitals
-            a = self.where[w, 0]
-            _get_orbs(self._site_ranges, a, &a_s, &a_norbs)
-            ### get the next onsite matrix, if necessary
-            if not unique_onsite:
-                M_a = M_a_blocks.get(w)
-            ### do the actual calculation
-            if op == MAT_ELS:
-                tmp = 0
-                for i in range(a_norbs):
-                    for j in range(a_norbs):
-                        tmp += (bra[a_s + i].conjugate() *
-                                M_a[i * a_norbs + j] * ket[a_s + j])
-                out_data[w] = tmp
-            elif op == ACT:
-                for i in range(a_norbs):
-                    tmp = 0
-                    for j in range(a_norbs):
-                        tmp += M_a[i * a_norbs + j] * ket[a_s + j]
-                    out_data[a_s + i] = out_data[a_s + i] + tmp
+            blocks = self._eval_onsites(args, params)
+        return blocks, np.arange(n_where + 1, dtype=gint_dtype)
 
-    @cython.boundscheck(False)
-    @cython.wraparound(False)
-    @cython.cdivision(True)
     @cython.embedsignature
     def tocoo(self, args=(), *, params=None):
         """Convert the operator to coordinate format sparse matrix."""
-        cdef int blk, blk_size, n_blocks, n, k = 0
-        cdef int [:, :] offsets, shapes
-        cdef int [:] row, col
         if self._bound_onsite and (args or params):
            raise ValueError("Extra arguments are already bound to this "
                             "operator. You should call this operator "
@@ -797,35 +1418,10 @@ cdef class Density(_LocalOperator):
         if args and params:
             raise TypeError("'args' and 'params' are mutually exclusive.")
 
-        if not callable(self.onsite):
-            offsets = _get_all_orbs(self.where, self._site_ranges)[0]
-            n_blocks = len(self.where)
-            shapes = np.asarray(np.resize([self.onsite.shape], (n_blocks, 2)),
-                                gint_dtype)
-            data = np.asarray(self.onsite).flatten()
-            data = np.resize(data, [len(data) * n_blocks])
-        else:
-            if self._bound_onsite is not None:
-                onsite_matrix = self._bound_onsite
-            else:
-                onsite_matrix = self._eval_onsites(args, params)
-            data = onsite_matrix.data
-            offsets = np.asarray(onsite_matrix.block_offsets)
-            shapes = np.asarray(onsite_matrix.block_shapes)
-
-        row = np.empty(len(data), gint_dtype)
-        col = np.empty(len(data), gint_dtype)
-        for blk in range(len(offsets)):
-            blk_size = shapes[blk, 0] * shapes[blk, 1]
-            for n in range(blk_size):
-                row[k] = offsets[blk, 0] + n // shapes[blk, 1]
-                col[k] = offsets[blk, 1] + n % shapes[blk, 1]
-                k += 1
-
+        blocks, where_ptr = self._operator_blocks(args, params)
+        rows, cols, values, _ = _block_elements(blocks, where_ptr)
         norbs = _get_tot_norbs(self.syst)
-        return coo_matrix((np.asarray(data),
-                           (np.asarray(row), np.asarray(col))),
-                          shape=(norbs, norbs))
+        return coo_matrix((values, (rows, cols)), shape=(norbs, norbs))
 
 
 cdef class Current(_LocalOperator):
@@ -859,6 +1455,17 @@ cdef class Current(_LocalOperator):
         If True, then calling this operator will return a single scalar,
         otherwise a vector will be returned (see
         `~kwant.operator.Current.__call__` for details).
+    vectorize : bool, default: False
+        If True, a function given as ``where`` is called only once, with two
+        arrays of shape ``(n_hoppings, dim)`` that hold the positions of the
+        first and of the second sites of all the hoppings, and must return a
+        boolean array of length ``n_hoppings``. If ``syst`` is not a
+        finalized Builder, it receives two arrays of site indices instead.
+        A function given as ``onsite`` is called once for each site family
+        in ``where``, as ``onsite(family, positions, *args)``, and must
+        return either a single matrix for all these sites or an array of
+        shape ``(n_sites, norbs, norbs)``; this is only supported if
+        ``syst`` is a finalized Builder.
 
     Notes
     -----
@@ -876,10 +1483,11 @@ cdef class Current(_LocalOperator):
 
     @cython.embedsignature
     def __init__(self, syst, onsite=1, where=None, *,
-                 check_hermiticity=True, sum=False):
-        where = _normalize_hopping_where(syst, where)
+                 check_hermiticity=True, sum=False, vectorize=False):
+        where = _normalize_hopping_where(syst, where, vectorize)
         super().__init__(syst, onsite, where,
-                         check_hermiticity=check_hermiticity, sum=sum)
+                         check_hermiticity=check_hermiticity, sum=sum,
+                         vectorize=vectorize)
 
     @cython.embedsignature
     def bind(self, args=(), *, params=None):
@@ -887,6 +1495,8 @@ cdef class Current(_LocalOperator):
 
         Returns a copy of this operator that does not need to be passed extra
         arguments when subsequently called or when using the ``act`` method.
+        The values that are bound are evaluated using the same cache as
+        ``__call__``, under the same assumptions on the parameters.
         """
         q = super().bind(args, params=params)
         q._bound_hamiltonian = self._eval_hamiltonian(args, params)
@@ -894,67 +1504,143 @@ cdef class Current(_LocalOperator):
 
     @cython.boundscheck(False)
     @cython.wraparound(False)
-    def _operate(self, complex[:] out_data, complex[:] bra, complex[:] ket,
-                 args, operation op, *, params=None):
+    @cython.embedsignature
+    def vector_field(self, current, positions=None, *, grid=None):
+        r"""Turn a current on the hoppings into a vector field on the sites.
+
+        The current :math:`J_{ab}` through each hopping :math:`(a, b)` of
+        ``where`` is added to the field at site :math:`a` along the direction
+        of the hopping, that is the field at site :math:`a` is
+        :math:`∑_b J_{ab} (r_b - r_a) / |r_b - r_a|`.
+
+        Parameters
+        ----------
+        current : 1D array of float
+            The current through each hopping of ``where``, as returned by
+            calling this operator.
+        positions : 2D array of float, optional
+            The positions of all the sites of the system, with one row per
+            site. If not provided, the positions of the sites of ``syst`` are
+            used, which must then be a finalized Builder.
+        grid : int or sequence of int, optional
+            If provided, the field is instead summed over the cells of a
+            regular grid that spans the positions of all the sites, with
+            ``grid`` cells along each dimension.
+
+        Returns
+        -------
+        field : array of float
+            If ``grid`` is not provided, an array of shape
+            ``(n_sites, dim)``. Otherwise an array of shape
+            ``grid + (dim,)``.
+        box : sequence of 2-sequences of float
+            Only returned if ``grid`` is provided. The extents of the grid:
+            ``((x0, x1), (y0, y1), ...)``.
+        """
+        if positions is None:
+            if not hasattr(self.syst, 'sites'):
+                raise TypeError('`positions` must be provided for systems '
+                                'that are not finalized Builders.')
+            positions = _site_positions(self.syst.sites)
+        positions = np.ascontiguousarray(positions, dtype=float)
+        if positions.ndim != 2:
+            raise ValueError('`positions` must be a 2D array.')
+        current = np.ascontiguousarray(current, dtype=float)
+        if current.shape != (self.where.shape[0],):
+            raise ValueError('`current` must have one value for each '
+                             'hopping in `where`.')
+        hoppings = np.asarray(self.where)
+        if len(hoppings) and np.max(hoppings) >= len(positions):
+            raise ValueError('`positions` must have one row for each site '
+                             'of the system.')
+        n_sites, dim = positions.shape
+
+        if grid is None:
+            targets = np.arange(n_sites, dtype=gint_dtype)
+            shape = (n_sites,)
+        else:
+            shape = tuple(np.broadcast_to(grid, (dim,)))
+            if min(shape) < 1:
+                raise ValueError('`grid` must have at least one cell along '
+                                 'each dimension.')
+            lower = np.min(positions, axis=0)
+            upper = np.max(positions, axis=0)
+            extent = np.where(upper > lower, upper - lower, 1)
+            cells = np.floor((positions - lower) / extent * shape)
+            cells = np.minimum(cells.astype(int), np.array(shape) - 1)
+            targets = np.ravel_multi_index(cells.T, shape).astype(gint_dtype)
+
+        cdef double[:, ::1] field = np.zeros((np.prod(shape), dim))
+        cdef gint[:] targets_view = targets
+        cdef double[:] current_view = current
+        cdef gint[:, :] where = self.where
+        cdef double[:, :] positions_view = positions
+        if field.shape[0] and dim:
+            with nogil:
+                _accumulate_current(&field[0, 0], targets_view, current_view,
+                                    where, positions_view)
+        field_array = np.asarray(field).reshape(shape + (dim,))
+        if grid is None:
+            return field_array
+        return field_array, tuple(zip(lower, upper))
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def _operator_blocks(self, args, params):
         # prepare onsite matrices and hamiltonians
         cdef int unique_onsite = not callable(self.onsite)
         cdef complex[:, :] _tmp_mat
         cdef complex *M_a = NULL
-        cdef complex *H_ab = NULL
+        cdef gint[:] M_offsets
         cdef BlockSparseMatrix M_a_blocks, H_ab_blocks
 
         if unique_onsite:
             _tmp_mat = self.onsite
             M_a = <complex*> &_tmp_mat[0, 0]
-        elif self._bound_onsite:
-            M_a_blocks = self._bound_onsite
         else:
-            M_a_blocks = self._eval_onsites(args, params)
+            if self._bound_onsite:
+                M_a_blocks = self._bound_onsite
+            else:
+                M_a_blocks = self._eval_onsites(args, params)
+            M_a = <complex*> &M_a_blocks.data[0]
+            M_offsets = M_a_blocks.data_offsets
 
         if self._bound_hamiltonian:
             H_ab_blocks = self._bound_hamiltonian
         else:
             H_ab_blocks = self._eval_hamiltonian(args, params)
 
-        # main loop
-        cdef gint a, a_s, a_norbs, b, b_s, b_norbs
-        cdef gint i, j, k, w
-        cdef complex tmp
-        for w in range(self.where.shape[0]):
-            ### get the next hopping's start orbitals and numbers of orbitals
-            a_s = H_ab_blocks.block_offsets[w, 0]
-            b_s = H_ab_blocks.block_offsets[w, 1]
-            a_norbs = H_ab_blocks.block_shapes[w, 0]
-            b_norbs = H_ab_blocks.block_shapes[w, 1]
-            ### get the next onsite and Hamiltonian matrices
-            H_ab = H_ab_blocks.get(w)
-            if not unique_onsite:
-                M_a = M_a_blocks.get(w)
-            ### do the actual calculation
-            if op == MAT_ELS:
-                tmp = 0
-                for i in range(b_norbs):
-                    for j in range(a_norbs):
-                        for k in range(a_norbs):
-                            tmp += (bra[b_s + i].conjugate() *
-                                    H_ab[j * b_norbs + i].conjugate() *
-                                    M_a[j * a_norbs + k] * ket[a_s + k]
-                                  - bra[a_s + j].conjugate() *
-                                    M_a[j * a_norbs + k] *
-                                    H_ab[k * b_norbs + i] * ket[b_s + i])
-                out_data[w] = 1j * tmp
-            elif op == ACT:
-                for i in range(b_norbs):
-                    for j in range(a_norbs):
-                        for k in range(a_norbs):
-                            out_data[b_s + i] = (
-                                out_data[b_s + i] +
-                                1j * H_ab[j * b_norbs + i].conjugate() *
-                                M_a[j * a_norbs + k] * ket[a_s + k])
-                            out_data[a_s + j] = (
-                                out_data[a_s + j] -
-                                1j * M_a[j * a_norbs + k] * H_ab[k * b_norbs + i] *
-                                ket[b_s + i])
+        # Hopping 'w' has two blocks: 'i H_ab^† M_a' at orbitals '(b, a)',
+        # followed by '-i M_a H_ab' at orbitals '(a, b)'.
+        H_block_offsets = np.asarray(H_ab_blocks.block_offsets)
+        H_block_shapes = np.asarray(H_ab_blocks.block_shapes)
+        cdef gint[:, :] shapes = H_block_shapes
+        cdef gint[:] H_offsets = H_ab_blocks.data_offsets
+        cdef complex *H_ab = <complex*> &H_ab_blocks.data[0]
+        cdef gint n_where = self.where.shape[0]
+
+        block_offsets = np.stack([H_block_offsets[:, ::-1], H_block_offsets],
+                                 axis=1).reshape(-1, 2)
+        block_shapes = np.stack([H_block_shapes[:, ::-1], H_block_shapes],
+                                axis=1).reshape(-1, 2)
+        data_offsets = 2 * np.repeat(np.asarray(H_offsets), 2)
+        data_offsets[1::2] += np.prod(H_block_shapes, axis=1)
+        cdef complex[:] data = np.empty(2 * H_ab_blocks.data.shape[0],
+                                        dtype=complex)
+        cdef complex *P = &data[0]
+
+        cdef gint w
+        cdef complex *M_w
+        with nogil:
+            for w in prange(n_where):
+                M_w = M_a if unique_onsite else M_a + M_offsets[w]
+                _current_blocks(H_ab + H_offsets[w], M_w,
+                                shapes[w, 0], shapes[w, 1],
+                                P + 2 * H_offsets[w])
+
+        blocks = _block_sparse_matrix(block_offsets, block_shapes,
+                                      data_offsets, data)
+        return blocks, np.arange(0, 2 * n_where + 1, 2, dtype=gint_dtype)
 
 
 cdef class Source(_LocalOperator):
@@ -987,6 +1673,17 @@ cdef class Source(_LocalOperator):
         If True, then calling this operator will return a single scalar,
         otherwise a vector will be returned (see
         `~kwant.operator.Source.__call__` for details).
+    vectorize : bool, default: False
+        If True, a function given as ``where`` is called only once, with the
+        positions of all the sites as an array of shape ``(n_sites, dim)``,
+        and must return a boolean array of length ``n_sites``. If ``syst``
+        is not a finalized Builder, it receives the array of all site
+        indices instead.
+        A function given as ``onsite`` is called once for each site family
+        in ``where``, as ``onsite(family, positions, *args)``, and must
+        return either a single matrix for all these sites or an array of
+        shape ``(n_sites, norbs, norbs)``; this is only supported if
+        ``syst`` is a finalized Builder.
 
     Notes
     -----
@@ -1001,10 +1698,11 @@ cdef class Source(_LocalOperator):
 
     @cython.embedsignature
     def __init__(self, syst, onsite=1, where=None, *,
-                 check_hermiticity=True, sum=False):
-        where = _normalize_site_where(syst, where)
+                 check_hermiticity=True, sum=False, vectorize=False):
+        where = _normalize_site_where(syst, where, vectorize)
         super().__init__(syst, onsite, where,
-                         check_hermiticity=check_hermiticity, sum=sum)
+                         check_hermiticity=check_hermiticity, sum=sum,
+                         vectorize=vectorize)
 
     @cython.embedsignature
     def bind(self, args=(), *, params=None):
@@ -1012,6 +1710,8 @@ cdef class Source(_LocalOperator):
 
         Returns a copy of this operator that does not need to be passed extra
         arguments when subsequently called or when using the ``act`` method.
+        The values that are bound are evaluated using the same cache as
+        ``__call__``, under the same assumptions on the parameters.
         """
         q = super().bind(args, params=params)
         q._bound_hamiltonian = self._eval_hamiltonian(args, params)
@@ -1019,62 +1719,255 @@ cdef class Source(_LocalOperator):
 
     @cython.boundscheck(False)
     @cython.wraparound(False)
-    def _operate(self, complex[:] out_data, complex[:] bra, complex[:] ket,
-                 args, operation op, *, params=None):
+    def _operator_blocks(self, args, params):
         # prepare onsite matrices and hamiltonians
         cdef int unique_onsite = not callable(self.onsite)
         cdef complex[:, :] _tmp_mat
         cdef complex *M_a = NULL
-        cdef complex *H_aa = NULL
+        cdef gint[:] M_offsets
         cdef BlockSparseMatrix M_a_blocks, H_aa_blocks
 
         if unique_onsite:
             _tmp_mat = self.onsite
             M_a = <complex*> &_tmp_mat[0, 0]
-        elif self._bound_onsite:
-            M_a_blocks = self._bound_onsite
         else:
-            M_a_blocks = self._eval_onsites(args, params)
+            if self._bound_onsite:
+                M_a_blocks = self._bound_onsite
+            else:
+                M_a_blocks = self._eval_onsites(args, params)
+            M_a = <complex*> &M_a_blocks.data[0]
+            M_offsets = M_a_blocks.data_offsets
 
         if self._bound_hamiltonian:
             H_aa_blocks = self._bound_hamiltonian
         else:
             H_aa_blocks = self._eval_hamiltonian(args, params)
 
-        # main loop
-        cdef gint a, a_s, a_norbs
-        cdef gint i, j, k, w
-        cdef complex tmp, tmp2
-        for w in range(self.where.shape[0]):
-            ### get the next site, start orbital and number of orbitals
-            # row offsets and block size are the same as for columns, as
-            # we are only dealing with the block-diagonal part of H
-            a_s = H_aa_blocks.block_offsets[w, 0]
-            a_norbs = H_aa_blocks.block_shapes[w, 0]
-            ### get the next onsite and Hamiltonian matrices
-            H_aa = H_aa_blocks.get(w)
-            if not unique_onsite:
-                M_a = M_a_blocks.get(w)
-            ### do the actual calculation
-            if op == MAT_ELS:
-                tmp2 = 0
-                for i in range(a_norbs):
-                    tmp = 0
-                    for j in range(a_norbs):
-                        for k in range(a_norbs):
-                            tmp += (H_aa[j * a_norbs + i].conjugate() *
-                                    M_a[j * a_norbs + k] * ket[a_s + k]
-                                  - M_a[i * a_norbs + j] *
-                                    H_aa[j * a_norbs + k] * ket[a_s + k])
-                    tmp2 += bra[a_s + i].conjugate() * tmp
-                out_data[w] = 1j * tmp2
-            elif op == ACT:
-                for i in range(a_norbs):
-                    tmp = 0
-                    for j in range(a_norbs):
-                        for k in range(a_norbs):
-                            tmp += (H_aa[j * a_norbs + i].conjugate() *
-                                    M_a[j * a_norbs + k] * ket[a_s + k]
-                                  - M_a[i * a_norbs + j] *
-                                    H_aa[j * a_norbs + k] * ket[a_s + k])
-                    out_data[a_s + i] = out_data[a_s + i] + 1j * tmp
+        # The source operator has the same blocks as the onsite Hamiltonian.
+        cdef gint[:, :] shapes = H_aa_blocks.block_shapes
+        cdef gint[:] H_offsets = H_aa_blocks.data_offsets
+        cdef complex *H_aa = <complex*> &H_aa_blocks.data[0]
+        cdef complex[:] data = np.empty(H_aa_blocks.data.shape[0],
+                                        dtype=complex)
+        cdef complex *Q = &data[0]
+        cdef gint n_where = self.where.shape[0]
+
+        cdef gint w
+        cdef complex *M_w
+        with nogil:
+            for w in prange(n_where):
+                M_w = M_a if unique_onsite else M_a + M_offsets[w]
+                _source_block(H_aa + H_offsets[w], M_w, shapes[w, 0],
+                              Q + H_offsets[w])
+
+        blocks = _block_sparse_matrix(H_aa_blocks.block_offsets, shapes,
+                                      H_offsets, data)
+        return blocks, np.arange(n_where + 1, dtype=gint_dtype)
+
+
+cdef class Composite:
+    """An operator that evaluates several local operators at once.
+
+    An instance of this class can be called like a function to evaluate the
+    expectation values of all the operators with a wavefunction. See
+    `~kwant.operator.Composite.__call__` for details.
+
+    Parameters
+    ----------
+    operators : sequence of `~kwant.operator.Density`, \
+            `~kwant.operator.Current` or `~kwant.operator.Source`
+        The operators to evaluate. They must be defined on the same system,
+        and on the same sites or hoppings (their ``where`` must be equal).
+    sum : bool, default: False
+        If True, then calling this operator will return one scalar for each
+        of the ``operators``, rather than one vector.
+
+    Notes
+    -----
+    Evaluating the operators together is faster than evaluating them one
+    after the other: the sites or hoppings are visited once for all of the
+    operators, and the products of the wavefunctions on each of them are
+    computed only once. The ``sum`` of the individual operators is ignored.
+    """
+
+    cdef public object operators
+    cdef public int sum
+
+    @cython.embedsignature
+    def __init__(self, operators, *, sum=False):
+        operators = tuple(operators)
+        if not operators:
+            raise ValueError('At least one operator must be provided.')
+        if not all(isinstance(op, _LocalOperator) for op in operators):
+            raise TypeError('Only Density, Current and Source operators '
+                            'can be combined.')
+        first = operators[0]
+        for op in operators[1:]:
+            if (op.syst is not first.syst
+                or not np.array_equal(op.where, first.where)):
+                raise ValueError('The operators must be defined on the same '
+                                 'system and the same sites or hoppings.')
+        self.operators = operators
+        self.sum = sum
+
+    @property
+    def where(self):
+        return self.operators[0].where
+
+    @cython.embedsignature
+    def __call__(self, bra, ket=None, args=(), *, params=None,
+                 sum_states=False):
+        r"""Return the matrix elements of all the operators.
+
+        This is equivalent to stacking the results of calling each of the
+        operators (with the ``sum`` of this operator), but is computed in a
+        single pass over the sites or hoppings.
+
+        Parameters
+        ----------
+        bra, ket : sequence of complex, or 2D array of complex
+            Must have the same length as the number of orbitals
+            in the system, or be 2D arrays with one wavefunction per row.
+            If only one is provided, both ``bra`` and ``ket`` are taken as
+            equal. ``bra`` and ``ket`` must have the same shape.
+        args : tuple, optional
+            The arguments to pass to the system. Used to evaluate
+            the ``onsite`` elements and, possibly, the system Hamiltonian.
+            Mutually exclusive with 'params'.
+        params : dict, optional
+            Dictionary of parameter names and their values. Mutually exclusive
+            with 'args'.
+        sum_states : bool, default: False
+            If True and ``bra`` and ``ket`` are 2D, then return the sum of the
+            matrix elements over all the wavefunctions, rather than the
+            matrix elements of each wavefunction separately.
+
+        Returns
+        -------
+        An array whose first axis runs over the ``operators``. It is real if
+        all the operators check their hermiticity and ``ket`` is ``None``.
+        The remaining axes are those of the values returned by a single
+        operator.
+        """
+        cdef _LocalOperator op
+        for op in self.operators:
+            if (op._bound_onsite or op._bound_hamiltonian) and (args or params):
+                raise ValueError("Extra arguments are already bound to this "
+                                 "operator. You should call this operator "
+                                 "providing neither 'args' nor 'params'.")
+        if args and params:
+            raise TypeError("'args' and 'params' are mutually exclusive.")
+        if bra is None:
+            raise TypeError('bra must be an array')
+        first = self.operators[0]
+        bra = np.asarray(bra, dtype=complex)
+        ket = bra if ket is None else np.asarray(ket, dtype=complex)
+        tot_norbs = _get_tot_norbs(first.syst)
+        if bra.ndim not in (1, 2) or bra.shape[-1] != tot_norbs:
+            raise ValueError('bra vector is incorrect shape')
+        elif ket.shape != bra.shape:
+            raise ValueError('ket vector is incorrect shape')
+
+        bra_cols = _as_columns(bra)
+        ket_cols = bra_cols if ket is bra else _as_columns(ket)
+        n_out = 1 if sum_states else bra_cols.shape[1]
+        result = np.zeros((len(self.operators), first.where.shape[0], n_out),
+                          dtype=complex)
+        self._operate(result, bra_cols, ket_cols, args, params)
+        if bra is ket and all(op.check_hermiticity for op in self.operators):
+            result = result.real
+        if bra.ndim == 1 or sum_states:
+            result = result[..., 0]
+        else:
+            result = result.transpose(0, 2, 1)
+        return np.sum(result, axis=-1) if self.sum else result
+
+    @cython.embedsignature
+    def bind(self, args=(), *, params=None):
+        """Bind the given arguments to this operator.
+
+        Returns a copy of this operator that does not need to be passed extra
+        arguments when subsequently called.
+        """
+        if args and params:
+            raise TypeError("'args' and 'params' are mutually exclusive.")
+        return Composite([op.bind(args, params=params)
+                          for op in self.operators], sum=self.sum)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def _operate(self, complex[:, :, ::1] out_data, complex[:, ::1] bra,
+                 complex[:, ::1] ket, args, params):
+        """Add the matrix elements of all the operators to `out_data`.
+
+        `out_data` has one entry along its first axis per operator, and is
+        otherwise like the output of `_LocalOperator._operate` for
+        `MAT_ELS`.
+        """
+        blocks, where_ptrs = zip(*(op._operator_blocks(args, params)
+                                   for op in self.operators))
+        first = blocks[0]
+        for matrix, where_ptr in zip(blocks[1:], where_ptrs[1:]):
+            if not (np.array_equal(where_ptr, where_ptrs[0])
+                    and np.array_equal(matrix.block_offsets,
+                                       first.block_offsets)
+                    and np.array_equal(matrix.block_shapes,
+                                       first.block_shapes)):
+                raise ValueError('The operators must be of the same kind '
+                                 '(on sites or on hoppings).')
+
+        cdef gint[:, :] offsets = first.block_offsets
+        cdef gint[:, :] shapes = first.block_shapes
+        cdef gint[:] ptr = np.asarray(where_ptrs[0], dtype=gint_dtype)
+        cdef gint[:, ::1] data_offsets = np.array(
+            [matrix.data_offsets for matrix in blocks], dtype=gint_dtype)
+        data = [np.ascontiguousarray(matrix.data) for matrix in blocks]
+        if offsets.shape[0] == 0 or ket.shape[1] == 0:
+            return
+
+        cdef complex *out = &out_data[0, 0, 0]
+        cdef complex *bra_data = &bra[0, 0]
+        cdef complex *ket_data = &ket[0, 0]
+        cdef gint n_ops = out_data.shape[0], n_where = out_data.shape[1]
+        cdef gint n_out = out_data.shape[2], n_modes = ket.shape[1]
+        cdef gint w, k, o
+        cdef complex[::1] op_data
+        cdef complex **Q
+        cdef complex *bra_ket
+        # scratch space of each thread
+        cdef int n_threads = _max_threads()
+        cdef complex **op_data_ptrs = <complex**> malloc(
+            n_ops * sizeof(complex*))
+        cdef complex **Q_all = <complex**> malloc(
+            n_threads * n_ops * sizeof(complex*))
+        cdef complex *bra_ket_all = <complex*> malloc(
+            n_threads * n_modes * sizeof(complex))
+        try:
+            if op_data_ptrs == NULL or Q_all == NULL or bra_ket_all == NULL:
+                raise MemoryError()
+            for o in range(n_ops):
+                op_data = data[o]
+                op_data_ptrs[o] = &op_data[0]
+            with nogil, parallel(num_threads=n_threads):
+                Q = Q_all + threadid() * n_ops
+                bra_ket = bra_ket_all + threadid() * n_modes
+                for w in prange(n_where):
+                    for k in range(ptr[w], ptr[w + 1]):
+                        for o in range(n_ops):
+                            Q[o] = op_data_ptrs[o] + data_offsets[o, k]
+                        _stacked_block_mat_els(
+                            out + w * n_out, n_where * n_out, n_ops, n_out,
+                            bra_data, offsets[k, 0], shapes[k, 0],
+                            Q,
+                            ket_data, offsets[k, 1], shapes[k, 1],
+                            n_modes, bra_ket)
+        finally:
+            free(op_data_ptrs)
+            free(Q_all)
+            free(bra_ket_all)
+
+    def __getstate__(self):
+        return (self.operators, self.sum)
+
+    def __setstate__(self, state):
+        self.operators, self.sum = state
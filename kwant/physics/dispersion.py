@@ -6,11 +6,18 @@
 # the file AUTHORS.rst at the top-level directory of this distribution and at
 # http://kwant-project.org/authors.
 
-import math
 import numpy as np
+import scipy.sparse as sp
+import scipy.sparse.linalg as sla
 from .. import system
 from .._common import ensure_isinstance
 
+# MUMPS usually works best.  Use SciPy as fallback.
+try:
+    from ..linalg import mumps
+except ImportError:
+    mumps = None
+
 __all__ = ['Bands']
 
 
@@ -29,26 +36,47 @@ class Bands:
     params : dict, optional
         Dictionary of parameter names and their values. Mutually exclusive
         with 'args'.
+    sparse : bool, default: False
+        If True, the Hamiltonian of the unit cell and the hopping between
+        unit cells are stored as sparse matrices, and only the ``n_bands``
+        bands closest to ``energy`` are computed, using shift-invert Lanczos
+        iterations. This is suited to large unit cells.
+    n_bands : int, default: 10
+        The number of bands to compute. Only used if ``sparse`` is True.
+    energy : float, default: 0
+        The energy around which the bands are computed. Only used if
+        ``sparse`` is True.
 
     Notes
     -----
     An instance of this class can be called like a function.  Given a momentum
     (currently this must be a scalar as all infinite systems are quasi-1-d), it
     returns a NumPy array containing the eigenenergies of all modes at this
-    momentum
+    momentum. The bands at many momenta are computed more efficiently
+    with `~kwant.physics.Bands.evaluate`.
+
+    In the sparse mode, the Bloch Hamiltonian is factorized at each momentum
+    with MUMPS if it is available (or with SciPy otherwise). The Lanczos
+    iterations start from the eigenvectors of the previous momentum, so
+    momenta should be given in the order in which they lie along the bands.
 
     Examples
     --------
     >>> bands = kwant.physics.Bands(some_syst)
     >>> momenta = numpy.linspace(-numpy.pi, numpy.pi, 101)
-    >>> energies = [bands(k) for k in momenta]
+    >>> energies = bands.evaluate(momenta)
     >>> pyplot.plot(momenta, energies)
     >>> pyplot.show()
     """
 
-    def __init__(self, sys, args=(), *, params=None):
+    def __init__(self, sys, args=(), *, params=None, sparse=False,
+                 n_bands=10, energy=0):
         syst = sys
         ensure_isinstance(syst, system.InfiniteSystem)
+        self.sparse = sparse
+        if sparse:
+            self._init_sparse(syst, args, params, n_bands, energy)
+            return
         self.ham = syst.cell_hamiltonian(args, params=params)
         if not np.allclose(self.ham, self.ham.T.conj()):
             raise ValueError('The cell Hamiltonian is not Hermitian.')
@@ -57,9 +85,176 @@ class Bands:
         self.hop[:, : hop.shape[1]] = hop
         self.hop[:, hop.shape[1]:] = 0
 
+    def _init_sparse(self, syst, args, params, n_bands, energy):
+        ham = syst.cell_hamiltonian(args, sparse=True, params=params).tocoo()
+        difference = abs(ham - ham.T.conj())
+        if difference.nnz and (difference.max()
+                               > 1e-8 + 1e-5 * abs(ham).max()):
+            raise ValueError('The cell Hamiltonian is not Hermitian.')
+        hop = syst.inter_cell_hopping(args, sparse=True,
+                                      params=params).tocoo()
+        if not 0 < n_bands < ham.shape[0] - 1:
+            raise ValueError('n_bands must be positive and smaller than the '
+                             'number of orbitals in the unit cell minus one. '
+                             'Use sparse=False to compute all the bands.')
+        self.ham = ham.astype(complex)
+        self.hop = sp.coo_matrix((hop.data.astype(complex),
+                                  (hop.row, hop.col)), shape=ham.shape)
+        self.n_bands = n_bands
+        self.energy = energy
+
     def __call__(self, k):
-        # Note: Equation to solve is
-        #       (V^\dagger e^{ik} + H + V e^{-ik}) \psi = E \psi
-        mat = self.hop * complex(math.cos(k), -math.sin(k))
-        mat += mat.conjugate().transpose() + self.ham
-        return np.sort(np.linalg.eigvalsh(mat).real)
+        return self.evaluate([k])[0]
+
+    def evaluate(self, momenta, *, return_eigenvectors=False,
+                 return_velocities=False, chunk_size=None):
+        """Compute the energy bands at several momenta at once.
+
+        Parameters
+        ----------
+        momenta : 1D array of float
+            The momenta at which to compute the bands.
+        return_eigenvectors : bool, default: False
+            If True, also return the eigenvectors.
+        return_velocities : bool, default: False
+            If True, also return the band velocities :math:`dE/dk`, computed
+            from the eigenvectors with the Hellmann-Feynman theorem. Where
+            bands are degenerate, these are the velocities of the particular
+            eigenvectors returned by the diagonalization.
+        chunk_size : int, optional
+            The number of momenta whose Hamiltonians are diagonalized
+            together. Smaller values bound the memory usage, which is
+            proportional to ``chunk_size`` times the square of the number of
+            orbitals in the unit cell. By default, the Hamiltonians of one
+            chunk have about 2**16 elements in total. Not used in the sparse
+            mode, where the momenta are handled one after the other.
+
+        Returns
+        -------
+        energies : 2D array of float
+            The energies at each momentum, in ascending order, with shape
+            ``(len(momenta), n_orbs)``, or ``(len(momenta), n_bands)`` in
+            the sparse mode.
+        eigenvectors : 3D array of complex
+            Only returned if ``return_eigenvectors`` is True. The element
+            ``eigenvectors[i, :, n]`` is the eigenvector of the band ``n`` at
+            ``momenta[i]``.
+        velocities : 2D array of float
+            Only returned if ``return_velocities`` is True. Has the same
+            shape as ``energies``.
+        """
+        momenta = np.atleast_1d(np.asarray(momenta, dtype=float))
+        if momenta.ndim != 1:
+            raise ValueError('momenta must be a 1D array.')
+        if self.sparse:
+            return self._evaluate_sparse(momenta, return_eigenvectors,
+                                         return_velocities)
+        n_k, n_orbs = len(momenta), self.ham.shape[0]
+        if chunk_size is None:
+            chunk_size = max(2**16 // max(n_orbs, 1)**2, 1)
+        elif chunk_size < 1:
+            raise ValueError('chunk_size must be a positive integer.')
+        need_vectors = return_eigenvectors or return_velocities
+
+        energies = np.empty((n_k, n_orbs))
+        if return_eigenvectors:
+            eigenvectors = np.empty((n_k, n_orbs, n_orbs), dtype=complex)
+        if return_velocities:
+            velocities = np.empty((n_k, n_orbs))
+
+        for start in range(0, n_k, chunk_size):
+            chunk = slice(start, start + chunk_size)
+            # Note: Equation to solve is
+            #       (V^\dagger e^{ik} + H + V e^{-ik}) \psi = E \psi
+            hop = self.hop * np.exp(-1j * momenta[chunk])[:, None, None]
+            hop_dagger = hop.conj().swapaxes(1, 2)
+            mat = hop + hop_dagger + self.ham
+            if not need_vectors:
+                energies[chunk] = np.linalg.eigvalsh(mat)
+                continue
+            energies[chunk], vectors = np.linalg.eigh(mat)
+            if return_eigenvectors:
+                eigenvectors[chunk] = vectors
+            if return_velocities:
+                # dH/dk = i (V^\dagger e^{ik} - V e^{-ik})
+                ham_dk = 1j * (hop_dagger - hop)
+                velocities[chunk] = np.sum(vectors.conj() * (ham_dk @ vectors),
+                                           axis=1).real
+
+        result = [energies]
+        if return_eigenvectors:
+            result.append(eigenvectors)
+        if return_velocities:
+            result.append(velocities)
+        return result[0] if len(result) == 1 else tuple(result)
+
+    def _evaluate_sparse(self, momenta, return_eigenvectors,
+                         return_velocities):
+        ham, hop = self.ham, self.hop
+        n_k, n_orbs, n_bands = len(momenta), ham.shape[0], self.n_bands
+        energies = np.empty((n_k, n_bands))
+        if return_eigenvectors:
+            eigenvectors = np.empty((n_k, n_orbs, n_bands), dtype=complex)
+        if return_velocities:
+            velocities = np.empty((n_k, n_bands))
+
+        # H(k) - energy always has the same structure: that of 'ham', 'hop',
+        # 'hop^\dagger' and the diagonal.
+        diagonal = np.arange(n_orbs)
+        rows = np.concatenate([ham.row, hop.row, hop.col, diagonal])
+        cols = np.concatenate([ham.col, hop.col, hop.row, diagonal])
+        shift = np.full(n_orbs, -self.energy, dtype=complex)
+        solver = _ShiftInvertSolver()
+        start = None
+        for i, k in enumerate(momenta):
+            hop_k = hop.data * np.exp(-1j * k)
+            mat = sp.coo_matrix(
+                (np.concatenate([ham.data, hop_k, hop_k.conj(), shift]),
+                 (rows, cols)), shape=ham.shape)
+            inverse = sla.LinearOperator(ham.shape, matvec=solver.factor(mat),
+                                         dtype=complex)
+            vals, vecs = sla.eigsh(mat, k=n_bands, sigma=0, OPinv=inverse,
+                                   v0=start)
+            order = np.argsort(vals)
+            vals, vecs = vals[order] + self.energy, vecs[:, order]
+            # start the next iterations from the current eigenvectors
+            start = np.sum(vecs, axis=1)
+
+            energies[i] = vals
+            if return_eigenvectors:
+                eigenvectors[i] = vecs
+            if return_velocities:
+                # dH/dk = i (V^\dagger e^{ik} - V e^{-ik})
+                ham_dk = sp.coo_matrix(
+                    (np.concatenate([1j * hop_k.conj(), -1j * hop_k]),
+                     (np.concatenate([hop.col, hop.row]),
+                      np.concatenate([hop.row, hop.col]))), shape=ham.shape)
+                velocities[i] = np.sum(vecs.conj() * (ham_dk @ vecs),
+                                       axis=0).real
+
+        result = [energies]
+        if return_eigenvectors:
+            result.append(eigenvectors)
+        if return_velocities:
+            result.append(velocities)
+        return result[0] if len(result) == 1 else tuple(result)
+
+
+class _ShiftInvertSolver:
+    """Factorize a sequence of sparse matrices with the same structure.
+
+    MUMPS is used if it is available, and its analysis of the structure is
+    reused between the matrices.
+    """
+
+    def __init__(self):
+        self.context = None if mumps is None else mumps.MUMPSContext()
+        self.analyzed = False
+
+    def factor(self, mat):
+        """Factorize `mat` and return a function that solves ``mat x = b``."""
+        if self.context is None:
+            return sla.splu(mat.tocsc()).solve
+        self.context.factor(mat, reuse_analysis=self.analyzed)
+        self.analyzed = True
+        return self.context.solve
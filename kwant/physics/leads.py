@@ -21,6 +21,11 @@ from scipy.sparse import (identity as sp_identity, hstack as sp_hstack,
 
 dot = np.dot
 
+
+def herm_conj(a):
+    """Hermitian conjugate of a stack of matrices."""
+    return np.swapaxes(a, -1, -2).conj()
+
 __all__ = ['selfenergy', 'modes', 'PropagatingModes', 'StabilizedModes']
 
 
@@ -106,6 +111,9 @@ class PropagatingModes:
     block_nmodes: list of integers
         Number of left or right moving propagating modes
         per conservation law block of the Hamiltonian.
+    groups : numpy array of integers
+        Label of the group of degenerate modes (modes with the same momentum)
+        to which each mode belongs.
 
     Notes
     =====
@@ -135,6 +143,11 @@ class PropagatingModes:
     propagating modes in conservation law block `i`. The ordering of blocks
     is the same as the ordering of the projectors used to block diagonalize
     the Hamiltonian.
+
+    Modes with the same momentum in the same conservation law block form a
+    degenerate group; they are orthogonalized together and the velocity
+    operator is diagonalized within each group. `groups[i]` is the label of
+    the group of mode `i`, labels are consecutive integers starting at 0.
     """
     def __init__(self, wave_functions, velocities, momenta):
         kwargs = locals()
@@ -193,8 +206,20 @@ class StabilizedModes:
             The computed self-energy. Note that even if `h_cell` and `h_hop` are
             both real, `Sigma` will typically be complex. (More precisely, if
             there is a propagating mode, `Sigma` will definitely be complex.)
+
+        Notes
+        -----
+        The self-energy is the product ``V U L^-1 V^+``, where ``V`` is
+        `sqrt_hop`, and ``U`` and ``L`` are the parts of `vecs` and
+        `vecslmbdainv` corresponding to the outgoing and evanescent modes.
+        If `sqrt_hop` is None, ``V`` is the identity.
         """
         v = self.sqrt_hop
+        if v is None:
+            v = np.identity(self.vecs.shape[0])
+        if not self.vecs.shape[1]:
+            n = v.shape[0]
+            return np.zeros((n, n), dtype=complex)
         vecs = self.vecs[:, self.nmodes:]
         vecslmbdainv = self.vecslmbdainv[:, self.nmodes:]
         return dot(v, dot(vecs, la.solve(vecslmbdainv, v.T.conj())))
@@ -275,7 +300,8 @@ def setup_linsys(h_cell, h_hop, tol=1e6, stabilization=None):
         B_H_inv = 1.0 / B     # just a real scalar here
         A_inv = la.inv(A)
 
-        lhs = np.zeros((2*n, 2*n), dtype=np.common_type(h_cell, h_hop))
+        lhs = np.zeros((2*n, 2*n), dtype=np.common_type(h_cell, h_hop),
+                       order='F')
         lhs[:n, :n] = -dot(A_inv, h_cell) * B_H_inv
         lhs[:n, n:] = -A_inv * B
         lhs[n:, :n] = A.T.conj() * B_H_inv
@@ -353,8 +379,12 @@ def setup_linsys(h_cell, h_hop, tol=1e6, stabilization=None):
 
         # Setup the generalized eigenvalue problem.
 
-        A = np.zeros((2 * n_nonsing, 2 * n_nonsing), np.common_type(h, h_hop))
-        B = np.zeros((2 * n_nonsing, 2 * n_nonsing), np.common_type(h, h_hop))
+        # The matrices are created in Fortran order, so that LAPACK can
+        # work on them without copying.
+        A = np.zeros((2 * n_nonsing, 2 * n_nonsing), np.common_type(h, h_hop),
+                     order='F')
+        B = np.zeros((2 * n_nonsing, 2 * n_nonsing), np.common_type(h, h_hop),
+                     order='F')
 
         begin, end = slice(n_nonsing), slice(n_nonsing, None)
 
@@ -404,7 +434,7 @@ def setup_linsys(h_cell, h_hop, tol=1e6, stabilization=None):
     return Linsys(matrices, v_out, extract_wf)
 
 
-def unified_eigenproblem(a, b=None, tol=1e6):
+def unified_eigenproblem(a, b=None, tol=1e6, workspace=None):
     """A helper routine for modes(), that wraps eigenproblems.
 
     This routine wraps the regular and general eigenproblems that can arise
@@ -420,6 +450,8 @@ def unified_eigenproblem(a, b=None, tol=1e6):
     tol : float
         The tolerance for separating eigenvalues with absolute value 1 from the
         rest.
+    workspace : `~kwant.linalg.lapack.Workspace` or None
+        Work arrays for LAPACK to be reused between calls.
 
     Returns
     -------
@@ -439,22 +471,33 @@ def unified_eigenproblem(a, b=None, tol=1e6):
         eigenvector space) of the (general) Schur decomposition reordered such
         that the eigenvalues chosen by the array select are in the top left
         block.
+
+    Notes
+    -----
+    The matrices `a` and `b` are overwritten.  `ord_schur` reorders the Schur
+    decomposition in place, and therefore may only be called once, after all
+    calls to `vec_gen`.
     """
     if b is None:
         eps = np.finfo(a.dtype).eps * tol
-        t, z, ev = kla.schur(a)
+        t, z, ev = kla.schur(a, overwrite_a=True, workspace=workspace)
 
         # Right-decaying modes.
         select = abs(ev) > 1 + eps
         # Propagating modes.
         propselect = abs(abs(ev) - 1) < eps
 
-        vec_gen = lambda x: kla.evecs_from_schur(t, z, select=x)
-        ord_schur = lambda x: kla.order_schur(x, t, z, calc_ev=False)[1]
+        vec_gen = lambda x: kla.evecs_from_schur(t, z, select=x,
+                                                 workspace=workspace)
+        ord_schur = lambda x: kla.order_schur(x, t, z, calc_ev=False,
+                                              overwrite_tq=True,
+                                              workspace=workspace)[1]
 
     else:
         eps = np.finfo(np.common_type(a, b)).eps * tol
-        s, t, z, alpha, beta = kla.gen_schur(a, b, calc_q=False)
+        s, t, z, alpha, beta = kla.gen_schur(a, b, calc_q=False,
+                                             overwrite_ab=True,
+                                             workspace=workspace)
 
         # Right-decaying modes.
         select = abs(alpha) > (1 + eps) * abs(beta)
@@ -466,9 +509,12 @@ def unified_eigenproblem(a, b=None, tol=1e6):
         # Note: the division is OK here, since we later only access
         #       eigenvalues close to the unit circle
 
-        vec_gen = lambda x: kla.evecs_from_gen_schur(s, t, z=z, select=x)
+        vec_gen = lambda x: kla.evecs_from_gen_schur(s, t, z=z, select=x,
+                                                     workspace=workspace)
         ord_schur = lambda x: kla.order_gen_schur(x, s, t, z=z,
-                                                  calc_ev=False)[2]
+                                                  calc_ev=False,
+                                                  overwrite_stqz=True,
+                                                  workspace=workspace)[2]
 
     return ev, select, propselect, vec_gen, ord_schur
 
@@ -613,6 +659,36 @@ def phs_symmetrization(wfs, particle_hole):
     return new_wfs, TRIM_sort
 
 
+def degenerate_groups(lmbdainv, eps):
+    """Partition translation eigenvalues into groups of degenerate ones.
+
+    Eigenvalues are grouped if they can be connected by a chain of
+    eigenvalues whose neighbours are closer than `eps`.  Since the eigenvalues
+    occupy the unit circle, care is taken not to introduce a cut at
+    lambda = -1.
+
+    Returns
+    -------
+    groups : list of integer arrays
+        Indices into `lmbdainv` of the eigenvalues in each group.
+    """
+    if not len(lmbdainv):
+        return []
+    order = np.argsort(np.angle(lmbdainv))
+    vals = lmbdainv[order]
+    # `starts[i]` is true if the i-th sorted eigenvalue differs from the
+    # previous one (cyclically), i.e. if it is the first of its group.
+    starts = np.abs(vals - np.roll(vals, 1)) > eps
+    if not np.any(starts):
+        # The singular case of all eigenvalues equal.
+        return [order]
+    # Rotate such that the first sorted eigenvalue starts a group.
+    shift = np.argmax(starts)
+    order = np.roll(order, -shift)
+    starts = np.roll(starts, -shift)
+    return np.split(order, np.flatnonzero(starts)[1:])
+
+
 def make_proper_modes(lmbdainv, psi, extract, tol, particle_hole,
                       time_reversal, chiral):
     """
@@ -621,6 +697,9 @@ def make_proper_modes(lmbdainv, psi, extract, tol, particle_hole,
     Special care is taken of the case of degenerate k-values, where the
     numerically computed modes are typically a superposition of the real
     modes. In this case, also the proper (orthogonal) modes are computed.
+
+    The returned `PropagatingModes` has an additional attribute `groups`, an
+    integer array that labels the degenerate group of each mode.
     """
     vel_eps = np.finfo(psi.dtype).eps * tol
 
@@ -636,38 +715,31 @@ def make_proper_modes(lmbdainv, psi, extract, tol, particle_hole,
     # Calculate the full wave function in real space.
     full_psi = extract(psi, lmbdainv)
 
-    # Cast the types if any of the symmetry operators is complex
-    for symm in time_reversal, particle_hole, chiral:
-        if symm is None:
-            continue
-        full_psi = full_psi.astype(np.common_type(symm, full_psi))
-        psi = psi.astype(np.common_type(symm, psi))
+    # The rotations below typically make purely real eigenvectors complex,
+    # and so may complex symmetry operators.
+    psi = psi.astype(np.common_type(psi, np.array(1j)))
+    full_psi = full_psi.astype(np.common_type(full_psi, psi))
 
-    # Find clusters of nearby eigenvalues. Since the eigenvalues occupy the
-    # unit circle, special care has to be taken to not introduce a cut at
-    # lambda = -1.
+    # Find clusters of nearby eigenvalues.
     eps = np.finfo(lmbdainv.dtype).eps * tol
-    angles = np.angle(lmbdainv)
-    sort_order = np.resize(np.argsort(angles), (2 * len(angles,)))
-    boundaries = np.argwhere(np.abs(np.diff(lmbdainv[sort_order]))
-                             > eps).flatten() + 1
-
-    # Detect the singular case of all eigenvalues equal.
-    if boundaries.shape == (0,) and len(angles):
-        boundaries = np.array([0, len(angles)])
-
-    for interval in zip(boundaries[:-1], boundaries[1:]):
-        if interval[1] > boundaries[0] + len(angles):
-            break
-
-        indx = sort_order[interval[0] : interval[1]]
-
-        # If there is a degenerate eigenvalue with several different
-        # eigenvectors, the numerical routines return some arbitrary
-        # overlap of the real, physical solutions. In order
-        # to figure out the correct wave function, we need to
-        # have the full, not the projected wave functions
-        # (at least to our current knowledge).
+    groups = degenerate_groups(lmbdainv, eps)
+    labels = np.empty(nmodes, dtype=int)
+    for label, indx in enumerate(groups):
+        labels[indx] = label
+
+    # If there is a degenerate eigenvalue with several different eigenvectors,
+    # the numerical routines return some arbitrary overlap of the real,
+    # physical solutions. In order to figure out the correct wave function, we
+    # need to have the full, not the projected wave functions (at least to our
+    # current knowledge).  All groups of the same size are treated at once,
+    # using stacked linear algebra.
+    sizes = np.array([len(indx) for indx in groups])
+    for size in np.unique(sizes):
+        # Shape (number of groups, size).
+        indx = np.array([g for g, s in zip(groups, sizes) if s == size])
+        # Stacks of wave functions, shape (number of groups, orbitals, size).
+        full_wfs = full_psi[:, indx].transpose(1, 0, 2)
+        wfs = psi[:, indx].transpose(1, 0, 2)
 
         # Finding the true modes is done in two steps:
 
@@ -677,19 +749,21 @@ def make_proper_modes(lmbdainv, psi, extract, tol, particle_hole,
         # modes are orthogonal because of the longitudinal dependence e^{i k1
         # x} and e^{i k2 x}).  The modes with the same k are therefore
         # orthogonalized. Moreover for the velocity to have a proper value the
-        # modes should also be normalized.
-
-        q, r = la.qr(full_psi[:, indx], mode='economic')
-
-        # If the eigenvectors were purely real up to this stage,
-        # they will typically become complex after the rotation.
-        if psi.dtype != np.common_type(psi, r):
-            psi = psi.astype(np.common_type(psi, r))
-        if full_psi.dtype != np.common_type(full_psi, q):
-            full_psi = full_psi.astype(np.common_type(psi, q))
-
-        full_psi[:, indx] = q
-        psi[:, indx] = la.solve(r.T, psi[:, indx].T).T
+        # modes should also be normalized.  As stacked QR decompositions are
+        # not available, we use the eigendecomposition of the overlap matrix
+        # `Q^+ Q = U D U^+`, such that `Q U D^{-1/2}` is orthonormal.  This
+        # squares the condition number of `Q`, so groups whose modes are
+        # nearly parallel are orthonormalized with a QR decomposition instead.
+        overlap_vals, overlap_vecs = npl.eigh(herm_conj(full_wfs) @ full_wfs)
+        well_conditioned = (overlap_vals[:, 0] > overlap_vals[:, -1]
+                            * np.sqrt(np.finfo(overlap_vals.dtype).eps))
+        rot = (overlap_vecs[well_conditioned]
+               / np.sqrt(overlap_vals[well_conditioned])[:, None, :])
+        full_wfs[well_conditioned] = full_wfs[well_conditioned] @ rot
+        wfs[well_conditioned] = wfs[well_conditioned] @ rot
+        for i in np.flatnonzero(~well_conditioned):
+            full_wfs[i], r = la.qr(full_wfs[i], mode='economic')
+            wfs[i] = la.solve_triangular(r, wfs[i].T, trans='T').T
 
         # 2. Moving infinitesimally away from the degeneracy
         # point, the modes should diagonalize the velocity
@@ -701,23 +775,15 @@ def make_proper_modes(lmbdainv, psi, extract, tol, particle_hole,
         # degenerate even for a range of Bloch momenta (and hence
         # must have the same velocity). However, this does not matter,
         # since we are happy with any superposition in this case.
+        vel_op = -1j * herm_conj(wfs[:, n:]) @ wfs[:, :n]
+        vel_op = vel_op + herm_conj(vel_op)
+        vel_vals, rot = npl.eigh(vel_op)
 
-        vel_op = -1j * dot(psi[n:, indx].T.conj(), psi[:n, indx])
-        vel_op = vel_op + vel_op.T.conj()
-        vel_vals, rot = la.eigh(vel_op)
-
-        # If the eigenvectors were purely real up to this stage,
-        # they will typically become complex after the rotation.
-
-        if psi.dtype != np.common_type(psi, rot):
-            psi = psi.astype(np.common_type(psi, rot))
-        if full_psi.dtype != np.common_type(full_psi, rot):
-            full_psi = full_psi.astype(np.common_type(psi, rot))
-
-        psi[:, indx] = dot(psi[:, indx], rot)
-        full_psi[:, indx] = dot(full_psi[:, indx], rot)
+        psi[:, indx] = (wfs @ rot).transpose(1, 0, 2)
+        full_psi[:, indx] = (full_wfs @ rot).transpose(1, 0, 2)
         velocities[indx] = vel_vals
 
+    for indx in groups:
         # With particle-hole symmetry, treat TRIMs individually.
         # Particle-hole conserves velocity.
         # If P^2 = 1, we can pick modes at a TRIM as particle-hole eigenstates.
@@ -813,6 +879,7 @@ def make_proper_modes(lmbdainv, psi, extract, tol, particle_hole,
 
     velocities = velocities[order]
     momenta = momenta[order]
+    labels = labels[order]
     full_psi = full_psi[:, order]
     psi = psi[:, order]
 
@@ -871,18 +938,20 @@ def make_proper_modes(lmbdainv, psi, extract, tol, particle_hole,
     full_psi = full_psi / norm
     psi = psi / norm
 
-    return psi, PropagatingModes(full_psi, velocities, momenta)
+    prop_modes = PropagatingModes(full_psi, velocities, momenta)
+    prop_modes.groups = labels
+    return psi, prop_modes
 
 
 def compute_block_modes(h_cell, h_hop, tol, stabilization,
-                        time_reversal, particle_hole, chiral):
+                        time_reversal, particle_hole, chiral, workspace=None):
     """Calculate modes corresponding to a single projector. """
     n, m = h_hop.shape
 
     # Defer most of the calculation to helper routines.
     matrices, v, extract = setup_linsys(h_cell, h_hop, tol, stabilization)
     ev, evanselect, propselect, vec_gen, ord_schur = unified_eigenproblem(
-        *(matrices + (tol,)))
+        *(matrices + (tol, workspace)))
 
     # v is never None.
     # h_hop.shape[0] and v.shape[1] not always the same.
@@ -891,10 +960,11 @@ def compute_block_modes(h_cell, h_hop, tol, stabilization,
 
     nrightmovers = np.sum(propselect) // 2
     nevan = n - nrightmovers
-    evan_vecs = ord_schur(evanselect)[:, :nevan]
 
-    # Compute the propagating eigenvectors.
+    # Compute the propagating eigenvectors.  This must happen before
+    # reordering the Schur form, which is done in place.
     prop_vecs = vec_gen(propselect)
+    evan_vecs = ord_schur(evanselect)[:, :nevan]
     # Compute their velocity, and, if necessary, rotate them.
 
     # prop_vecs here is 'psi' in make_proper_modes, i.e. the wf in the SVD
@@ -912,8 +982,10 @@ def compute_block_modes(h_cell, h_hop, tol, stabilization,
     wave_functions = real_space_data.wave_functions
     momenta = real_space_data.momenta
     velocities = real_space_data.velocities
+    groups = real_space_data.groups
 
-    return (wave_functions, momenta, velocities, vecs, vecslmbdainv, v)
+    return (wave_functions, momenta, velocities, vecs, vecslmbdainv, v,
+            groups)
 
 
 def transform_modes(modes_data, unitary=None, time_reversal=None,
@@ -923,14 +995,15 @@ def transform_modes(modes_data, unitary=None, time_reversal=None,
     specified as can also be identity, for the case when blocks are identical.
 
     Assume that modes_data has the form returned by compute_block_modes, i.e. a
-    tuple (wave_functions, momenta, velocities, nmodes, vecs, vecslmbdainv, v)
+    tuple (wave_functions, momenta, velocities, vecs, vecslmbdainv, v, groups)
     containing the block modes data.
 
     Assume that the symmetry operator is written in the proper basis (block
     basis, not full TB).
 
     """
-    wave_functions, momenta, velocities, vecs, vecslmbdainv, v = modes_data
+    wave_functions, momenta, velocities, vecs, vecslmbdainv, v, groups = \
+        modes_data
 
     # Copy to not overwrite modes from previous blocks
     wave_functions = wave_functions.copy()
@@ -985,12 +1058,14 @@ def transform_modes(modes_data, unitary=None, time_reversal=None,
     vecslmbdainv[:, :2*nmodes] = vecslmbdainv[:, perm]
     velocities = velocities[perm]
     momenta = momenta[perm]
-    return (wave_functions, momenta, velocities, vecs, vecslmbdainv, v)
+    groups = groups[perm]
+    return (wave_functions, momenta, velocities, vecs, vecslmbdainv, v,
+            groups)
 
 
 def modes(h_cell, h_hop, tol=1e6, stabilization=None, *,
           discrete_symmetry=None, projectors=None, time_reversal=None,
-          particle_hole=None, chiral=None):
+          particle_hole=None, chiral=None, workspace=None):
     """Compute the eigendecomposition of a translation operator of a lead.
 
     Parameters
@@ -1025,6 +1100,10 @@ def modes(h_cell, h_hop, tol=1e6, stabilization=None, *,
     projectors : an iterable of sparse or dense matrices
         Projectors that block diagonalize the Hamiltonian in accordance
         with a conservation law.
+    workspace : `~kwant.linalg.lapack.Workspace` or None
+        Work arrays for the Schur decompositions.  Passing the same workspace
+        to repeated calls for leads of the same size avoids allocating the
+        work arrays anew each time.
 
     Returns
     -------
@@ -1123,7 +1202,8 @@ def modes(h_cell, h_hop, tol=1e6, stabilization=None, *,
                 continue
             # We did not compute this block yet.
             block_modes[i] = compute_block_modes(h, t, tol, stabilization,
-                                                 *symmetries)
+                                                 *symmetries,
+                                                 workspace=workspace)
         else:
             if block_modes[j] is not None:
                 # Modes in the block already computed.
@@ -1141,7 +1221,7 @@ def modes(h_cell, h_hop, tol=1e6, stabilization=None, *,
                 block_modes[j] = transform_modes(block_modes[i], unitary,
                                                  *symmetries)
     (wave_functions, momenta, velocities,
-     vecs, vecslmbdainv, sqrt_hops) = zip(*block_modes)
+     vecs, vecslmbdainv, sqrt_hops, groups) = zip(*block_modes)
 
     # Reorder by direction of propagation
     wave_functions = group_halves([(projector.dot(wf)).T for wf, projector in
@@ -1155,6 +1235,11 @@ def modes(h_cell, h_hop, tol=1e6, stabilization=None, *,
     # In the module that makes leads with conservation laws, this is necessary
     # to keep track of the block structure of the scattering matrix.
     prop_modes.block_nmodes = nmodes
+    # Label the degenerate groups of modes consecutively across all blocks.
+    offsets = np.cumsum([0] + [len(set(g)) for g in groups[:-1]])
+    prop_modes.groups = group_halves([np.unique(g, return_inverse=True)[1]
+                                      + offset
+                                      for g, offset in zip(groups, offsets)])
 
     parts = zip(*([v[:, :n], v[:, n:2*n], v[:, 2*n:]]
                   for n, v in zip(nmodes, vecs)))
@@ -6,6 +6,7 @@
 # the file AUTHORS.rst at the top-level directory of this distribution and at
 # http://kwant-project.org/authors.
 
+import numpy as np
 from numpy.testing import assert_array_almost_equal, assert_almost_equal
 from pytest import raises
 
@@ -46,3 +47,72 @@ def test_raise_nonhermitian():
     syst[lat(0), lat(1)] = complex(cos(0.2), sin(0.2))
     syst = syst.finalized()
     raises(ValueError, kwant.physics.Bands, syst)
+    raises(ValueError, kwant.physics.Bands, syst, sparse=True, n_bands=1)
+
+def test_evaluate():
+    syst = kwant.Builder(kwant.TranslationalSymmetry((-1, 0)))
+    lat = kwant.lattice.square()
+    syst[[lat(0, 0), lat(0, 1)]] = 3
+    syst[lat(0, 1), lat(0, 0)] = -1
+    syst[((lat(1, y), lat(0, y)) for y in range(2))] = -1
+    syst[lat(1, 0), lat(0, 1)] = 0.3j
+    bands = kwant.physics.Bands(syst.finalized())
+
+    momenta = np.linspace(-pi, pi, 21)
+    energies = bands.evaluate(momenta)
+    assert energies.shape == (21, 2)
+    assert_array_almost_equal(energies, [bands(k) for k in momenta])
+    # chunks give the same result
+    for chunk_size in (1, 4, 100):
+        assert_array_almost_equal(
+            bands.evaluate(momenta, chunk_size=chunk_size), energies)
+
+    energies, vectors, velocities = bands.evaluate(
+        momenta, return_eigenvectors=True, return_velocities=True)
+    for k, E, psi in zip(momenta, energies, vectors):
+        mat = bands.hop * np.exp(-1j * k)
+        mat = mat + mat.conj().T + bands.ham
+        assert_array_almost_equal(mat @ psi, psi * E)
+    # Hellmann-Feynman velocities agree with finite differences
+    dk = 1e-6
+    expected = (bands.evaluate(momenta + dk)
+                - bands.evaluate(momenta - dk)) / (2 * dk)
+    assert_array_almost_equal(velocities, expected)
+    assert_array_almost_equal(
+        bands.evaluate(momenta, return_velocities=True)[1], velocities)
+
+    raises(ValueError, bands.evaluate, momenta, chunk_size=0)
+
+
+def test_sparse_bands():
+    lat = kwant.lattice.square()
+    syst = kwant.Builder(kwant.TranslationalSymmetry((-1, 0)))
+    syst[(lat(0, y) for y in range(20))] = \
+        lambda site: 4 + kwant.digest.uniform(site.tag)
+    syst[lat.neighbors()] = -1
+    syst[lat(1, 0), lat(0, 3)] = 0.2j
+    syst = syst.finalized()
+    dense = kwant.physics.Bands(syst)
+    sparse = kwant.physics.Bands(syst, sparse=True, n_bands=4, energy=1.5)
+
+    momenta = np.linspace(-pi, pi, 11)
+    energies, vectors, velocities = sparse.evaluate(
+        momenta, return_eigenvectors=True, return_velocities=True)
+    assert energies.shape == velocities.shape == (11, 4)
+    assert vectors.shape == (11, 20, 4)
+    all_energies, all_velocities = dense.evaluate(momenta,
+                                                  return_velocities=True)
+    for k, E, psi, E_all, v_all in zip(momenta, energies, vectors,
+                                       all_energies, all_velocities):
+        closest = np.sort(np.argsort(abs(E_all - 1.5))[:4])
+        assert_array_almost_equal(E, E_all[closest])
+        assert_array_almost_equal(sparse(k), E)
+        mat = dense.hop * np.exp(-1j * k)
+        mat = mat + mat.conj().T + dense.ham
+        assert_array_almost_equal(mat @ psi, psi * E)
+    assert_array_almost_equal(velocities, all_velocities[
+        np.arange(11)[:, None],
+        np.sort(np.argsort(abs(all_energies - 1.5), axis=1)[:, :4], axis=1)])
+
+    raises(ValueError, kwant.physics.Bands, syst, sparse=True, n_bands=19)
+    raises(ValueError, kwant.physics.Bands, syst, sparse=True, n_bands=0)
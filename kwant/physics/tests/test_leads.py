@@ -265,6 +265,24 @@ def test_modes():
         2 * (stab.vecs[0] * stab.vecslmbdainv[0].conj()).imag, [1, -1])
 
 
+def test_modes_workspace():
+    rng = ensure_rng(10)
+    workspace = kwant.linalg.lapack.Workspace()
+    for stabilization in (None, (True, True), (False, False)):
+        for i in range(3):
+            h_cell = rng.randn(4, 4) + 1j * rng.randn(4, 4)
+            h_cell += h_cell.T.conj()
+            h_hop = rng.randn(4, 4)
+            h_hop[:, 2:] = 0
+            prop, stab = leads.modes(h_cell, h_hop, stabilization=stabilization)
+            prop2, stab2 = leads.modes(h_cell, h_hop,
+                                       stabilization=stabilization,
+                                       workspace=workspace)
+            assert_almost_equal(prop.velocities, prop2.velocities)
+            assert_almost_equal(prop.momenta, prop2.momenta)
+            assert_almost_equal(stab.selfenergy(), stab2.selfenergy())
+
+
 def test_modes_bearded_ribbon():
     # Check if bearded graphene ribbons work.
     lat = kwant.lattice.honeycomb()
@@ -1173,3 +1191,63 @@ def test_blocks_symm_complex_projectors():
             # If first block is empty, so is the second one.
             else:
                 assert not in_modes[rows1, cols1].size
+
+
+def test_degenerate_groups():
+    # A cluster of eigenvalues across lambda = -1 must not be split.
+    eps = 1e-10
+    lmbdainv = np.exp(1j * np.array([np.pi - eps / 4, 0.5, -np.pi + eps / 4,
+                                     0.5 + eps / 4, -0.5]))
+    groups = leads.degenerate_groups(lmbdainv, eps)
+    assert sorted(sorted(g) for g in groups) == [[0, 2], [1, 3], [4]]
+    assert [sorted(g) for g in leads.degenerate_groups(np.ones(3), eps)] \
+        == [[0, 1, 2]]
+    assert leads.degenerate_groups(np.ones(0), eps) == []
+
+
+def test_modes_groups():
+    # Three identical uncoupled chains and one distinct chain give degenerate
+    # groups of size three and one.
+    h_cell = np.diag([0., 0., 0., 0.5])
+    h_hop = -np.eye(4)
+    prop, stab = leads.modes(h_cell, h_hop)
+    current_conserving(stab)
+    groups = prop.groups
+    assert len(groups) == len(prop.momenta) == 8
+    assert sorted(np.bincount(groups)) == [1, 1, 3, 3]
+    for label in np.unique(groups):
+        indx = groups == label
+        assert np.allclose(prop.momenta[indx], prop.momenta[indx][0])
+        wfs = prop.wave_functions[:, indx]
+        wfs = wfs * np.sqrt(abs(prop.velocities[indx]))
+        assert np.allclose(wfs.T.conj().dot(wfs), np.eye(np.sum(indx)))
+
+
+def test_modes_nearly_parallel_degenerate():
+    # The eigensolver may return any basis of a degenerate subspace.  A nearly
+    # parallel basis must still give orthonormal modes.
+    h_cell = np.zeros((3, 3))
+    h_hop = -np.eye(3)
+    tol = 1e6
+    matrices, v, extract = leads.setup_linsys(h_cell, h_hop, tol)
+    ev, evanselect, propselect, vec_gen, ord_schur = \
+        leads.unified_eigenproblem(*(matrices + (tol,)))
+    lmbdainv = ev[propselect]
+    psi = vec_gen(propselect)
+    eps = np.finfo(float).eps * tol
+    groups = leads.degenerate_groups(lmbdainv, eps)
+    assert sorted(len(indx) for indx in groups) == [3, 3]
+    mixing = np.array([[1, 1, 1], [0, 1e-7, 0], [0, 0, 1e-7]])
+    for indx in groups:
+        psi[:, indx] = psi[:, indx] @ mixing
+
+    psi, prop = leads.make_proper_modes(lmbdainv, psi, extract, tol,
+                                        None, None, None)
+    for label in np.unique(prop.groups):
+        indx = prop.groups == label
+        wfs = prop.wave_functions[:, indx]
+        wfs = wfs * np.sqrt(abs(prop.velocities[indx]))
+        assert np.allclose(wfs.T.conj() @ wfs, np.eye(np.sum(indx)))
+    # The modes in the stabilized basis must match the real space ones.
+    assert np.allclose(extract(psi, np.exp(-1j * prop.momenta)),
+                       prop.wave_functions)
@@ -20,13 +20,12 @@ import sys
 import itertools
 import functools
 import warnings
-import cmath
 import numpy as np
 import tinyarray as ta
 from scipy import spatial, interpolate
 from math import cos, sin, pi, sqrt
 
-from . import system, builder, _common
+from . import system, builder, physics, _common
 
 
 __all__ = ['plot', 'map', 'bands', 'spectrum', 'current', 'density',
@@ -1395,24 +1394,10 @@ def bands(sys, args=(), momenta=65, file=None, show=True, dpi=None,
     if momenta.ndim != 1:
         momenta = np.linspace(-np.pi, np.pi, momenta)
 
-    # expand out the contents of 'physics.Bands' to get the H(k),
-    # because 'spectrum' already does the diagonalisation.
-    ham = syst.cell_hamiltonian(args, params=params)
-    if not np.allclose(ham, ham.conjugate().transpose()):
-        raise ValueError('The cell Hamiltonian is not Hermitian.')
-    _hop = syst.inter_cell_hopping(args, params=params)
-    hop = np.empty(ham.shape, dtype=complex)
-    hop[:, :_hop.shape[1]] = _hop
-    hop[:, _hop.shape[1]:] = 0
-
-    def h_k(k):
-        # H_k = H_0 + V e^-ik + V^\dagger e^ik
-        mat = hop * cmath.exp(-1j * k)
-        mat +=  mat.conjugate().transpose() + ham
-        return mat
-
-    return spectrum(h_k, ('k', momenta), file=file, show=show, dpi=dpi,
-                    fig_size=fig_size, ax=ax)
+    energies = physics.Bands(syst, args, params=params).evaluate(momenta)
+    return _plot_spectrum(('k',), (momenta,), energies, params=None,
+                          file=file, show=show, dpi=dpi, fig_size=fig_size,
+                          ax=ax)
 
 
 def spectrum(syst, x, y=None, params=None, mask=None, file=None,
@@ -1496,6 +1481,16 @@ def spectrum(syst, x, y=None, params=None, mask=None, file=None,
     new_shape = [len(v) for v in array_values] + [-1]
     spectrum = np.array(spectrum).reshape(new_shape)
 
+    return _plot_spectrum(keys, array_values, spectrum, params, file=file,
+                          show=show, dpi=dpi, fig_size=fig_size, ax=ax)
+
+
+def _plot_spectrum(keys, array_values, spectrum, params, file=None,
+                   show=True, dpi=None, fig_size=None, ax=None):
+    """Plot a spectrum computed on a grid of one or two parameters."""
+    params = params or dict()
+    y = None if len(keys) == 1 else keys[1]
+
     # set up axes
     if ax is None:
         fig = _make_figure(dpi, fig_size, use_pyplot=(file is None))
@@ -33,6 +33,47 @@ from functools import reduce
 LinearSys = namedtuple('LinearSys', ['lhs', 'rhs', 'indices', 'num_orb'])
 
 
+def _border_blocks(stab, iface_orbs, num_vars):
+    """Return the blocks that border the linear system for a lead.
+
+    Parameters
+    ----------
+    stab : `~kwant.physics.StabilizedModes`
+        The stabilized modes of the lead.
+    iface_orbs : sequence of integers
+        The orbitals of the system to which the lead is attached.
+    num_vars : integer
+        The number of variables in the system of equations to which the
+        lead blocks are added.
+
+    Returns
+    -------
+    transf : scipy.sparse.csc_matrix
+        Matrix of ones that translates the inter-cell hopping to a proper
+        hopping from the system to the lead.
+    v_sp, vdaguout_sp, lead_mat : matrices
+        The lower left, upper right, and lower right blocks of the bordered
+        system.  Eliminating the additional variables of the bordered system
+        adds the lead self-energy to the system Hamiltonian.
+    """
+    nprop = stab.nmodes
+    svd_v = stab.sqrt_hop
+    u_out = stab.vecs[:, nprop:]
+    ulinv_out = stab.vecslmbdainv[:, nprop:]
+
+    coords = np.r_[[np.arange(len(iface_orbs))], [iface_orbs]]
+    transf = sp.csc_matrix((np.ones(len(iface_orbs)), coords),
+                           shape=(len(iface_orbs), num_vars))
+
+    if svd_v is not None:
+        v_sp = sp.csc_matrix(svd_v.T.conj()) * transf
+        vdaguout_sp = transf.T * sp.csc_matrix(np.dot(svd_v, u_out))
+    else:
+        v_sp = transf
+        vdaguout_sp = transf.T * sp.csc_matrix(u_out)
+    return transf, v_sp, vdaguout_sp, -ulinv_out
+
+
 class SparseSolver(metaclass=abc.ABCMeta):
     """Solver class for computing physical quantities based on solving
     a liner system of equations.
@@ -140,12 +181,17 @@ class SparseSolver(metaclass=abc.ABCMeta):
         lead_info : list of objects
             Contains one entry for each lead.  If `realspace=False`, this is an
             instance of `~kwant.physics.PropagatingModes` with a corresponding
-            format, otherwise the lead self-energy matrix.
+            format, otherwise the lead self-energy matrix, or the
+            `~kwant.physics.StabilizedModes` of leads whose self-energy is
+            added in factored form.
 
         Notes
         -----
         All the leads should implement a method `modes` if `realspace=False`
-        and a method `selfenergy`.
+        and a method `selfenergy`.  If `realspace=True` and a lead provides
+        the method `selfenergy_factors`, the self-energy is added to the
+        system in factored form as additional variables, which keeps `lhs`
+        sparse.
 
         The system of equations that is created will be described in detail
         elsewhere.
@@ -201,35 +247,20 @@ class SparseSolver(metaclass=abc.ABCMeta):
 
                 indices.append(np.arange(lhs.shape[0], lhs.shape[0] + nprop))
 
-                u_out, ulinv_out = u[:, nprop:], ulinv[:, nprop:]
                 u_in, ulinv_in = u[:, :nprop], ulinv[:, :nprop]
 
-                # Construct a matrix of 1's that translates the
-                # inter-cell hopping to a proper hopping
-                # from the system to the lead.
                 iface_orbs = np.r_[tuple(slice(offsets[i], offsets[i + 1])
                                         for i in interface)]
 
                 n_lead_orbs = (svd_v.shape[0] if svd_v is not None
-                               else u_out.shape[0])
+                               else u.shape[0])
                 if n_lead_orbs != len(iface_orbs):
                     msg = ('Lead {0} has hopping with dimensions '
                            'incompatible with its interface dimension.')
                     raise ValueError(msg.format(leadnum))
 
-                coords = np.r_[[np.arange(len(iface_orbs))], [iface_orbs]]
-                transf = sp.csc_matrix((np.ones(len(iface_orbs)), coords),
-                                       shape=(iface_orbs.size, lhs.shape[0]))
-
-                if svd_v is not None:
-                    v_sp = sp.csc_matrix(svd_v.T.conj()) * transf
-                    vdaguout_sp = (transf.T *
-                                   sp.csc_matrix(np.dot(svd_v, u_out)))
-                    lead_mat = - ulinv_out
-                else:
-                    v_sp = transf
-                    vdaguout_sp = transf.T * sp.csc_matrix(u_out)
-                    lead_mat = - ulinv_out
+                transf, v_sp, vdaguout_sp, lead_mat = _border_blocks(
+                    stab, iface_orbs, lhs.shape[0])
 
                 lhs = sp.bmat([[lhs, vdaguout_sp], [v_sp, lead_mat]],
                               format=self.lhsformat)
@@ -247,21 +278,45 @@ class SparseSolver(metaclass=abc.ABCMeta):
                 else:
                     rhs.append(None)
             else:
-                sigma = np.asarray(lead.selfenergy(energy, args, params=params))
-                lead_info.append(sigma)
                 coords = np.r_[tuple(slice(offsets[i], offsets[i + 1])
                                       for i in interface)]
-
-                if sigma.shape != 2 * coords.shape:
-                    msg = ('Self-energy dimension for lead {0} does not '
-                           'match the total number of orbitals of the '
-                           'sites for which it is defined.')
-                    raise ValueError(msg.format(leadnum))
-
-                y, x = np.meshgrid(coords, coords)
-                sig_sparse = splhsmat((sigma.flat, [x.flat, y.flat]),
-                                      lhs.shape)
-                lhs = lhs + sig_sparse  # __iadd__ is not implemented in v0.7
+                msg = ('Self-energy dimension for lead {0} does not '
+                       'match the total number of orbitals of the '
+                       'sites for which it is defined.')
+
+                if hasattr(lead, 'selfenergy_factors'):
+                    # The self-energy V U L^-1 V^+ is added to the system
+                    # as bordering blocks, in the same way as in the modes
+                    # case above.  This avoids forming a dense block.
+                    stab = lead.selfenergy_factors(energy, args,
+                                                   params=params)
+                    n_lead_orbs = (stab.sqrt_hop.shape[0]
+                                   if stab.sqrt_hop is not None
+                                   else stab.vecs.shape[0])
+                    if n_lead_orbs != len(coords):
+                        raise ValueError(msg.format(leadnum))
+                    # The self-energy is only formed by `GreensFunction`
+                    # when it is needed.
+                    lead_info.append(stab)
+                    if stab.vecs.shape[1]:
+                        _, v_sp, vdaguout_sp, lead_mat = _border_blocks(
+                            stab, coords, lhs.shape[0])
+                        lhs = sp.bmat([[lhs, vdaguout_sp],
+                                       [v_sp, lead_mat]],
+                                      format=self.lhsformat)
+                else:
+                    sigma = np.asarray(lead.selfenergy(energy, args,
+                                                       params=params))
+                    lead_info.append(sigma)
+
+                    if sigma.shape != 2 * coords.shape:
+                        raise ValueError(msg.format(leadnum))
+
+                    y, x = np.meshgrid(coords, coords)
+                    sig_sparse = splhsmat((sigma.flat, [x.flat, y.flat]),
+                                          lhs.shape)
+                    # __iadd__ is not implemented in v0.7
+                    lhs = lhs + sig_sparse
                 indices.append(coords)
                 if leadnum in in_leads:
                     # defer formation of true rhs until the proper system
@@ -707,7 +762,7 @@ class BlockResult(metaclass=abc.ABCMeta):
             return self._transmission(lead_out, lead_in)
 
         if self.current_conserving:
-            all_but_one = len(self.lead_info) - 1
+            all_but_one = len(self.sizes) - 1
             s_t = self._transmission
             if sum(ok) == 1:
                 # Calculate the transmission element by summing over a single
@@ -735,7 +790,7 @@ class BlockResult(metaclass=abc.ABCMeta):
         This matrix is useful for calculating non-local resistances.  See
         Section 2.4 of the book by S. Datta.
         """
-        n = len(self.lead_info)
+        n = len(self.sizes)
         rn = range(n)
         result = np.array([[-self.transmission(i, j) if i != j else 0
                             for j in rn] for i in rn])
@@ -906,14 +961,54 @@ class GreensFunction(BlockResult):
 
     def __init__(self, data, lead_info, out_leads, in_leads,
                  current_conserving=False):
-        sizes = [i.shape[0] for i in lead_info]
+        # Leads whose self-energy was added to the system in factored form
+        # are given by their `~kwant.physics.StabilizedModes`.  Their
+        # self-energies are only formed when `lead_info` is accessed.
+        self._lead_factors = [None if isinstance(i, np.ndarray) else i
+                              for i in lead_info]
+        sizes = [i.shape[0] if isinstance(i, np.ndarray)
+                 else (i.vecs if i.sqrt_hop is None else i.sqrt_hop).shape[0]
+                 for i in lead_info]
         super().__init__(
             data, lead_info, out_leads, in_leads, sizes, current_conserving)
 
+    @property
+    def lead_info(self):
+        for i, info in enumerate(self._lead_info):
+            if not isinstance(info, np.ndarray):
+                self._lead_info[i] = info.selfenergy()
+        return self._lead_info
+
+    @lead_info.setter
+    def lead_info(self, lead_info):
+        self._lead_info = list(lead_info)
+
+    def _gamma(self, lead):
+        """Return the coupling ``i (Sigma - Sigma^+)`` of a lead.
+
+        For a self-energy ``V U L^-1 V^+`` in factored form, this equals
+        ``V i (X - X^+) V^+`` with ``X = U L^-1``, so the self-energy itself
+        is never formed.
+        """
+        factors = self._lead_factors[lead]
+        if factors is None:
+            selfenergy = self._lead_info[lead]
+            return 1j * (selfenergy - selfenergy.conj().T)
+        v = factors.sqrt_hop
+        vecs = factors.vecs[:, factors.nmodes:]
+        vecslmbdainv = factors.vecslmbdainv[:, factors.nmodes:]
+        if vecs.shape[1]:
+            x = np.linalg.solve(vecslmbdainv.T, vecs.T).T
+        else:
+            x = np.zeros(vecs.shape[:1] * 2, dtype=complex)
+        gamma = 1j * (x - x.conj().T)
+        if v is not None:
+            gamma = np.dot(v, np.dot(gamma, v.conj().T))
+        return gamma
+
     def num_propagating(self, lead):
         """Return the number of propagating modes in the lead."""
-        gamma = 1j * (self.lead_info[lead] -
-                      self.lead_info[lead].conj().T)
+        gamma = self._gamma(lead)
 
         # The number of channels is given by the number of
         # nonzero eigenvalues of Gamma
@@ -928,8 +1023,7 @@ class GreensFunction(BlockResult):
         gf = self.submatrix(lead_out, lead_in)
         factors = []
         for lead, gf2 in ((lead_out, gf), (lead_in, gf.conj().T)):
-            possible_se = self.lead_info[lead]
-            factors.append(1j * (possible_se - possible_se.conj().T))
+            factors.append(self._gamma(lead))
             factors.append(gf2)
         return reduce(np.dot, factors)
 
@@ -938,8 +1032,7 @@ class GreensFunction(BlockResult):
         result = np.trace(attdagainv).real
         if lead_out == lead_in:
             # For reflection we have to be more careful
-            gamma = 1j * (self.lead_info[lead_in] -
-                          self.lead_info[lead_in].conj().T)
+            gamma = self._gamma(lead_in)
             gf = self.submatrix(lead_out, lead_in)
 
             # The number of channels is given by the number of
@@ -393,6 +393,38 @@ def test_selfenergy(greens_function, smatrix):
         check_fsyst(syst)
     raises(ValueError, check_fsyst, fsyst.precalculate(what='modes'))
 
+    # Self-energies in factored form must give the same Green's function as
+    # the dense ones, also without 'sqrt_hop'.
+    class LeadWithoutSqrtHop(LeadWithOnlySelfEnergy):
+        def selfenergy_factors(self, energy, args=(), *, params=None):
+            stab = self.lead.selfenergy_factors(energy)
+            v = stab.sqrt_hop
+            return kwant.physics.StabilizedModes(
+                v.dot(stab.vecs), np.linalg.solve(v.conj().T,
+                                                  stab.vecslmbdainv),
+                stab.nmodes)
+
+    def check_factored(fsyst):
+        sol = greens_function(fsyst, 0)
+        assert_almost_equal(sol.data, gf.data)
+        # The self-energies are exposed as for the dense leads.
+        assert all(isinstance(se, np.ndarray) for se in sol.lead_info)
+        assert_almost_equal(sol.lead_info, gf.lead_info)
+        for i in range(2):
+            assert sol.num_propagating(i) == gf.num_propagating(i)
+            for j in range(2):
+                assert_almost_equal(sol.transmission(i, j),
+                                    gf.transmission(i, j))
+        assert_almost_equal(sol.conductance_matrix(), gf.conductance_matrix())
+
+    leads = fsyst.leads
+    fsyst.leads = [LeadWithOnlySelfEnergy(lead) for lead in leads]
+    gf = greens_function(fsyst, 0)
+    fsyst.leads = leads
+    check_factored(fsyst)
+    fsyst.leads = [LeadWithoutSqrtHop(lead) for lead in leads]
+    check_factored(fsyst)
+
 
 def test_selfenergy_reflection(greens_function, smatrix):
     rng = ensure_rng(4)
@@ -11,7 +11,12 @@
 __all__ = ['System', 'FiniteSystem', 'InfiniteSystem']
 
 import abc
+import heapq
+import threading
+import warnings
+import weakref
 from copy import copy
+import numpy as np
 from . import _system
 
 
@@ -80,7 +85,8 @@ class FiniteSystem(System, metaclass=abc.ABCMeta):
         the same signature as `InfiniteSystem.selfenergy` (without the
         ``self`` parameter). It may also provide ``modes`` that has the
         same signature as `InfiniteSystem.modes` (without the ``self``
-        parameter).
+        parameter), and ``selfenergy_factors`` that has the same
+        signature as `InfiniteSystem.selfenergy_factors`.
     lead_interfaces : sequence of sequences of integers
         Each sub-sequence contains the indices of the system sites
         to which the lead is connected.
@@ -163,6 +169,109 @@ class FiniteSystem(System, metaclass=abc.ABCMeta):
         result.leads = new_leads
         return result
 
+    def precalculate_grid(self, energies, args=(), leads=None, what='modes',
+                          *, params=None, tol=None, max_energies=1000):
+        """
+        Precalculate modes or self-energies in the leads on a grid of energies.
+
+        Construct a copy of the system, with the lead modes or self-energies
+        precalculated at each of the `energies`.  The leads of the copy then
+        answer requests at these energies by lookup, which speeds up repeated
+        calculations (e.g. sweeps over the parameters of the scattering
+        region) that use the same energies.
+
+        Parameters
+        ----------
+        energies : sequence of floats
+            Energies at which the modes or self-energies have to be
+            evaluated.
+        args : sequence
+            Additional parameters required for calculating the Hamiltionians.
+            Mutually exclusive with 'params'.
+        leads : sequence of integers or None
+            Numbers of the leads to be precalculated. If ``None``, all are
+            precalculated.
+        what : 'modes', 'selfenergy', 'all'
+            The quantitity to precompute. 'all' will compute both
+            modes and self-energies. Defaults to 'modes'.
+        params : dict, optional
+            Dictionary of parameter names and their values. Mutually exclusive
+            with 'args'.
+        tol : float or None
+            If provided, the self-energies are linearly interpolated between
+            the grid points.  The grid is refined by bisection until the
+            interpolated self-energy differs from the exact one by at most
+            `tol` (maximal absolute difference of the matrix elements) at the
+            middle of every interval, or until the grid has `max_energies`
+            points.  Only allowed if self-energies are precalculated.
+        max_energies : int
+            Maximal number of grid points when refining the grid.  The
+            intervals with the largest interpolation error are refined
+            first, and a ``RuntimeWarning`` is emitted if `tol` is not met
+            with this many points.
+
+        Returns
+        -------
+        syst : FiniteSystem
+            A copy of the original system with some leads precalculated.
+            The precalculated leads are instances of `GridPrecalculatedLead`.
+
+        Notes
+        -----
+        Modes are only available at the grid points; requesting them at any
+        other energy raises a ``ValueError``.  The same applies to the
+        self-energies, unless `tol` is provided.
+        """
+
+        if what not in ('modes', 'selfenergy', 'all'):
+            raise ValueError("Invalid value of argument 'what': "
+                             "{0}".format(what))
+        if tol is not None and what == 'modes':
+            raise ValueError("Interpolation is only possible if "
+                             "self-energies are precalculated.")
+
+        energies = np.unique(energies)
+        result = copy(self)
+        if leads is None:
+            leads = list(range(len(self.leads)))
+        new_leads = []
+        for nr, lead in enumerate(self.leads):
+            if nr not in leads:
+                new_leads.append(lead)
+                continue
+
+            def calculate(energy):
+                modes, selfenergy = None, None
+                if what in ('modes', 'all'):
+                    modes = lead.modes(energy, args, params=params)
+                if what in ('selfenergy', 'all'):
+                    if modes:
+                        selfenergy = modes[1].selfenergy()
+                    else:
+                        selfenergy = lead.selfenergy(energy, args,
+                                                     params=params)
+                return modes, selfenergy
+
+            data = {energy: calculate(energy) for energy in energies}
+            if tol is not None:
+                _refine_energy_grid(data, calculate, tol, max_energies)
+            lead_energies = sorted(data)
+            modes, selfenergies = zip(*(data[e] for e in lead_energies))
+            if what == 'selfenergy':
+                modes = None
+            if what == 'modes':
+                selfenergies = None
+            new_leads.append(GridPrecalculatedLead(
+                lead_energies, modes, selfenergies,
+                interpolate=tol is not None))
+        result.leads = new_leads
+        return result
+
+
+# The LAPACK work arrays of the leads, separately for each thread, as they
+# must not be shared between threads.  See `InfiniteSystem._lapack_workspace`.
+_lapack_workspaces = threading.local()
+
 
 class InfiniteSystem(System, metaclass=abc.ABCMeta):
     """Abstract infinite low-level system.
@@ -219,6 +328,26 @@ class InfiniteSystem(System, metaclass=abc.ABCMeta):
         return self.hamiltonian_submatrix(args, cell_sites, interface_sites,
                                           sparse=sparse, params=params)
 
+    def _lapack_workspace(self):
+        """Return the LAPACK work arrays of this lead for the current thread.
+
+        Reusing them avoids allocating the work arrays of the Schur
+        decompositions anew each time the modes are computed.  None is
+        returned for systems that cannot be weakly referenced.
+        """
+        from .linalg import lapack
+        try:
+            workspaces = _lapack_workspaces.leads
+        except AttributeError:
+            workspaces = _lapack_workspaces.leads = weakref.WeakKeyDictionary()
+        try:
+            workspace = workspaces.get(self)
+            if workspace is None:
+                workspace = workspaces[self] = lapack.Workspace()
+        except TypeError:
+            return None
+        return workspace
+
     def modes(self, energy=0, args=(), *, params=None):
         """Return mode decomposition of the lead
 
@@ -250,7 +379,8 @@ class InfiniteSystem(System, metaclass=abc.ABCMeta):
         # Particle-hole and chiral symmetries only apply at zero energy.
         if energy:
             symmetries.particle_hole = symmetries.chiral = None
-        return physics.modes(ham, hop, discrete_symmetry=symmetries)
+        return physics.modes(ham, hop, discrete_symmetry=symmetries,
+                             workspace=self._lapack_workspace())
 
     def selfenergy(self, energy=0, args=(), *, params=None):
         """Return self-energy of a lead.
@@ -269,6 +399,29 @@ class InfiniteSystem(System, metaclass=abc.ABCMeta):
         return physics.selfenergy(ham,
                                   self.inter_cell_hopping(args, params=params))
 
+    def selfenergy_factors(self, energy=0, args=(), *, params=None):
+        """Return the self-energy of a lead in factored form.
+
+        The self-energy is returned as a `~kwant.physics.StabilizedModes`
+        instance ``stab``, such that the self-energy equals
+        ``V U L^-1 V^+`` with ``V = stab.sqrt_hop``, ``U =
+        stab.vecs[:, stab.nmodes:]`` and ``L = stab.vecslmbdainv[:,
+        stab.nmodes:]``.  See `~kwant.physics.StabilizedModes.selfenergy`.
+
+        Solvers use this form to avoid constructing the dense self-energy
+        matrix.
+        """
+        from . import physics   # Putting this here avoids a circular import.
+        ham = self.cell_hamiltonian(args, params=params)
+        shape = ham.shape
+        assert len(shape) == 2
+        assert shape[0] == shape[1]
+        # Subtract energy from the diagonal.
+        ham.flat[::ham.shape[0] + 1] -= energy
+        return physics.modes(ham,
+                             self.inter_cell_hopping(args, params=params),
+                             workspace=self._lapack_workspace())[1]
+
 
 class PrecalculatedLead:
     def __init__(self, modes=None, selfenergy=None):
@@ -305,3 +458,179 @@ class PrecalculatedLead:
             raise ValueError("No precalculated selfenergy was provided. "
                              "Consider using precalculate() with "
                              "what='selfenergy' or what='all'")
+
+
+def _refine_energy_grid(data, calculate, tol, max_energies):
+    """Refine a grid of precalculated self-energies by bisection.
+
+    `data` is a dictionary mapping energies to the output of `calculate`,
+    a pair whose second element is the self-energy.  New grid points are
+    added to `data` in place, until linear interpolation is accurate to
+    `tol` in the middle of every interval, or `data` has `max_energies`
+    entries.  The intervals are bisected in the order of decreasing
+    interpolation error, such that the points are spent where they are
+    needed most if `max_energies` is reached.
+    """
+    energies = sorted(data)
+    # A heap of (-error, a, b), where error is the interpolation error in
+    # the middle of the interval that was bisected to obtain (a, b).  The
+    # initial intervals come first.
+    intervals = [(-np.inf, a, b) for a, b in zip(energies[:-1], energies[1:])]
+    while intervals and len(data) < max_energies:
+        _, a, b = heapq.heappop(intervals)
+        middle = (a + b) / 2
+        if middle in (a, b):
+            continue
+        data[middle] = calculate(middle)
+        interpolated = (data[a][1] + data[b][1]) / 2
+        error = np.max(np.abs(data[middle][1] - interpolated), initial=0)
+        if error > tol:
+            heapq.heappush(intervals, (-error, a, middle))
+            heapq.heappush(intervals, (-error, middle, b))
+    if intervals:
+        warnings.warn("The energy grid was not refined to the requested "
+                      "tolerance, as it reached {} points. Increase "
+                      "'max_energies' or 'tol'.".format(max_energies),
+                      RuntimeWarning, stacklevel=3)
+
+
+class GridPrecalculatedLead:
+    """A lead with modes or self-energies precalculated on an energy grid.
+
+    Parameters
+    ----------
+    energies : sequence of floats
+        The energies at which the lead was precalculated, sorted in
+        ascending order.
+    modes : sequence of pairs or None
+        For each energy, the modes of the lead as a pair
+        (`kwant.physics.PropagatingModes`, `kwant.physics.StabilizedModes`).
+    selfenergies : sequence of numpy arrays or None
+        For each energy, the self-energy of the lead.
+    interpolate : bool
+        Whether self-energies at energies between grid points are
+        obtained by linear interpolation.  Otherwise requesting such
+        energies raises an error.
+
+    Notes
+    -----
+    At least one of ``modes`` and ``selfenergies`` must be provided.  The
+    self-energies are stored as a single array of shape ``(len(energies),
+    M, M)``.  Instances are usually created using
+    `FiniteSystem.precalculate_grid`, and can be stored to and loaded from
+    disk using `save` and `load`.
+    """
+
+    _mode_attrs = (('wave_functions', 'velocities', 'momenta'),
+                   ('vecs', 'vecslmbdainv', 'nmodes', 'sqrt_hop'))
+    _optional_mode_attrs = ('block_nmodes', 'groups')
+
+    def __init__(self, energies, modes=None, selfenergies=None,
+                 interpolate=False):
+        if modes is None and selfenergies is None:
+            raise ValueError("No precalculated values provided.")
+        self.energies = np.asarray(energies, dtype=float)
+        if np.any(np.diff(self.energies) <= 0):
+            raise ValueError("Energies must be sorted and unique.")
+        if modes is not None:
+            modes = list(modes)
+            if len(modes) != len(self.energies):
+                raise ValueError("The number of modes and energies differ.")
+        if selfenergies is not None:
+            selfenergies = np.array(selfenergies, dtype=complex)
+            if len(selfenergies) != len(self.energies):
+                raise ValueError("The number of self-energies and "
+                                 "energies differ.")
+        self._modes = modes
+        self._selfenergies = selfenergies
+        self.interpolate = interpolate
+
+    def _index(self, energy):
+        i = np.searchsorted(self.energies, energy)
+        if i < len(self.energies) and self.energies[i] == energy:
+            return i
+        return None
+
+    def modes(self, energy=0, args=(), *, params=None):
+        if self._modes is None:
+            raise ValueError("No precalculated modes were provided. "
+                             "Consider using precalculate_grid() with "
+                             "what='modes' or what='all'")
+        i = self._index(energy)
+        if i is None:
+            raise ValueError("Modes were not precalculated at energy "
+                             "{0}.".format(energy))
+        return self._modes[i]
+
+    def selfenergy(self, energy=0, args=(), *, params=None):
+        if self._selfenergies is None:
+            raise ValueError("No precalculated selfenergy was provided. "
+                             "Consider using precalculate_grid() with "
+                             "what='selfenergy' or what='all'")
+        i = self._index(energy)
+        if i is not None:
+            return self._selfenergies[i]
+        i = np.searchsorted(self.energies, energy)
+        if not self.interpolate or i == 0 or i == len(self.energies):
+            raise ValueError("Self-energy was not precalculated at energy "
+                             "{0}.".format(energy))
+        a, b = self.energies[i - 1], self.energies[i]
+        weight = (energy - a) / (b - a)
+        return ((1 - weight) * self._selfenergies[i - 1] +
+                weight * self._selfenergies[i])
+
+    def save(self, file):
+        """Save the precalculated data to a file in NumPy ``.npz`` format.
+
+        Parameters
+        ----------
+        file : str or file
+            Passed on to `numpy.savez_compressed`.
+        """
+        arrays = dict(energies=self.energies, interpolate=self.interpolate)
+        if self._selfenergies is not None:
+            arrays['selfenergies'] = self._selfenergies
+        if self._modes is not None:
+            arrays['has_modes'] = True
+            for i, pair in enumerate(self._modes):
+                for modes, attrs in zip(pair, self._mode_attrs):
+                    for attr in attrs:
+                        arrays['{0}_{1}'.format(attr, i)] = getattr(modes,
+                                                                    attr)
+                for attr in self._optional_mode_attrs:
+                    value = getattr(pair[0], attr, None)
+                    if value is not None:
+                        arrays['{0}_{1}'.format(attr, i)] = value
+        np.savez_compressed(file, **arrays)
+
+    @classmethod
+    def load(cls, file):
+        """Load a lead saved with `save`.
+
+        Parameters
+        ----------
+        file : str or file
+            Passed on to `numpy.load`.
+        """
+        from . import physics   # Putting this here avoids a circular import.
+        prop_attrs, stab_attrs = cls._mode_attrs
+        with np.load(file) as data:
+            energies = data['energies']
+            selfenergies = None
+            if 'selfenergies' in data:
+                selfenergies = data['selfenergies']
+            modes = None
+            if 'has_modes' in data:
+                modes = []
+                for i in range(len(energies)):
+                    get = lambda attr: data['{0}_{1}'.format(attr, i)]
+                    prop = physics.PropagatingModes(*map(get, prop_attrs))
+                    stab = physics.StabilizedModes(*map(get, stab_attrs))
+                    stab.nmodes = int(stab.nmodes)
+                    if 'block_nmodes_{0}'.format(i) in data:
+                        prop.block_nmodes = list(get('block_nmodes'))
+                    if 'groups_{0}'.format(i) in data:
+                        prop.groups = get('groups')
+                    modes.append((prop, stab))
+            return cls(energies, modes, selfenergies,
+                       bool(data['interpolate']))
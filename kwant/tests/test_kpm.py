@@ -6,16 +6,20 @@
 # the file AUTHORS.rst at the top-level directory of this distribution and at
 # http://kwant-project.org/authors.
 
+import pickle
 from copy import copy as copy
 from types import SimpleNamespace
 
 import pytest
 import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
 import scipy.sparse.linalg as sla
 from scipy.integrate import simps
 
 import kwant
-from ..kpm import _rescale
+from ..kpm import (_rescale, _spectral_bounds, _lanczos_bounds,
+                   _gershgorin_bounds, _bounds_cache)
 from .._common import ensure_rng
 
 SpectralDensity = kwant.kpm.SpectralDensity
@@ -208,8 +212,8 @@ def test_operator_none():
 
 
 def test_bounds():
-    """Check operator=None gives the same results as operator=np.identity(),
-    with the same random vectors.
+    """Check that providing the bounds gives the same results as when
+    they are estimated, with the same random vectors.
     """
     ham = kwant.rmt.gaussian(dim)
     epsilon = 0.05
@@ -219,14 +223,39 @@ def test_bounds():
     # re initialize to obtain the same vector v0
     rng = ensure_rng(1)
     v0 = np.exp(2j * np.pi * rng.random_sample(dim))
-    lmax = float(sla.eigsh(
-        ham, k=1, which='LA', return_eigenvectors=False, tol=tol, v0=v0))
-    lmin = float(sla.eigsh(
-        ham, k=1, which='SA', return_eigenvectors=False, tol=tol, v0=v0))
+    lmin, lmax = _spectral_bounds(scipy.sparse.csr_matrix(ham), tol, v0)
     sp2 = SpectralDensity(ham, bounds=(lmin, lmax), eps=epsilon, rng=1)
+    assert_allclose(sp1.densities, sp2.densities)
 
-    # different algorithms are used so these arrays are equal up to TOL_SP
-    assert_allclose_sp(sp1.densities, sp2.densities)
+    # The estimated bounds contain the spectrum.
+    eigvals = np.linalg.eigvalsh(ham)
+    assert lmin <= eigvals[0] + TOL and eigvals[-1] <= lmax + TOL
+    assert lmax - lmin < (1 + tol) * (eigvals[-1] - eigvals[0])
+
+
+def test_spectral_bounds():
+    syst = kwant.Builder()
+    lat = kwant.lattice.square(norbs=1)
+    syst[(lat(i, j) for i in range(30) for j in range(30))] = (
+        lambda site: 2 * kwant.digest.uniform(site.tag) - 1)
+    syst[lat.neighbors()] = -1
+    ham = syst.finalized().hamiltonian_submatrix(sparse=True).tocsr()
+    eigvals = np.linalg.eigvalsh(ham.toarray())
+    lmin, lmax = _lanczos_bounds(ham, 0.01)
+    assert lmin <= eigvals[0] and eigvals[-1] <= lmax
+    assert lmax - lmin < 1.01 * (eigvals[-1] - eigvals[0])
+    # Not converged with too few Lanczos steps.
+    assert _lanczos_bounds(ham, 0.01, max_steps=10) is None
+
+    glmin, glmax = _gershgorin_bounds(ham)
+    assert -5 <= glmin <= eigvals[0] and eigvals[-1] <= glmax <= 5
+
+    # The bounds are cached for the same Hamiltonian and tolerance.
+    _bounds_cache.clear()
+    bounds = _spectral_bounds(ham, 0.01)
+    assert _spectral_bounds(ham.copy(), 0.01) is bounds
+    assert _spectral_bounds(ham, 0.02) is not bounds
+    assert _spectral_bounds(2 * ham, 0.01) is not bounds
 
 
 def test_operator_user():
@@ -562,3 +591,393 @@ def test_rescale():
     test this is that the product gives a complex number in the unit circle."""
     eigvalues, eigvectors = np.linalg.eigh(ham)
     assert np.all(1 - np.abs(np.vdot(eigvectors, rescaled_eigvectors)) < TOL)
+
+
+def test_block_size():
+    spectrum = make_spectrum(ham, p, rng=1)
+    for block_size in (1, 2, p.num_vectors + 1):
+        spectrum_block = SpectralDensity(ham, num_moments=p.num_moments,
+                                         num_vectors=p.num_vectors, rng=1,
+                                         block_size=block_size)
+        assert_allclose(spectrum_block.densities, spectrum.densities)
+
+    ham_sys = make_chain()
+    op = kwant.operator.Density(ham_sys, sum=False)
+    spectrum = make_spectrum(ham_sys, p, operator=op, rng=1)
+    spectrum_block = SpectralDensity(ham_sys, operator=op, rng=1,
+                                     num_moments=p.num_moments,
+                                     num_vectors=p.num_vectors, block_size=2)
+    assert_allclose(spectrum_block.densities, spectrum.densities)
+    spectrum.add_moments(10)
+    spectrum_block.add_moments(10)
+    assert_allclose(spectrum_block.densities, spectrum.densities)
+
+    with pytest.raises(ValueError):
+        SpectralDensity(ham, block_size=0)
+
+
+def test_n_jobs():
+    precise = copy(p)
+    precise.num_vectors = 3
+    spectrum = make_spectrum(ham, precise, rng=1)
+    spectrum_par = SpectralDensity(ham, num_moments=p.num_moments,
+                                   num_vectors=3, rng=1, n_jobs=2)
+    assert spectrum_par.block_size == 1
+    # Results are reproducible regardless of the number of processes.
+    assert np.all(spectrum_par.densities == spectrum.densities)
+    spectrum.add_vectors(3)
+    spectrum_par.add_vectors(3)
+    assert np.all(spectrum_par.densities == spectrum.densities)
+    spectrum.add_moments(10)
+    spectrum_par.add_moments(10)
+    assert np.all(spectrum_par.densities == spectrum.densities)
+
+    # Operators are passed on to the worker processes.
+    identity = np.identity(dim)
+    spectrum = make_spectrum(ham, p, operator=identity, rng=1)
+    spectrum_par = SpectralDensity(ham, operator=identity, rng=1,
+                                   num_moments=p.num_moments,
+                                   num_vectors=p.num_vectors, n_jobs=2)
+    assert np.all(spectrum_par.densities == spectrum.densities)
+
+
+def test_pickle():
+    spectrum = make_spectrum(ham, p, rng=1)
+    assert spectrum._moments_list.shape == (p.num_vectors, p.num_moments)
+    spectrum_loaded = pickle.loads(pickle.dumps(spectrum))
+    assert np.all(spectrum_loaded.densities == spectrum.densities)
+
+    # Calculations can be continued after loading.
+    for sp in (spectrum, spectrum_loaded):
+        sp.add_moments(10)
+        sp.add_vectors(2)
+    assert np.all(spectrum_loaded.densities == spectrum.densities)
+
+    syst = make_chain()
+    op = kwant.operator.Density(syst, sum=False)
+    spectrum = make_spectrum(syst, p, operator=op, rng=1)
+    assert spectrum._moments_list.shape == (p.num_vectors, p.num_moments,
+                                            dim)
+    spectrum_loaded = pickle.loads(pickle.dumps(spectrum))
+    for sp in (spectrum, spectrum_loaded):
+        sp.add_moments(10)
+    assert np.all(spectrum_loaded.densities == spectrum.densities)
+
+
+def test_operator_applied_once():
+    # Operators are applied to the random vectors once; the results
+    # are the same as calling the operators for every moment.
+    lat = kwant.lattice.square(norbs=2)
+    syst = kwant.Builder()
+    syst[(lat(i, j) for i in range(4) for j in range(3))] = (
+        lambda site: np.diag([site.pos[0], -site.pos[1]]))
+    syst[lat.neighbors()] = np.array([[1, 0.5j], [0.5j, -1]])
+    syst = syst.finalized()
+    sigma_y = np.array([[0, -1j], [1j, 0]])
+    where = [lat(3, 1), lat(0, 0), lat(2, 2)]
+
+    operators = [
+        kwant.operator.Density(syst, sigma_y),
+        kwant.operator.Density(syst, sigma_y, where=where, sum=True),
+        kwant.operator.Density(syst, sigma_y, where=where),
+        kwant.operator.Current(syst, sum=True),
+        kwant.operator.Current(syst),
+        ensure_rng(1).random_sample((24, 24)),
+    ]
+    for op in operators:
+        spectrum = make_spectrum(syst, p, operator=op, rng=1)
+        if callable(op):
+            op_call = lambda bra, ket: op(bra, ket)
+        else:
+            op_call = lambda bra, ket: np.vdot(bra, op.dot(ket))
+        spectrum_call = make_spectrum(syst, p, operator=op_call, rng=1)
+        assert_allclose(spectrum.densities, spectrum_call.densities)
+
+
+def make_qwz_torus(L, m=1):
+    """Return the Hamiltonian and velocity operators of the
+    Qi-Wu-Zhang model on an L by L torus."""
+    sx = np.array([[0, 1], [1, 0]])
+    sy = np.array([[0, -1j], [1j, 0]])
+    sz = np.array([[1, 0], [0, -1]])
+    hoppings = [((1, 0), (sz - 1j * sx) / 2), ((0, 1), (sz - 1j * sy) / 2)]
+    shape = (2 * L**2, 2 * L**2)
+    ham, vx, vy = (np.zeros(shape, complex) for i in range(3))
+    for x in range(L):
+        for y in range(L):
+            i = slice(2 * (x * L + y), 2 * (x * L + y + 1))
+            ham[i, i] = m * sz
+            for (dx, dy), hop in hoppings:
+                j = 2 * (((x + dx) % L) * L + (y + dy) % L)
+                j = slice(j, j + 2)
+                ham[j, i] += hop
+                ham[i, j] += hop.conj().T
+                for v, d in ((vx, dx), (vy, dy)):
+                    v[j, i] -= 1j * d * hop
+                    v[i, j] += 1j * d * hop.conj().T
+    return ham, vx, vy
+
+
+def test_conductivity_chern_insulator():
+    L = 8
+    ham, vx, vy = make_qwz_torus(L)
+    sigma_xy = kwant.kpm.Conductivity(ham, alpha=vx, beta=vy, rng=0)
+    # The Hall conductivity is quantized in the gap.
+    assert np.allclose(sigma_xy(mu=[-0.2, 0, 0.2]) / L**2, -1, atol=0.05)
+    assert sigma_xy(mu=[-0.2, 0.2]).shape == (2,)
+    # No conductivity for empty and full bands.
+    assert abs(sigma_xy(mu=-5)) < TOL_SP
+    assert abs(sigma_xy(mu=5) / L**2) < TOL_WEAK
+    sigma_xx = kwant.kpm.Conductivity(ham, alpha=vx, beta=vx, rng=0)
+    assert abs(sigma_xx(mu=0) / L**2) < TOL_WEAK
+    assert sigma_xx(mu=1, temperature=0.1) > 1
+
+
+def test_conductivity():
+    lat = kwant.lattice.square(norbs=2)
+    syst = kwant.Builder()
+    syst[(lat(i, j) for i in range(4) for j in range(3))] = (
+        lambda site, mu: np.diag([mu, -site.pos[1]]))
+    syst[lat.neighbors()] = np.array([[1, 0.5j], [0.5j, -1]])
+    syst = syst.finalized()
+    params = dict(mu=0.3)
+    ham = syst.hamiltonian_submatrix(params=params)
+    positions = np.repeat([s.pos for s in syst.sites], 2, axis=0)
+    vx, vy = (1j * (ham @ np.diag(x) - np.diag(x) @ ham)
+              for x in positions.T)
+
+    def basis_vectors():
+        vectors = iter(np.identity(len(ham)))
+        return lambda n: next(vectors)
+
+    num_moments = 10
+    sigma = kwant.kpm.Conductivity(syst, alpha='x', beta='y', params=params,
+                                   num_moments=num_moments,
+                                   num_vectors=len(ham),
+                                   vector_factory=basis_vectors())
+    # With the basis vectors, the moments are sums of exact traces.
+    ham_rescaled = (ham - sigma._b * np.identity(len(ham))) / sigma._a
+    chebyshev = [np.identity(len(ham)), ham_rescaled]
+    for n in range(2, num_moments):
+        chebyshev.append(2 * ham_rescaled @ chebyshev[-1] - chebyshev[-2])
+    moments = [[np.trace(vx @ t_m @ vy @ t_n) for t_n in chebyshev]
+               for t_m in chebyshev]
+    assert_allclose(sigma._moments_sum, moments)
+
+    # The velocities can also be obtained from the positions, or be given.
+    sigma_pos = kwant.kpm.Conductivity(ham, alpha='x', beta='y',
+                                       positions=positions, rng=1)
+    sigma_vel = kwant.kpm.Conductivity(ham, alpha=vx, beta=vy, rng=1)
+    mu = np.linspace(-2, 2, 5)
+    assert_allclose_sp(sigma_pos(mu), sigma_vel(mu))
+
+    # Blocks of random vectors, processes and additional random vectors.
+    sigma_block = kwant.kpm.Conductivity(ham, alpha=vx, beta=vy, rng=1,
+                                         num_vectors=5, block_size=2,
+                                         n_jobs=2)
+    sigma_block.add_vectors(5)
+    assert sigma_block.num_vectors == 10
+    assert_allclose_sp(sigma_block(mu, temperature=0.1),
+                    sigma_vel(mu, temperature=0.1))
+
+    with pytest.raises(ValueError):
+        kwant.kpm.Conductivity(ham)
+    with pytest.raises(ValueError):
+        kwant.kpm.Conductivity(syst, alpha='z', params=params)
+    with pytest.raises(ValueError):
+        kwant.kpm.Conductivity(syst, alpha='t', params=params)
+    with pytest.raises(ValueError):
+        kwant.kpm.Conductivity(ham, alpha=vx, beta=vy, block_size=0)
+    with pytest.raises(ValueError):
+        sigma(mu, temperature=-1)
+
+
+def test_propagator():
+    ham = kwant.rmt.gaussian(dim, rng=1)
+    eigvals, eigvecs = np.linalg.eigh(ham)
+
+    def exact(vectors, t):
+        phases = np.diag(np.exp(-1j * eigvals * t))
+        return eigvecs @ phases @ eigvecs.T.conj() @ vectors
+
+    rng = ensure_rng(2)
+    vectors = rng.randn(dim, 3) + 1j * rng.randn(dim, 3)
+    propagator = kwant.kpm.Propagator(ham, rng=1)
+    for t in (0, 0.1, -2, 30):
+        assert_allclose_sp(propagator(vectors, t), exact(vectors, t))
+        assert_allclose(propagator(vectors[:, 1], t),
+                        propagator(vectors, t)[:, 1])
+    # The order of the expansion grows with the time step.
+    assert (len(propagator._expansion_coefficients(30)) >
+            len(propagator._expansion_coefficients(0.1)))
+
+    times = [0.5, 1, 1.5, 4]
+    states = list(propagator.trajectory(vectors, times))
+    for state, t in zip(states, times):
+        assert_allclose_sp(state, exact(vectors, t))
+
+    # Expectation values along the trajectory.
+    syst = make_chain()
+    density = kwant.operator.Density(syst, sum=False)
+    position = np.diag(np.arange(dim))
+    psi = np.zeros(dim, complex)
+    psi[dim // 2] = 1
+    ham = syst.hamiltonian_submatrix()
+    eigvals, eigvecs = np.linalg.eigh(ham)
+    propagator = kwant.kpm.Propagator(syst)
+    densities = propagator.expectation_values(density, psi, times)
+    assert densities.shape == (len(times), dim)
+    for values, t in zip(densities, times):
+        assert_allclose_sp(values, np.abs(exact(psi, t))**2)
+    x = propagator.expectation_values(position, psi[:, None], times)
+    assert x.shape == (len(times), 1)
+    x_exact = [np.vdot(exact(psi, t), position @ exact(psi, t))
+               for t in times]
+    assert_allclose_sp(x[:, 0], x_exact)
+
+    with pytest.raises(ValueError):
+        kwant.kpm.Propagator(ham, tol=0)
+    with pytest.raises(ValueError):
+        propagator.expectation_values(None, psi, times)
+
+
+def test_probing_vectors():
+    lat = kwant.lattice.honeycomb(norbs=2)
+    syst = kwant.Builder()
+    syst[lat.shape(lambda pos: np.linalg.norm(pos) < 5, (0, 0))] = (
+        lambda site: np.diag([1, -1]) * kwant.digest.uniform(site.tag))
+    syst[lat.neighbors()] = np.array([[1, 0.2j], [0.2j, 1]])
+    syst = syst.finalized()
+    ham = syst.hamiltonian_submatrix()
+    graph_distance = scipy.sparse.csgraph.shortest_path(
+        scipy.sparse.csr_matrix(ham[::2, ::2] != 0), unweighted=True)
+
+    for distance in (1, 3):
+        for random_phases in (False, True):
+            factory = kwant.kpm.ProbingVectors(
+                syst, distance, random_phases=random_phases, rng=1)
+            colors = factory.colors
+            same_color = colors[:, None] == colors[None, :]
+            np.fill_diagonal(same_color, False)
+            assert np.all(graph_distance[same_color] > distance)
+            assert factory.num_vectors == 2 * (np.max(colors) + 1)
+
+            spectrum = SpectralDensity(syst, num_moments=10, rng=1,
+                                       num_vectors=2 * factory.num_vectors,
+                                       vector_factory=factory)
+            # The traces of the Chebyshev polynomials of degree up to
+            # 'distance' are exact.
+            ham_rescaled = ((ham - spectrum._b * np.identity(len(ham)))
+                            / spectrum._a)
+            chebyshev = [np.identity(len(ham)), ham_rescaled]
+            for n in range(2, distance + 1):
+                chebyshev.append(2 * ham_rescaled @ chebyshev[-1]
+                                 - chebyshev[-2])
+            exact = [np.trace(t_n).real for t_n in chebyshev]
+            moments = spectrum._moments() * spectrum._a
+            assert_allclose(moments[:distance + 1], exact)
+
+    with pytest.raises(ValueError):
+        kwant.kpm.ProbingVectors(syst, 0)
+    with pytest.raises(ValueError):
+        factory(3)
+
+
+def test_distance_coloring():
+    lat = kwant.lattice.cubic(norbs=1)
+    syst = kwant.Builder()
+    syst[(lat(i, j, k) for i in range(20) for j in range(20)
+          for k in range(20))] = 1
+    syst[lat.neighbors()] = 1
+    graph = syst.finalized().graph
+    adjacency = scipy.sparse.csr_matrix(
+        (np.ones(graph.num_edges), (np.array(list(graph)).T)))
+    adjacency += scipy.sparse.identity(graph.num_nodes, format='csr')
+
+    # The nodes within 'distance // 2' of a node must all have different
+    # colors, and the greedy coloring uses at most one color per node within
+    # 'distance' of a node.
+    min_colors = {1: 2, 2: 7, 3: 7}
+    max_colors = {1: 2, 2: 25, 3: 63}
+    neighborhood = adjacency
+    for distance in (1, 2, 3):
+        colors = kwant.graph.core._distance_coloring(graph, distance)
+        rows, cols = neighborhood.nonzero()
+        different = rows != cols
+        assert np.all(colors[rows[different]] != colors[cols[different]])
+        assert min_colors[distance] <= np.max(colors) + 1
+        assert np.max(colors) + 1 <= max_colors[distance]
+        neighborhood = neighborhood @ adjacency
+
+
+def test_integrate_batched():
+    fermi_distribution = kwant.kpm.fermi_distribution
+    assert fermi_distribution(0, 0, 0) == 0.5
+    assert_allclose(fermi_distribution([-1, 1], 0, [0, 0.1]),
+                    [1, 1 / (1 + np.exp(10))])
+    with pytest.raises(ValueError):
+        fermi_distribution(0, 0, -1)
+
+    mu = np.linspace(-3, 3, 7)
+    temperature = np.array([0, 0.1, 1])
+    syst = make_chain()
+    for operator in (None, kwant.operator.Density(syst),
+                     kwant.operator.Density(syst, sum=True)):
+        spectrum = make_spectrum(syst, p, operator=operator, rng=1)
+        # Scalar distribution functions are broadcast over the energies.
+        assert_allclose(spectrum.integrate(lambda e: 1), spectrum.integrate())
+        integrals = spectrum.integrate(
+            lambda e: fermi_distribution(e, mu[:, None, None],
+                                         temperature[:, None]))
+        assert integrals.shape == ((len(mu), len(temperature))
+                                   + spectrum.densities.shape[1:])
+        for i, j in np.ndindex(len(mu), len(temperature)):
+            integral = spectrum.integrate(
+                lambda e: fermi_distribution(e, mu[i], temperature[j]))
+            assert_allclose(integrals[i, j], integral)
+
+    # The cached coefficients are updated with the moments.
+    spectrum = make_spectrum(ham, p, rng=1)
+    spectrum.add_moments(10)
+    spectrum.add_vectors(2)
+    reference = SpectralDensity(ham, num_moments=p.num_moments + 10,
+                                num_vectors=p.num_vectors + 2, rng=1)
+    energies = np.linspace(-1, 1)
+    assert_allclose(spectrum(energies), reference(energies))
+
+
+def test_dtype():
+    syst = make_chain()
+    ham_real = syst.hamiltonian_submatrix(sparse=True)
+    op = kwant.operator.Density(syst, sum=False)
+    for operator in (None, op):
+        reference = {kind: make_spectrum(syst, p, operator=operator, rng=1)
+                     for kind in 'cf'}
+        reference['f'] = SpectralDensity(
+            syst, operator=operator, rng=1, num_moments=p.num_moments,
+            num_vectors=p.num_vectors, dtype=float)
+        assert reference['f'].hamiltonian.dtype == np.float64
+        assert reference['f']._rand_vects.dtype == np.float64
+        assert np.all(np.abs(reference['f']._rand_vects) == 1)
+        # Same statistics as with random phases.
+        assert_allclose(reference['f'].integrate(),
+                        reference['c'].integrate())
+        for dtype in (np.complex64, np.float32):
+            spectrum = SpectralDensity(
+                syst, operator=operator, rng=1, num_moments=p.num_moments,
+                num_vectors=p.num_vectors, dtype=dtype)
+            assert spectrum.hamiltonian.dtype == dtype
+            assert spectrum._last_two_alphas.dtype == dtype
+            kind = np.dtype(dtype).kind
+            # Accuracy check against double precision.
+            np.testing.assert_allclose(
+                spectrum.densities, reference[kind].densities,
+                atol=1e-4 * np.max(reference[kind].densities))
+
+    with pytest.raises(ValueError):
+        SpectralDensity(ham, dtype=float)
+    with pytest.raises(ValueError):
+        SpectralDensity(ham_real, dtype=int)
+    with pytest.raises(ValueError):
+        SpectralDensity(ham_real, dtype=float,
+                        vector_factory=lambda n: np.full(n, 1j))
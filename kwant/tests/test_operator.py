@@ -7,12 +7,13 @@
 # http://kwant-project.org/authors.
 
 import functools as ft
+import collections
 from collections import deque
 import pickle
 import numpy as np
 import tinyarray as ta
 import numpy.linalg as la
-from scipy.sparse import coo_matrix
+from scipy.sparse import coo_matrix, csr_matrix
 import pytest
 from pytest import raises
 # needed to get round odd bug in test_mask_interpolate
@@ -157,6 +158,95 @@ def test_operator_construction():
         A(fsyst, sum=True).sum == True
 
 
+def test_vectorized_where():
+    lat, syst = _random_square_system(4)
+    fsyst = syst.finalized()
+
+    def in_disk(site):
+        return site.pos[0]**2 + site.pos[1]**2 < 5
+
+    def in_disk_vectorized(pos):
+        return pos[:, 0]**2 + pos[:, 1]**2 < 5
+
+    for A in (ops.Density, ops.Source):
+        assert np.all(np.asarray(A(fsyst, where=in_disk).where) ==
+                      A(fsyst, where=in_disk_vectorized, vectorize=True).where)
+
+    def upwards(a, b):
+        return b.pos[1] > a.pos[1]
+
+    def upwards_vectorized(pos_a, pos_b):
+        return pos_b[:, 1] > pos_a[:, 1]
+
+    J = ops.Current(fsyst, where=upwards)
+    assert len(J.where) == 12
+    assert np.all(np.asarray(J.where) ==
+                  ops.Current(fsyst, where=upwards_vectorized,
+                              vectorize=True).where)
+    assert np.all(np.asarray(ops.Current(fsyst).where) == list(fsyst.graph))
+
+    raises(ValueError, ops.Density, fsyst, where=lambda pos: True,
+           vectorize=True)
+    raises(ValueError, ops.Current, fsyst,
+           where=lambda pos_a, pos_b: pos_a[:2, 0] > 0, vectorize=True)
+
+
+def test_family_onsite():
+    lat = kwant.lattice.honeycomb(norbs=2)
+    a, b = lat.sublattices
+    syst = kwant.Builder()
+    syst[lat.shape(lambda pos: la.norm(pos) < 3, (0, 0))] = 4 * sigma0
+    syst[lat.neighbors()] = -sigma0
+    fsyst = syst.finalized()
+    rng = np.random.RandomState(0)
+    wf = rng.randn(2, 2 * len(fsyst.sites)) * (1 + 1j)
+    params = dict(phi=0.3)
+
+    valley = {a: sigmaz, b: -sigmaz}
+
+    def valley_site(site):
+        return valley[site.family]
+
+    def valley_vectorized(family, pos):
+        return valley[family]
+
+    def texture(site, phi):
+        x, y = site.pos
+        return np.cos(phi * x) * sigmax + np.sin(phi * y) * sigmay
+
+    def texture_vectorized(family, pos, phi):
+        x, y = pos[:, 0, None, None], pos[:, 1, None, None]
+        return np.cos(phi * x) * sigmax + np.sin(phi * y) * sigmay
+
+    for A in opservables:
+        reference = A(fsyst, valley_site)(wf)
+        assert np.allclose(A(fsyst, valley)(wf), reference)
+        A_vec = A(fsyst, valley_vectorized, vectorize=True)
+        assert np.allclose(A_vec(wf), reference)
+
+        reference = A(fsyst, texture)(wf, params=params)
+        A_vec = A(fsyst, texture_vectorized, vectorize=True)
+        assert A_vec._onsite_param_names == ('phi',)
+        assert np.allclose(A_vec(wf, params=params), reference)
+        assert np.allclose(A_vec.bind(params=params)(wf), reference)
+        assert np.allclose(A_vec(wf, args=(0.3,)), reference)
+        assert np.allclose(A_vec.onsite(3, 0.3),
+                           texture(fsyst.sites[3], 0.3))
+
+    # only the distinct onsite matrices are stored
+    for onsite, vectorize in [(valley, False), (valley_vectorized, True)]:
+        rho = ops.Density(fsyst, onsite, vectorize=vectorize)
+        blocks, _ = rho._operator_blocks((), None)
+        assert len(blocks.data) == 2 * 4
+        assert np.allclose(rho.tocoo().toarray(),
+                           ops.Density(fsyst, valley_site).tocoo().toarray())
+
+    # wrong shapes and non-hermitian matrices are caught
+    for value in (sigma0[:, :1], [sigma0] * 2, 1j * sigmax):
+        rho = ops.Density(fsyst, lambda family, pos: value, vectorize=True)
+        raises((ValueError, kwant.UserCodeError), rho, wf[0])
+
+
 def _test(A, bra, ket=None, per_el_val=None, reduced_val=None, args=()):
     if per_el_val is not None:
         val = A(bra, ket, args=args)
@@ -377,6 +467,48 @@ def test_opservables_gauged():
     _test(spin_current_gauge, down, per_el_val=1)
 
 
+@pytest.mark.parametrize("A", opservables)
+def test_many_wavefunctions(A):
+    lat = kwant.lattice.square(norbs=2)
+    syst = kwant.Builder()
+    syst[(lat(i, j) for i in range(4) for j in range(4))] = (
+        lambda site: kwant.digest.uniform(site.tag) * sigmax + sigmaz)
+    syst[lat.neighbors()] = (
+        lambda a, b: -sigma0 + 1j * kwant.digest.uniform(a.tag) * sigmay)
+    fsyst = syst.finalized()
+    onsite = lambda site: kwant.digest.uniform(site.tag, 'x') * sigmay
+    op = A(fsyst, onsite)
+
+    rng = np.random.RandomState(0)
+    shape = (3, 2 * len(fsyst.sites))
+    bras = rng.randn(*shape) + 1j * rng.randn(*shape)
+    kets = rng.randn(*shape) + 1j * rng.randn(*shape)
+
+    # one result per row of the wavefunctions
+    expected = np.array([op(bra, ket) for bra, ket in zip(bras, kets)])
+    assert np.allclose(op(bras, kets), expected)
+    assert np.allclose(op(bras, kets, sum_states=True), expected.sum(axis=0))
+    expected = np.array([op(bra) for bra in bras])
+    result = op(bras)
+    assert np.isrealobj(result)
+    assert np.allclose(result, expected)
+    expected = np.array([op.act(ket) for ket in kets])
+    assert np.allclose(op.act(kets), expected)
+
+    # also for bound operators and operators with 'sum=True'
+    op = A(fsyst, onsite, sum=True).bind()
+    expected = np.array([op(bra, ket) for bra, ket in zip(bras, kets)])
+    assert np.allclose(op(bras, kets), expected)
+    assert np.allclose(op(bras, kets, sum_states=True), expected.sum())
+
+    # a single wavefunction as a 2D array
+    assert np.allclose(op(bras[:1], kets[:1]), expected[:1])
+
+    raises(ValueError, op, bras, kets[:2])
+    raises(ValueError, op, bras[..., None])
+    raises(ValueError, op.act, kets[:, :-1])
+
+
 def test_tocoo():
     syst = kwant.Builder()
     lat1 = kwant.lattice.chain(norbs=1)
@@ -409,6 +541,227 @@ def test_tocoo():
     raises(ValueError, op.tocoo, [1])
 
 
+@pytest.mark.parametrize("A", opservables)
+def test_tocsr(A):
+    lat = kwant.lattice.chain(norbs=2)
+    syst = kwant.Builder()
+    syst[(lat(i) for i in range(5))] = lambda site, B: B * sigmaz + sigmax
+    syst[lat.neighbors()] = -sigma0 + 0.5j * sigmay
+    fsyst = syst.finalized()
+    params = dict(B=0.3)
+    N = 2 * len(fsyst.sites)
+
+    rng = np.random.RandomState(0)
+    bra = rng.randn(N, 3) + 1j * rng.randn(N, 3)
+    ket = rng.randn(N, 3) + 1j * rng.randn(N, 3)
+
+    for onsite in (sigmay, lambda site, B: B * sigmay):
+        op = A(fsyst, onsite)
+        matrix, where_map = op.tocsr(params=params, where_map=True)
+        assert isinstance(matrix, csr_matrix)
+        assert matrix.shape == (N, N)
+        assert where_map.shape == (len(op.where), matrix.nnz)
+        # the columns of the dense matrix are the action on the basis vectors
+        dense = op.act(np.eye(N), params=params).T
+        assert np.allclose(matrix.toarray(), dense)
+        assert np.allclose(op.bind(params=params).tocsr().toarray(), dense)
+
+        rows = np.repeat(np.arange(N), np.diff(matrix.indptr))
+        values = where_map @ (bra[rows].conj() * ket[matrix.indices])
+        assert np.allclose(values, op(bra.T, ket.T, params=params).T)
+        op = A(fsyst, onsite, sum=True)
+        assert np.allclose((bra.conj() * (matrix @ ket)).sum(axis=0),
+                           op(bra.T, ket.T, params=params))
+
+    # only part of the system
+    where = [(lat(1), lat(0))] if A is ops.Current else [lat(0)]
+    op = A(fsyst, sigmay, where=where)
+    assert np.allclose(op.tocsr(params=params).toarray(),
+                       op.act(np.eye(N), params=params).T)
+
+    op = A(fsyst, lambda site, B: B * sigmay)
+    raises(TypeError, op.tocsr, (0.3,), params=params)
+    raises(ValueError, op.bind(params=params).tocsr, params=params)
+
+
+@pytest.mark.parametrize("A", opservables)
+def test_cached_evaluation(A):
+    calls = collections.Counter()
+
+    def onsite(site, B, E):
+        calls['system'] += 1
+        return B * sigmaz + E * sigma0
+
+    def hopping(a, b, t):
+        calls['system'] += 1
+        return -t * sigma0
+
+    def spin(site, theta):
+        calls['operator'] += 1
+        return np.cos(theta) * sigmaz + np.sin(theta) * sigmax
+
+    lat = kwant.lattice.chain(norbs=2)
+    syst = kwant.Builder()
+    syst[(lat(i) for i in range(4))] = onsite
+    syst[lat.neighbors()] = hopping
+    fsyst = syst.finalized()
+    op = A(fsyst, spin)
+    wf = np.random.RandomState(0).randn(2 * len(fsyst.sites))
+
+    def evaluate(**params):
+        calls.clear()
+        result = op(wf, params=params)
+        return result, dict(calls)
+
+    params = dict(B=0.1, E=0.2, t=1., theta=0.5)
+    first, first_calls = evaluate(**params)
+    assert first_calls['operator'] > 0
+    # the same parameters: nothing is evaluated again
+    second, second_calls = evaluate(**params)
+    assert second_calls == {} and np.all(first == second)
+    # parameters that the operator does not depend on are ignored
+    if A is ops.Density:
+        relevant = ('theta',)
+    elif A is ops.Current:
+        relevant = ('t', 'theta')
+    else:
+        relevant = ('B', 'E', 'theta')
+    for name in params:
+        _, new_calls = evaluate(**dict(params, **{name: 0.3}))
+        assert bool(new_calls) == (name in relevant)
+    # arrays are compared by their values, the least recently used entries
+    # are dropped
+    evaluate(**dict(params, theta=np.array(0.5)))
+    assert evaluate(**dict(params, theta=np.array(0.5)))[1] == {}
+    for theta in np.linspace(1, 2, ops._cache_size + 1):
+        evaluate(**dict(params, theta=theta))
+    assert evaluate(**params)[1]['operator'] > 0
+    # positional arguments
+    syst[(lat(i) for i in range(4))] = sigmaz
+    syst[lat.neighbors()] = -sigma0
+    op = A(syst.finalized(), spin)
+    result = op(wf, args=(0.5,))
+    calls.clear()
+    assert np.all(op(wf, args=(0.5,)) == result)
+    assert calls == {}
+
+
+def test_cached_evaluation_mutable():
+    lat = kwant.lattice.chain(norbs=1)
+    syst = kwant.Builder()
+    syst[(lat(i) for i in range(4))] = 0
+    fsyst = syst.finalized()
+    wf = np.ones(4)
+
+    # objects that may be mutated are not used for caching
+    class Potential:
+        scale = 1
+
+    pot = Potential()
+    rho = ops.Density(fsyst, lambda site, pot: pot.scale, sum=True)
+    assert rho(wf, params=dict(pot=pot)) == 4
+    pot.scale = 3
+    assert rho(wf, params=dict(pot=pot)) == 12
+    assert rho.bind(params=dict(pot=pot))(wf) == 12
+    pot.scale = [1]
+    rho = ops.Density(fsyst, lambda site, pot: pot.scale[0], sum=True)
+    rho(wf, params=dict(pot=pot))
+    pot.scale[0] = 2
+    assert rho(wf, params=dict(pot=pot)) == 8
+
+    # numbers are distinguished by their type and sign
+    rho = ops.Density(fsyst, lambda site, x: np.copysign(1, x) + (x is True),
+                      sum=True)
+    assert rho(wf, params=dict(x=0.)) == 4
+    assert rho(wf, params=dict(x=-0.)) == -4
+    assert rho(wf, params=dict(x=1)) == 4
+    assert rho(wf, params=dict(x=True)) == 8
+
+
+def test_vector_field():
+    lat, syst = _random_square_system(4)
+    # a hopping that is not along the lattice vectors
+    syst[lat(0, 0), lat(3, 2)] = -0.5j
+    fsyst = syst.finalized()
+    rng = np.random.RandomState(0)
+    psi = rng.randn(len(fsyst.sites)) + 1j * rng.randn(len(fsyst.sites))
+    positions = np.array([site.pos for site in fsyst.sites])
+
+    for where in (None, lambda a, b: a.pos[0] < 2):
+        J = ops.Current(fsyst, where=where)
+        current = J(psi)
+        expected = np.zeros_like(positions)
+        for (a, b), J_ab in zip(np.asarray(J.where), current):
+            direction = positions[b] - positions[a]
+            expected[a] += J_ab * direction / la.norm(direction)
+        assert np.allclose(J.vector_field(current), expected)
+        # given positions
+        assert np.allclose(J.vector_field(current, 2 * positions), expected)
+        # on a grid: every cell holds the sum over its sites
+        for grid in (1, 2, (4, 2)):
+            field, box = J.vector_field(current, grid=grid)
+            shape = np.broadcast_to(grid, 2)
+            assert field.shape == tuple(shape) + (2,)
+            assert np.allclose(box, [(0, 3), (0, 3)])
+            cells = np.minimum(positions / 3 * shape, shape - 1).astype(int)
+            expected_field = np.zeros_like(field)
+            np.add.at(expected_field, tuple(cells.T), expected)
+            assert np.allclose(field, expected_field)
+
+    raises(ValueError, J.vector_field, current[:-1])
+    raises(ValueError, J.vector_field, current, positions[:2])
+
+
+def test_composite():
+    lat = kwant.lattice.square(norbs=2)
+    syst = kwant.Builder()
+    syst[(lat(i, j) for i in range(4) for j in range(4))] = random_onsite
+    syst[lat.neighbors()] = random_hopping
+    fsyst = syst.finalized()
+    rng = np.random.RandomState(0)
+    shape = (3, 2 * len(fsyst.sites))
+    wfs = rng.randn(*shape) + 1j * rng.randn(*shape)
+    params = dict(theta=0.3)
+
+    def spin(site, theta):
+        return np.cos(theta) * sigmaz + np.sin(theta) * sigmax
+
+    on_sites = [ops.Density(fsyst), ops.Density(fsyst, sigmaz),
+                ops.Density(fsyst, spin), ops.Source(fsyst, sigmay)]
+    on_hoppings = [ops.Current(fsyst), ops.Current(fsyst, sigmaz),
+                   ops.Current(fsyst, spin)]
+
+    for operators in (on_sites, on_hoppings):
+        composite = ops.Composite(operators)
+        summed = ops.Composite(operators, sum=True)
+        for bra, ket in [(wfs[0], None), (wfs[0], wfs[1]), (wfs, None),
+                         (wfs, wfs[::-1])]:
+            for sum_states in (False, True):
+                expected = np.array([A(bra, ket, params=params,
+                                       sum_states=sum_states)
+                                     for A in operators])
+                kwargs = dict(params=params, sum_states=sum_states)
+                result = composite(bra, ket, **kwargs)
+                assert result.shape == expected.shape
+                assert result.dtype == expected.dtype
+                assert np.allclose(result, expected)
+                assert np.allclose(summed(bra, ket, **kwargs),
+                                   np.sum(expected, axis=-1))
+        bound = composite.bind(params=params)
+        assert np.allclose(bound(wfs), composite(wfs, params=params))
+        raises(ValueError, bound, wfs, params=params)
+        picklable = ops.Composite(operators[:2]).bind()
+        loaded = pickle.loads(pickle.dumps(picklable))
+        assert np.all(loaded(wfs) == picklable(wfs))
+
+    # the operators must be compatible
+    raises(ValueError, ops.Composite, [])
+    raises(TypeError, ops.Composite, [ops.Density(fsyst), sigmaz])
+    raises(ValueError, ops.Composite, on_sites + on_hoppings)
+    raises(ValueError, ops.Composite,
+           [ops.Density(fsyst), ops.Density(fsyst, where=fsyst.sites[:2])])
+
+
 @pytest.mark.parametrize("A", opservables)
 def test_arg_passing(A):
     lat1 = kwant.lattice.chain(norbs=1)
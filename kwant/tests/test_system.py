@@ -8,7 +8,8 @@
 
 import pickle
 import copy
-from pytest import raises
+import threading
+from pytest import raises, warns
 import numpy as np
 from scipy import sparse
 import kwant
@@ -102,3 +103,106 @@ def test_pickling():
     s = kwant.smatrix(syst, 0.1)
     for other in (syst_copy1, syst_copy2, syst_copy3, syst_copy4):
         assert np.all(kwant.smatrix(other, 0.1).data == s.data)
+
+
+def test_lapack_workspace():
+    lat = kwant.lattice.square(norbs=1)
+    lead = kwant.Builder(kwant.TranslationalSymmetry((-1, 0)))
+    lead[(lat(0, j) for j in range(3))] = 4
+    lead[lat.neighbors()] = -1
+    lead = lead.finalized()
+
+    # The work arrays are kept for each lead and each thread.
+    workspace = lead._lapack_workspace()
+    assert workspace is lead._lapack_workspace()
+    prop, stab = lead.modes(1)
+    assert workspace._arrays
+    other = []
+    thread = threading.Thread(
+        target=lambda: other.append(lead._lapack_workspace()))
+    thread.start()
+    thread.join()
+    assert other[0] is not workspace
+
+    # Reusing them gives the same results.
+    for modes in (lead.modes(1), kwant.physics.modes(
+            lead.cell_hamiltonian() - np.eye(3), lead.inter_cell_hopping())):
+        np.testing.assert_array_equal(modes[0].wave_functions,
+                                      prop.wave_functions)
+        np.testing.assert_array_equal(modes[1].vecs, stab.vecs)
+    np.testing.assert_array_equal(lead.selfenergy_factors(1).vecs, stab.vecs)
+
+
+def test_precalculate_grid(tmpdir):
+    lat = kwant.lattice.square(norbs=1)
+    syst = kwant.Builder()
+    syst[(lat(i, j) for i in range(3) for j in range(3))] = 4
+    syst[lat.neighbors()] = -1
+    lead = kwant.Builder(kwant.TranslationalSymmetry((-1, 0)))
+    lead[(lat(0, j) for j in range(3))] = 4
+    lead[lat.neighbors()] = -1
+    syst.attach_lead(lead)
+    syst.attach_lead(lead.reversed())
+    syst = syst.finalized()
+    energies = [0.5, 1, 1.5]
+
+    grid_syst = syst.precalculate_grid(energies, what='all')
+    for energy in energies:
+        np.testing.assert_almost_equal(
+            kwant.smatrix(grid_syst, energy).data,
+            kwant.smatrix(syst, energy).data)
+        np.testing.assert_almost_equal(
+            kwant.greens_function(grid_syst, energy).data,
+            kwant.greens_function(syst, energy).data)
+    raises(ValueError, kwant.smatrix, grid_syst, 0.7)
+    raises(ValueError, kwant.greens_function, grid_syst, 0.7)
+    raises(ValueError, syst.precalculate_grid, energies, tol=1e-3)
+    raises(ValueError, kwant.smatrix,
+           syst.precalculate_grid(energies, what='selfenergy'), 1)
+
+    # Interpolation of the self-energy with adaptive refinement.
+    tol = 1e-4
+    grid_syst = syst.precalculate_grid(energies, what='selfenergy', tol=tol)
+    assert len(grid_syst.leads[0].energies) > len(energies)
+    for energy in (0.7, 1.2):
+        exact = syst.leads[0].selfenergy(energy)
+        interpolated = grid_syst.leads[0].selfenergy(energy)
+        assert np.max(np.abs(exact - interpolated)) < 10 * tol
+    raises(ValueError, grid_syst.leads[0].selfenergy, 2)
+    with warns(RuntimeWarning):
+        grid_syst = syst.precalculate_grid(energies, what='selfenergy',
+                                           tol=1e-12, max_energies=10)
+    assert len(grid_syst.leads[0].energies) == 10
+
+    # Storing on disk.
+    grid_syst = syst.precalculate_grid(energies, what='all')
+    fname = str(tmpdir.join('lead.npz'))
+    grid_syst.leads[0].save(fname)
+    loaded = kwant.system.GridPrecalculatedLead.load(fname)
+    np.testing.assert_array_equal(loaded.energies, energies)
+    for energy in energies:
+        prop, stab = loaded.modes(energy)
+        prop_orig, stab_orig = grid_syst.leads[0].modes(energy)
+        np.testing.assert_array_equal(prop.wave_functions,
+                                      prop_orig.wave_functions)
+        np.testing.assert_array_equal(stab.vecs, stab_orig.vecs)
+        assert stab.nmodes == stab_orig.nmodes
+        assert prop.block_nmodes == prop_orig.block_nmodes
+        assert np.all(prop.groups == prop_orig.groups)
+        np.testing.assert_array_equal(loaded.selfenergy(energy),
+                                      grid_syst.leads[0].selfenergy(energy))
+
+
+def test_refine_energy_grid():
+    # The interval with the largest interpolation error is refined first.
+    def calculate(energy):
+        return None, np.array([[energy**2 * (100 if energy < 1 else 1)]])
+
+    data = {energy: calculate(energy) for energy in (0, 1, 2)}
+    with warns(RuntimeWarning):
+        kwant.system._refine_energy_grid(data, calculate, 1e-3, 7)
+    assert sorted(data) == [0, 0.25, 0.5, 0.75, 1, 1.5, 2]
+
+    data = {energy: calculate(energy) for energy in (0, 1, 2)}
+    kwant.system._refine_energy_grid(data, calculate, 1e-3, 1000)
+    assert len(data) < 1000